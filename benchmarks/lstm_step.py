@@ -0,0 +1,57 @@
+"""
+Micro-benchmark: KalmanNetNN.lstm_rnn_step (two matmuls, two bias adds, four slices)
+against KalmanNetNN.lstm_fused_step (one addmm on the stacked [W_ih | W_hh] weights).
+
+Run from the repository root:
+    python -m benchmarks.lstm_step
+"""
+
+import time
+import torch
+
+import simulations.config as config
+from simulations.Linear_sysmdl import SystemModel
+from mnets.KNet_mnet import KalmanNetNN
+
+dims = [2, 3, 5, 10, 20] # m = n
+batch_size = 100
+n_iter = 1000
+
+def time_steps(step, n_iter):
+    start = time.perf_counter()
+    for _ in range(n_iter):
+        step()
+    return (time.perf_counter() - start) / n_iter * 1e6 # [us]
+
+args = config.general_settings()
+torch.manual_seed(0)
+print(f"batch size {batch_size}, {n_iter} iterations, time per step of the three KNet LSTMs")
+print(f"{'m=n':>5} {'unfused [us]':>14} {'fused [us]':>12} {'speedup':>8} {'max abs diff':>13}")
+for dim in dims:
+    SysModel = SystemModel(torch.eye(dim), torch.eye(dim), torch.eye(dim), torch.eye(dim), 1, 1, torch.zeros(4))
+    mnet = KalmanNetNN()
+    n_params = mnet.NNBuild(SysModel, args)
+    w = mnet.bind_weights(0.1 * torch.randn(n_params))
+
+    inputs = {}
+    for lstm in ('lstm_q', 'lstm_sigma', 'lstm_s'):
+        d_hidden, d_input = mnet.lstm_shape[lstm + '_w_hh'][1], mnet.lstm_shape[lstm + '_w_ih'][1]
+        inputs[lstm] = (torch.randn(1, batch_size, d_input), \
+            (torch.randn(1, batch_size, d_hidden), torch.randn(1, batch_size, d_hidden)))
+
+    def unfused():
+        return [mnet.lstm_rnn_step(x_t, h_t, [w[lstm + '_w_ih'], w[lstm + '_b_ih'], w[lstm + '_w_hh'], w[lstm + '_b_hh']]) \
+            for lstm, (x_t, h_t) in inputs.items()]
+
+    def fused():
+        return [mnet.lstm_fused_step(x_t, h_t, w[lstm + '_w'], w[lstm + '_b']) \
+            for lstm, (x_t, h_t) in inputs.items()]
+
+    with torch.no_grad():
+        diff = max((a - b).abs().max().item() for out_u, out_f in zip(unfused(), fused()) \
+            for a, b in zip(out_u, out_f))
+        for _ in range(10): # warm up
+            unfused(); fused()
+        t_unfused = time_steps(unfused, n_iter)
+        t_fused = time_steps(fused, n_iter)
+    print(f"{dim:>5} {t_unfused:>14.1f} {t_fused:>12.1f} {t_unfused / t_fused:>7.2f}x {diff:>13.2e}")
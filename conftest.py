@@ -0,0 +1,40 @@
+"""
+Shared fixtures of the tests in tests/; being at the repository root, it also puts the root on sys.path.
+"""
+
+import sys
+import pytest
+import torch
+import simulations.config as config
+from simulations.Linear_sysmdl import SystemModel
+from simulations.linear_canonical.parameters import F, H, Q_structure, R_structure, m1_0
+from mnets.KNet_mnet import KalmanNetNN
+from hnets.hnet import HyperNetwork
+
+T = 20 # sequence length of sys_model
+
+@pytest.fixture
+def args(monkeypatch):
+    # the default settings, without the command line of pytest
+    monkeypatch.setattr(sys, 'argv', ['pytest'])
+    torch.manual_seed(0)
+    return config.general_settings()
+
+@pytest.fixture
+def sys_model():
+    # linear canonical model with r2 = q2 = 1, as the first dataset of main_linear_canonical.py
+    sys_model = SystemModel(F, Q_structure, H, R_structure, T, T, torch.tensor([0, 0, 1, 1.]))
+    sys_model.InitSequence(m1_0, torch.zeros(2, 2))
+    return sys_model
+
+@pytest.fixture
+def mnet(args, sys_model):
+    mnet = KalmanNetNN()
+    mnet.NNBuild(sys_model, args)
+    return mnet
+
+@pytest.fixture
+def hnet(args, mnet):
+    hnet = HyperNetwork(args, mnet.n_params_KNet)
+    hnet.init_hidden()
+    return hnet
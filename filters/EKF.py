@@ -3,7 +3,9 @@ Theoretical Non Linear Kalman
 """
 import torch
 
-from simulations.lorenz_attractor.parameters import getJacobian
+from filters.utils import psd_sqrt, sqrt_predict, sqrt_update, sqrt_gain, joseph_update,\
+    allocate_history, history_dtype
+from simulations.lorenz_attractor.parameters import getJacobian, getValueAndJacobian
 
 class ExtendedKalmanFilter:
 
@@ -24,31 +26,49 @@ class ExtendedKalmanFilter:
         # sequence length (use maximum length if random length case)
         self.T = SystemModel.T
         self.T_test = SystemModel.T_test
+
+        # covariances (and gains) recorded every history_stride-th step, only the means if 0
+        self.history_stride = args.filter_history_stride
+        self.history_dtype = history_dtype(args)
+
+        # covariance update: 'standard', 'joseph' or 'sqrt' (propagate Cholesky factors)
+        self.form = args.KF_form
+        if self.form == 'sqrt':
+            self.Q_sqrt = psd_sqrt(self.Q)
+            self.R_sqrt = psd_sqrt(self.R)
   
     # Predict
     def Predict(self):
-        # Predict the 1-st moment of x
-        self.m1x_prior = self.f(self.m1x_posterior).to(self.device)
+        # Predict the 1-st moment of x and compute the Jacobian of f
+        self.m1x_prior, F = getValueAndJacobian(self.m1x_posterior, self.f)
+        self.m1x_prior = self.m1x_prior.to(self.device)
         # Compute the Jacobians
-        self.UpdateJacobians(getJacobian(self.m1x_posterior,self.f), getJacobian(self.m1x_prior, self.h))
+        self.UpdateJacobians(F, getJacobian(self.m1x_prior, self.h))
+        # Predict the 1-st moment of y
+        self.m1y = self.h(self.m1x_prior)
+
+        if self.form == 'sqrt':
+            # Square-root prior and innovation covariances
+            self.S_prior = sqrt_predict(self.batched_F, self.S_posterior, self.Q_sqrt)
+            self.S_y, self.K_bar, self.S_posterior = sqrt_update(self.batched_H, self.S_prior, self.R_sqrt)
+            return
+
         # Predict the 2-nd moment of x
         self.m2x_prior = torch.bmm(self.batched_F, self.m2x_posterior)
         self.m2x_prior = torch.bmm(self.m2x_prior, self.batched_F_T) + self.Q
 
-        # Predict the 1-st moment of y
-        self.m1y = self.h(self.m1x_prior)
         # Predict the 2-nd moment of y
         self.m2y = torch.bmm(self.batched_H, self.m2x_prior)
         self.m2y = torch.bmm(self.m2y, self.batched_H_T) + self.R
 
     # Compute the Kalman Gain
     def KGain(self):
-        self.KG = torch.bmm(self.m2x_prior, self.batched_H_T)
-        self.KG = torch.bmm(self.KG, torch.inverse(self.m2y))
-
-        #Save KalmanGain
-        self.KG_array[:,:,:,self.i] = self.KG
-        self.i += 1
+        if self.form == 'sqrt':
+            self.KG = sqrt_gain(self.S_y, self.K_bar)
+        else:
+            # KG = m2x_prior H^T m2y^-1, i.e. KG^T = m2y^-1 H m2x_prior with m2y and m2x_prior symmetric
+            L = torch.linalg.cholesky(self.m2y)
+            self.KG = torch.cholesky_solve(torch.bmm(self.batched_H, self.m2x_prior), L).transpose(1, 2)
 
     # Innovation
     def Innovation(self, y):
@@ -60,8 +80,13 @@ class ExtendedKalmanFilter:
         self.m1x_posterior = self.m1x_prior + torch.bmm(self.KG, self.dy)
 
         # Compute the 2-nd posterior moment
-        self.m2x_posterior = torch.bmm(self.m2y, torch.transpose(self.KG, 1, 2))
-        self.m2x_posterior = self.m2x_prior - torch.bmm(self.KG, self.m2x_posterior)
+        if self.form == 'sqrt':
+            self.m2x_posterior = torch.bmm(self.S_posterior, torch.transpose(self.S_posterior, 1, 2))
+        elif self.form == 'joseph':
+            self.m2x_posterior = joseph_update(self.m2x_prior, self.KG, self.batched_H, self.R)
+        else:
+            self.m2x_posterior = torch.bmm(self.m2y, torch.transpose(self.KG, 1, 2))
+            self.m2x_posterior = self.m2x_prior - torch.bmm(self.KG, self.m2x_posterior)
 
     def Update(self, y):
         self.Predict()
@@ -87,29 +112,36 @@ class ExtendedKalmanFilter:
     ######################
     ### Generate Batch ###
     ######################
-    def GenerateBatch(self, y):
+    def GenerateBatch(self, y, callback=None):
         """
         input y: batch of observations [batch_size, n, T]
+        input callback (function): called as callback(t, self) after each step, e.g. to stream
+            self.m2x_posterior or self.KG instead of recording their history
         """
         y = y.to(self.device)
         self.batch_size = y.shape[0] # batch size
         T = y.shape[2] # sequence length (maximum length if randomLength=True)
 
         # Pre allocate KG array
-        self.KG_array = torch.zeros([self.batch_size,self.m,self.n,T]).to(self.device)
-        self.i = 0 # Index for KG_array alocation
+        self.KG_array = allocate_history([self.batch_size, self.m, self.n], T, self.history_stride, self.history_dtype, self.device)
 
         # Allocate Array for 1st and 2nd order moments (use zero padding)
         self.x = torch.zeros(self.batch_size, self.m, T).to(self.device)
-        self.sigma = torch.zeros(self.batch_size, self.m, self.m, T).to(self.device)
+        self.sigma = allocate_history([self.batch_size, self.m, self.m], T, self.history_stride, self.history_dtype, self.device)
             
         # Set 1st and 2nd order moments for t=0
         self.m1x_posterior = self.m1x_0_batch.to(self.device)
         self.m2x_posterior = self.m2x_0_batch.to(self.device)
+        if self.form == 'sqrt':
+            self.S_posterior = psd_sqrt(self.m2x_posterior)
 
         # Generate in a batched manner
         for t in range(0, T):
             yt = torch.unsqueeze(y[:, :, t],2)
             xt,sigmat = self.Update(yt)
             self.x[:, :, t] = torch.squeeze(xt,2)
-            self.sigma[:, :, :, t] = sigmat
\ No newline at end of file
+            if self.sigma is not None and t % self.history_stride == 0:
+                self.sigma[:, :, :, t // self.history_stride] = sigmat
+                self.KG_array[:, :, :, t // self.history_stride] = self.KG
+            if callback is not None:
+                callback(t, self)
\ No newline at end of file
@@ -1,6 +1,7 @@
 import torch.nn as nn
 import torch
 import time
+from pipelines.utils import masked_mse
 from filters.EKF import ExtendedKalmanFilter
 
 
@@ -8,13 +9,6 @@ def EKFTest(args, SysModel, test_input, test_target, allStates=True,\
      randomInit = False,test_init=None, test_lengthMask=None):
     # Number of test samples
     N_T = test_target.size()[0]
-    # LOSS
-    loss_fn = nn.MSELoss(reduction='mean')  
-    # MSE [Linear]
-    MSE_EKF_linear_arr = torch.zeros(N_T)
-    # Allocate empty tensor for output
-    EKF_out = torch.zeros([N_T, SysModel.m, test_input.size()[2]]) # N_T x m x T
-    KG_array = torch.zeros([N_T, SysModel.m, SysModel.n, test_input.size()[2]]) # N_T x m x n x T
     
     if not allStates:
         loc = torch.tensor([True,False,False]) # for position only
@@ -33,21 +27,12 @@ def EKFTest(args, SysModel, test_input, test_target, allStates=True,\
     end = time.time()
     t = end - start
 
-    KG_array = EKF.KG_array
+    KG_array = EKF.KG_array # None unless args.filter_history_stride > 0
     EKF_out = EKF.x
 
-    # MSE loss
-    for j in range(N_T):# cannot use batch due to different length and std computation   
-        if(allStates):
-            if args.randomLength:
-                MSE_EKF_linear_arr[j] = loss_fn(EKF.x[j,:,test_lengthMask[j]], test_target[j,:,test_lengthMask[j]]).item()
-            else:      
-                MSE_EKF_linear_arr[j] = loss_fn(EKF.x[j,:,:], test_target[j,:,:]).item()
-        else: # mask on state
-            if args.randomLength:
-                MSE_EKF_linear_arr[j] = loss_fn(EKF.x[j,loc,test_lengthMask[j]], test_target[j,loc,test_lengthMask[j]]).item()
-            else:           
-                MSE_EKF_linear_arr[j] = loss_fn(EKF.x[j,loc,:], test_target[j,loc,:]).item()
+    # MSE loss of each sequence
+    MSE_EKF_linear_arr = masked_mse(EKF.x, test_target, test_lengthMask if args.randomLength else None, \
+        None if allStates else loc).cpu()
 
     MSE_EKF_linear_avg = torch.mean(MSE_EKF_linear_arr)
     MSE_EKF_dB_avg = 10 * torch.log10(MSE_EKF_linear_avg)
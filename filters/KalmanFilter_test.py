@@ -1,18 +1,12 @@
 import torch
 import torch.nn as nn
 import time
+from pipelines.utils import masked_mse
 from filters.Linear_KF import KalmanFilter
 
 def KFTest(args, SysModel, test_input, test_target, allStates=True,\
      randomInit = False, test_init=None, test_lengthMask=None):
 
-    # LOSS
-    loss_fn = nn.MSELoss(reduction='mean')
-
-    # MSE [Linear]
-    MSE_KF_linear_arr = torch.zeros(args.N_T)
-    # allocate memory for KF output
-    KF_out = torch.zeros(args.N_T, SysModel.m, args.T_test)
     if not allStates:
         loc = torch.tensor([True,False,False]) # for position only
         if SysModel.m == 2: 
@@ -31,18 +25,9 @@ def KFTest(args, SysModel, test_input, test_target, allStates=True,\
     end = time.time()
     t = end - start
     KF_out = KF.x
-    # MSE loss
-    for j in range(args.N_T):# cannot use batch due to different length and std computation   
-        if(allStates):
-            if args.randomLength:
-                MSE_KF_linear_arr[j] = loss_fn(KF.x[j,:,test_lengthMask[j]], test_target[j,:,test_lengthMask[j]]).item()
-            else:      
-                MSE_KF_linear_arr[j] = loss_fn(KF.x[j,:,:], test_target[j,:,:]).item()
-        else: # mask on state
-            if args.randomLength:
-                MSE_KF_linear_arr[j] = loss_fn(KF.x[j,loc,test_lengthMask[j]], test_target[j,loc,test_lengthMask[j]]).item()
-            else:           
-                MSE_KF_linear_arr[j] = loss_fn(KF.x[j,loc,:], test_target[j,loc,:]).item()
+    # MSE loss of each sequence
+    MSE_KF_linear_arr = masked_mse(KF.x, test_target, test_lengthMask if args.randomLength else None, \
+        None if allStates else loc).cpu()
 
     MSE_KF_linear_avg = torch.mean(MSE_KF_linear_arr)
     MSE_KF_dB_avg = 10 * torch.log10(MSE_KF_linear_avg)
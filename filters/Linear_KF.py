@@ -4,6 +4,9 @@ batched version
 """
 import torch
 
+from filters.utils import psd_sqrt, sqrt_predict, sqrt_update, sqrt_gain, joseph_update,\
+    allocate_history, history_dtype
+
 class KalmanFilter:
 
     def __init__(self, SystemModel, args):
@@ -22,6 +25,19 @@ class KalmanFilter:
 
         self.T = SystemModel.T
         self.T_test = SystemModel.T_test
+
+        # tolerance on the gain change to declare steady state (shared covariance path), 0 to never freeze the gain
+        self.steady_tol = args.KF_steady_tol
+
+        # covariances (and gains) recorded every history_stride-th step, only the means if 0
+        self.history_stride = args.filter_history_stride
+        self.history_dtype = history_dtype(args)
+
+        # covariance update: 'standard', 'joseph' or 'sqrt' (propagate Cholesky factors)
+        self.form = args.KF_form
+        if self.form == 'sqrt':
+            self.Q_sqrt = psd_sqrt(self.Q)
+            self.R_sqrt = psd_sqrt(self.R)
    
     # Predict
 
@@ -29,22 +45,31 @@ class KalmanFilter:
         # Predict the 1-st moment of x
         self.m1x_prior = torch.bmm(self.batched_F, self.m1x_posterior).to(self.device)
 
+        # Predict the 1-st moment of y
+        self.m1y = torch.bmm(self.batched_H, self.m1x_prior)
+
+        if self.form == 'sqrt':
+            # Square-root prior and innovation covariances
+            self.S_prior = sqrt_predict(self.batched_F, self.S_posterior, self.Q_sqrt)
+            self.S_y, self.K_bar, self.S_posterior = sqrt_update(self.batched_H, self.S_prior, self.R_sqrt)
+            return
+
         # Predict the 2-nd moment of x
         self.m2x_prior = torch.bmm(self.batched_F, self.m2x_posterior)
         self.m2x_prior = torch.bmm(self.m2x_prior, self.batched_F_T) + self.Q
 
-        # Predict the 1-st moment of y
-        self.m1y = torch.bmm(self.batched_H, self.m1x_prior)
-
         # Predict the 2-nd moment of y
         self.m2y = torch.bmm(self.batched_H, self.m2x_prior)
         self.m2y = torch.bmm(self.m2y, self.batched_H_T) + self.R
 
     # Compute the Kalman Gain
     def KGain(self):
-        self.KG = torch.bmm(self.m2x_prior, self.batched_H_T)
-               
-        self.KG = torch.bmm(self.KG, torch.inverse(self.m2y))
+        if self.form == 'sqrt':
+            self.KG = sqrt_gain(self.S_y, self.K_bar)
+            return
+        # KG = m2x_prior H^T m2y^-1, i.e. KG^T = m2y^-1 H m2x_prior with m2y and m2x_prior symmetric
+        L = torch.linalg.cholesky(self.m2y)
+        self.KG = torch.cholesky_solve(torch.bmm(self.batched_H, self.m2x_prior), L).transpose(1, 2)
 
     # Innovation
     def Innovation(self, y):
@@ -56,8 +81,13 @@ class KalmanFilter:
         self.m1x_posterior = self.m1x_prior + torch.bmm(self.KG, self.dy)
 
         # Compute the 2-nd posterior moment
-        self.m2x_posterior = torch.bmm(self.m2y, torch.transpose(self.KG, 1, 2))
-        self.m2x_posterior = self.m2x_prior - torch.bmm(self.KG, self.m2x_posterior)
+        if self.form == 'sqrt':
+            self.m2x_posterior = torch.bmm(self.S_posterior, torch.transpose(self.S_posterior, 1, 2))
+        elif self.form == 'joseph':
+            self.m2x_posterior = joseph_update(self.m2x_prior, self.KG, self.batched_H, self.R)
+        else:
+            self.m2x_posterior = torch.bmm(self.m2y, torch.transpose(self.KG, 1, 2))
+            self.m2x_posterior = self.m2x_prior - torch.bmm(self.KG, self.m2x_posterior)
 
     def Update(self, y):
         self.Predict()
@@ -75,14 +105,23 @@ class KalmanFilter:
     ######################
     ### Generate Batch ###
     ######################
-    def GenerateBatch(self, y):
+    def GenerateBatch(self, y, callback=None):
         """
         input y: batch of observations [batch_size, n, T]
+        input callback (function): called as callback(t, self) after each step, e.g. to stream
+            self.m2x_posterior or self.KG instead of recording their history
         """
         y = y.to(self.device)
         self.batch_size = y.shape[0] # batch size
         T = y.shape[2] # sequence length (maximum length if randomLength=True)
 
+        # The covariances and gains do not depend on the observations, so if all sequences
+        # share the initial covariance they are the same for the whole batch
+        m2x_0 = self.m2x_0_batch.to(self.device)
+        if m2x_0.dim() == 2 or bool((m2x_0 == m2x_0[:1]).all()):
+            self.GenerateBatch_shared(y, m2x_0.reshape(-1, self.m, self.m)[0], callback)
+            return
+
         # Batched F and H
         self.batched_F = self.F.view(1,self.m,self.m).expand(self.batch_size,-1,-1).to(self.device)
         self.batched_F_T = torch.transpose(self.batched_F, 1, 2).to(self.device)
@@ -91,15 +130,89 @@ class KalmanFilter:
 
         # Allocate Array for 1st and 2nd order moments (use zero padding)
         self.x = torch.zeros(self.batch_size, self.m, T).to(self.device)
-        self.sigma = torch.zeros(self.batch_size, self.m, self.m, T).to(self.device)
+        self.sigma = allocate_history([self.batch_size, self.m, self.m], T, self.history_stride, self.history_dtype, self.device)
             
         # Set 1st and 2nd order moments for t=0
         self.m1x_posterior = self.m1x_0_batch.to(self.device)
         self.m2x_posterior = self.m2x_0_batch.to(self.device)
+        if self.form == 'sqrt':
+            self.S_posterior = psd_sqrt(self.m2x_posterior)
 
         # Generate in a batched manner
         for t in range(0, T):
             yt = torch.unsqueeze(y[:, :, t],2)
             xt,sigmat = self.Update(yt)
             self.x[:, :, t] = torch.squeeze(xt,2)
-            self.sigma[:, :, :, t] = sigmat
+            if self.sigma is not None and t % self.history_stride == 0:
+                self.sigma[:, :, :, t // self.history_stride] = sigmat
+            if callback is not None:
+                callback(t, self)
+
+    def GainSequence(self, m2x_0, T):
+        """
+        Riccati recursion for one covariance (shared by the whole batch), stopped early once
+        the gain changes by less than self.steady_tol (steady state)
+
+        input m2x_0 (torch.tensor): initial covariance [m, m]
+        input T (int): sequence length
+        output (tuple): gains [T, m, n], posterior covariances [T, m, m]
+        """
+        F, H = self.F.to(self.device), self.H.to(self.device)
+        KG_list, sigma_list = [], []
+        m2x_posterior = m2x_0
+        if self.form == 'sqrt':
+            S_posterior = psd_sqrt(m2x_0).unsqueeze(0)
+        for t in range(0, T):
+            if self.form == 'sqrt':
+                S_prior = sqrt_predict(F, S_posterior, self.Q_sqrt)
+                S_y, K_bar, S_posterior = sqrt_update(H, S_prior, self.R_sqrt)
+                KG = sqrt_gain(S_y, K_bar)[0]
+                m2x_posterior = S_posterior[0] @ S_posterior[0].T
+            else:
+                m2x_prior = F @ m2x_posterior @ F.T + self.Q
+                m2y = H @ m2x_prior @ H.T + self.R
+                L = torch.linalg.cholesky(m2y)
+                KG = torch.cholesky_solve(H @ m2x_prior, L).T
+                if self.form == 'joseph':
+                    m2x_posterior = joseph_update(m2x_prior, KG, H, self.R)
+                else:
+                    m2x_posterior = m2x_prior - KG @ m2y @ KG.T
+            KG_list.append(KG)
+            sigma_list.append(m2x_posterior)
+            if self.steady_tol > 0 and t > 0 and (KG - KG_list[-2]).abs().max() < self.steady_tol:
+                break
+        KG_seq, sigma_seq = torch.stack(KG_list), torch.stack(sigma_list)
+        if len(KG_list) < T: # steady state, keep the last gain and covariance
+            KG_seq = torch.cat([KG_seq, KG_seq[-1:].expand(T - len(KG_list), -1, -1)])
+            sigma_seq = torch.cat([sigma_seq, sigma_seq[-1:].expand(T - len(sigma_list), -1, -1)])
+        return KG_seq, sigma_seq
+
+    def GenerateBatch_shared(self, y, m2x_0, callback=None):
+        """
+        same output as GenerateBatch when all sequences share the initial covariance:
+        the Riccati recursion runs once, then only x = F x + K (y - H F x) is batched
+
+        input y: batch of observations [batch_size, n, T]
+        input m2x_0: shared initial covariance [m, m]
+        input callback (function): called as callback(t, self) after each step
+        """
+        T = y.shape[2]
+        F, H = self.F.to(self.device), self.H.to(self.device)
+        self.KG_seq, sigma_seq = self.GainSequence(m2x_0, T)
+
+        self.x = torch.zeros(self.batch_size, self.m, T).to(self.device)
+        # Same covariance for every sequence, expanded without copying
+        self.sigma = None
+        if self.history_stride > 0:
+            self.sigma = sigma_seq[::self.history_stride].to(self.history_dtype or sigma_seq.dtype).permute(1, 2, 0).unsqueeze(0).expand(self.batch_size, -1, -1, -1)
+
+        self.m1x_posterior = self.m1x_0_batch.to(self.device)
+        for t in range(0, T):
+            self.m1x_prior = torch.matmul(F, self.m1x_posterior)
+            self.m1x_posterior = self.m1x_prior + torch.matmul(self.KG_seq[t], y[:, :, t:t+1] - torch.matmul(H, self.m1x_prior))
+            self.x[:, :, t] = torch.squeeze(self.m1x_posterior, 2)
+            if callback is not None:
+                self.KG = self.KG_seq[t].expand(self.batch_size, -1, -1)
+                self.m2x_posterior = sigma_seq[t].expand(self.batch_size, -1, -1)
+                callback(t, self)
+        self.m2x_posterior = sigma_seq[-1].expand(self.batch_size, -1, -1)
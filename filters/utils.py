@@ -0,0 +1,103 @@
+"""
+The file contains utility functions for the model-based filters: the square-root (Cholesky factor)
+covariance recursion, the Joseph-form covariance correction and the storage of per-step histories.
+"""
+
+import torch
+
+def allocate_history(shape, T, stride, dtype=None, device=None):
+    """
+    storage for a per-step history (covariances or gains) recorded every stride-th time step,
+    i.e. steps 0, stride, 2*stride, ... at index t // stride
+
+    input shape (list): shape of one step, e.g. [batch_size, m, m]
+    input T (int): sequence length
+    input stride (int): record every stride-th step, 0 to not record the history
+    input dtype (torch.dtype): storage dtype (e.g. torch.float16 to halve the memory), default dtype if None
+    output (torch.tensor): [*shape, ceil(T / stride)], None if stride is 0
+    """
+    if stride == 0:
+        return None
+    return torch.zeros(list(shape) + [(T + stride - 1) // stride], dtype=dtype, device=device)
+
+def history_dtype(args):
+    # storage dtype of the filter histories from args.filter_history_dtype (e.g. 'float16'), None for the default dtype
+    if args.filter_history_dtype is None:
+        return None
+    return getattr(torch, args.filter_history_dtype)
+
+def psd_sqrt(P):
+    """
+    square root S of a symmetric positive semi-definite matrix, S S^T = P
+    (the Cholesky factor if P is positive definite, e.g. not for a zero initial covariance)
+
+    input P (torch.tensor): [..., m, m]
+    output S (torch.tensor): [..., m, m]
+    """
+    L, info = torch.linalg.cholesky_ex(P)
+    if not bool((info != 0).any()):
+        return L
+    eigval, eigvec = torch.linalg.eigh(P)
+    return eigvec * eigval.clamp(min=0).sqrt().unsqueeze(-2)
+
+def lower_triangularize(A):
+    """
+    lower-triangular L with L L^T = A A^T, from the QR decomposition of A^T
+
+    input A (torch.tensor): [batch_size, k, l] with l >= k
+    output L (torch.tensor): [batch_size, k, k]
+    """
+    R = torch.linalg.qr(A.transpose(1, 2), mode='r')[1]
+    return R.transpose(1, 2)
+
+def sqrt_predict(F, S_posterior, Q_sqrt):
+    """
+    square-root time update, S_prior S_prior^T = F P_posterior F^T + Q
+
+    input F (torch.tensor): [batch_size, m, m] or [m, m]
+    input S_posterior (torch.tensor): [batch_size, m, m]
+    input Q_sqrt (torch.tensor): [m, m]
+    output S_prior (torch.tensor): lower triangular [batch_size, m, m]
+    """
+    FS = torch.matmul(F, S_posterior)
+    return lower_triangularize(torch.cat([FS, Q_sqrt.expand_as(FS)], dim=2))
+
+def sqrt_update(H, S_prior, R_sqrt):
+    """
+    square-root measurement update in array form, the pre-array
+        [R^1/2  H S_prior]  is triangularized to  [S_y    0          ]
+        [0      S_prior  ]                        [K_bar  S_posterior]
+    with S_y S_y^T = H P_prior H^T + R and the Kalman gain K = K_bar S_y^-1
+
+    input H (torch.tensor): [batch_size, n, m] or [n, m]
+    input S_prior (torch.tensor): [batch_size, m, m]
+    input R_sqrt (torch.tensor): [n, n]
+    output (tuple): S_y [batch_size, n, n], K_bar [batch_size, m, n], S_posterior [batch_size, m, m]
+    """
+    batch_size, m = S_prior.shape[0], S_prior.shape[1]
+    n = R_sqrt.shape[0]
+    top = torch.cat([R_sqrt.expand(batch_size, n, n), torch.matmul(H, S_prior)], dim=2)
+    bottom = torch.cat([S_prior.new_zeros(batch_size, m, n), S_prior], dim=2)
+    L = lower_triangularize(torch.cat([top, bottom], dim=1))
+    return L[:, :n, :n], L[:, n:, :n], L[:, n:, n:]
+
+def sqrt_gain(S_y, K_bar):
+    # Kalman gain K = K_bar S_y^-1, with S_y lower triangular
+    return torch.linalg.solve_triangular(S_y, K_bar, upper=False, left=False)
+
+def joseph_update(m2x_prior, KG, H, R):
+    """
+    Joseph-form posterior covariance (I - K H) P_prior (I - K H)^T + K R K^T,
+    which stays symmetric positive semi-definite for any gain
+
+    input m2x_prior (torch.tensor): [batch_size, m, m]
+    input KG (torch.tensor): [batch_size, m, n]
+    input H (torch.tensor): [batch_size, n, m] or [n, m]
+    input R (torch.tensor): [n, n]
+    output (torch.tensor): [batch_size, m, m]
+    """
+    m = m2x_prior.shape[-1]
+    I_KH = torch.eye(m, dtype=KG.dtype, device=KG.device) - torch.matmul(KG, H)
+    m2x_posterior = torch.matmul(torch.matmul(I_KH, m2x_prior), I_KH.transpose(-1, -2))
+    m2x_posterior = m2x_posterior + torch.matmul(torch.matmul(KG, R), KG.transpose(-1, -2))
+    return (m2x_posterior + m2x_posterior.transpose(-1, -2)) / 2
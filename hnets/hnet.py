@@ -5,8 +5,15 @@ architecture 1: FC - GRU - FC
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+from collections import OrderedDict
 
 class HyperNetwork(nn.Module):
+    # models pickled before the bfloat16 mode existed
+    autocast_bf16 = False
+    _bf16_params = None
+    _bf16_version = None
+
     def __init__(self, args, output_size):
         super(HyperNetwork, self).__init__()
         # Device
@@ -20,10 +27,31 @@ class HyperNetwork(nn.Module):
         self.fc1 = nn.Linear(args.hnet_input_size, self.hidden_size).to(self.device)
         self.gru = nn.GRU(self.hidden_size, self.hidden_size).to(self.device)
         self.fc2 = nn.Linear(self.hidden_size, output_size).to(self.device)
+        # run the layers in bfloat16 (autocast), the generated weights are returned in float32
+        self.autocast_bf16 = getattr(args, 'autocast_bf16', False) # missing in the args of older checkpoints
 
     def forward(self, SoW):
+        """
+        input SoW (torch.tensor): [hnet_input_size], or [num_SoW, hnet_input_size]
+            to generate the KNet weights of several SoWs in one call
+        output (torch.tensor): KNet weights [n_params_KNet], or [num_SoW, n_params_KNet]
+        """
+        if not self.autocast_bf16:
+            return self._forward(SoW)
+        with torch.autocast(SoW.device.type, dtype=torch.bfloat16):
+            x = self._forward(SoW)
+        self.hgru = self.hgru.float()
+        return x.float()
+
+    def _forward(self, SoW):
         x = self.fc1(SoW)
         x = torch.relu(x)
+        if SoW.dim() == 2:
+            # each SoW is a one-step sequence starting from the current hidden state,
+            # the stored hidden state is left untouched
+            hgru = self.hgru.expand(-1, SoW.shape[0], -1).contiguous()
+            x, _ = self.gru(x.unsqueeze(0), hgru)
+            return self.fc2(x.squeeze(0))
         x = x.unsqueeze(0).unsqueeze(0)
         x, self.hgru = self.gru(x, self.hgru)
         x = x.squeeze(0)
@@ -38,6 +66,101 @@ class HyperNetwork(nn.Module):
         hidden = weight.new(1, 1, self.fc1.out_features).zero_()
         self.hgru = hidden.data
 
+    def generate(self, SoW):
+        """
+        stateless forward: the KNet weights from the initial (zero) hidden state, i.e. the output of
+        init_hidden() followed by forward(SoW), without reading or updating the stored hidden state
+
+        input SoW (torch.tensor): [hnet_input_size], or [num_SoW, hnet_input_size]
+        output (torch.tensor): KNet weights [n_params_KNet], or [num_SoW, n_params_KNet]
+        """
+        if self.autocast_bf16 and not torch.is_grad_enabled():
+            return self._generate_bf16(SoW)
+        with torch.autocast(SoW.device.type, dtype=torch.bfloat16, enabled=self.autocast_bf16):
+            x = torch.relu(self.fc1(SoW.reshape(-1, SoW.shape[-1])))
+            x, _ = self.gru(x.unsqueeze(0)) # zero initial hidden state
+            x = self.fc2(x.squeeze(0))
+        x = x.float()
+        return x if SoW.dim() == 2 else x.squeeze(0)
+
+    def _generate_bf16(self, SoW):
+        # Inference in bfloat16 on a copy of the parameters that is only made again when they change;
+        # autocast would cast them at every call, which costs more than the layers themselves.
+        # From the zero initial state the GRU step only needs its input weights: h = (1 - z) * n
+        version = tuple((p.data_ptr(), p._version) for p in self.parameters())
+        if self._bf16_version != version:
+            self._bf16_params = {name: p.detach().bfloat16() for name, p in self.named_parameters()}
+            self._bf16_version = version
+        p = self._bf16_params
+        x = torch.relu(F.linear(SoW.reshape(-1, SoW.shape[-1]).bfloat16(), p['fc1.weight'], p['fc1.bias']))
+        i_r, i_z, i_n = F.linear(x, p['gru.weight_ih_l0'], p['gru.bias_ih_l0']).chunk(3, dim=-1)
+        h_r, h_z, h_n = p['gru.bias_hh_l0'].chunk(3)
+        r = torch.sigmoid(i_r + h_r)
+        z = torch.sigmoid(i_z + h_z)
+        n = torch.tanh(i_n + r * h_n)
+        x = F.linear((1 - z) * n, p['fc2.weight'], p['fc2.bias']).float()
+        return x if SoW.dim() == 2 else x.squeeze(0)
+
+
+class WeightCache:
+    """
+    LRU cache of generated KNet weights in front of a HyperNetwork, for evaluation and deployment
+    where the same few SoWs recur. Entries are keyed on the SoW tensor quantised to `quantum`,
+    bounded by the bytes of cached weights, and dropped whenever a parameter of the hypernetwork
+    changes (optimizer.step(), load_state_dict or moving it to another device bump the version).
+    The weights come from the stateless HyperNetwork.generate, so they do not depend on call order.
+    In training mode the cache is bypassed.
+    """
+    def __init__(self, hnet, max_bytes=64 * 2**20, quantum=1e-6):
+        self.hnet = hnet
+        self.max_bytes = max_bytes
+        self.quantum = quantum
+        self.entries = OrderedDict() # key -> generated weights, least recently used first
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.version = None
+
+    def __call__(self, SoW):
+        """
+        input SoW (torch.tensor): [hnet_input_size], or [num_SoW, hnet_input_size]
+        output (torch.tensor): KNet weights [n_params_KNet], or [num_SoW, n_params_KNet]; 
+            cached tensors are shared, do not modify them in place
+        """
+        if self.hnet.training:
+            return self.hnet.generate(SoW)
+        version = self.params_version()
+        if version != self.version:
+            self.clear()
+            self.version = version
+        key = (tuple(SoW.shape),) + tuple(torch.round(SoW.detach() / self.quantum).long().flatten().tolist())
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        self.misses += 1
+        with torch.no_grad():
+            weights = self.hnet.generate(SoW.to(self.hnet.device))
+        size = weights.numel() * weights.element_size()
+        if size <= self.max_bytes:
+            self.entries[key] = weights
+            self.n_bytes += size
+            while self.n_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.n_bytes -= evicted.numel() * evicted.element_size()
+        return weights
+
+    def params_version(self):
+        # changes whenever a parameter is updated in place or replaced, or the precision is switched
+        return tuple((p.data_ptr(), p._version) for p in self.hnet.parameters()) + (self.hnet.autocast_bf16,)
+
+    def clear(self):
+        self.entries.clear()
+        self.n_bytes = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries), 'bytes': self.n_bytes}
+
 
 # if __name__ == '__main__':
 #     import sys
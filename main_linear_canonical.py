@@ -3,7 +3,7 @@ import torch.nn as nn
 from datetime import datetime
 
 from simulations.Linear_sysmdl import SystemModel
-from simulations.utils import DataGen
+from simulations.utils import DataGen_many, LoadData
 import simulations.config as config
 from simulations.linear_canonical.parameters import F, H, Q_structure, R_structure,\
    m, m1_0
@@ -119,8 +119,8 @@ for i in range(len(SoW)):
 ### Data Loader (Generate Data) ###
 ###################################
 # print("Start Data Gen")
-# for i in range(len(SoW)):
-#    DataGen(args, sys_model[i], dataFolderName + dataFileName[i])
+# DataGen_many(args, sys_model, [dataFolderName + dataFileName[i] for i in range(len(SoW))], \
+#    workers=args.datagen_workers, seed=args.datagen_seed)
 print("Data Load")
 train_input_list = []
 train_target_list = []
@@ -138,12 +138,12 @@ if args.randomLength:
 
 for i in range(len(SoW)):
    if args.randomLength:
-      [train_input, train_target, cv_input, cv_target, test_input, test_target,train_init, cv_init, test_init, train_lengthMask,cv_lengthMask,test_lengthMask] = torch.load(dataFolderName + dataFileName[i], map_location=device)
+      [train_input, train_target, cv_input, cv_target, test_input, test_target,train_init, cv_init, test_init, train_lengthMask,cv_lengthMask,test_lengthMask] = LoadData(args, dataFolderName + dataFileName[i], device)
       train_lengthMask_list.append(train_lengthMask)
       cv_lengthMask_list.append(cv_lengthMask)
       test_lengthMask_list.append(test_lengthMask)
    else:
-      [train_input, train_target, cv_input, cv_target, test_input, test_target,train_init, cv_init, test_init] = torch.load(dataFolderName + dataFileName[i], map_location=device)
+      [train_input, train_target, cv_input, cv_target, test_input, test_target,train_init, cv_init, test_init] = LoadData(args, dataFolderName + dataFileName[i], device)
    train_input_list.append((train_input, SoW[i]))
    train_target_list.append((train_target, SoW[i]))
    cv_input_list.append((cv_input, SoW[i]))
@@ -230,6 +230,10 @@ if args.randomLength:
    hknet_pipeline.NNTest_alldatasets(SoW_test_range, sys_model, test_input_list, test_target_list, path_results,test_init_list,test_lengthMask=test_lengthMask_list)
 else:    
    hknet_pipeline.NNTest_alldatasets(SoW_test_range, sys_model, test_input_list, test_target_list, path_results,test_init_list)
+## Accuracy guard of the bfloat16 mode against float32
+if args.autocast_bf16:
+   hknet_pipeline.autocast_guard(SoW_test_range, sys_model, test_input_list, test_target_list, test_init_list, \
+      lengthMask=test_lengthMask_list if args.randomLength else None)
 
 ## Save pipeline
 hknet_pipeline.save()
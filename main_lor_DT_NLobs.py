@@ -4,7 +4,7 @@ from datetime import datetime
 from filters.EKF_test import EKFTest
 
 from simulations.Extended_sysmdl import SystemModel
-from simulations.utils import DataGen,Short_Traj_Split
+from simulations.utils import DataGen_many,LoadData,Short_Traj_Split
 import simulations.config as config
 from simulations.lorenz_attractor.parameters import m1x_0, m2x_0, m, n,\
 f, h, h_nonlinear, Q_structure, R_structure
@@ -92,8 +92,8 @@ for i in range(len(SoW)):
 ###  Generate and load data DT case   ###
 #########################################
 print("Start Data Gen")
-for i in range(len(SoW)):
-   DataGen(args, sys_model[i], DatafolderName + dataFileName[i])
+DataGen_many(args, sys_model, [DatafolderName + dataFileName[i] for i in range(len(SoW))], \
+   workers=args.datagen_workers, seed=args.datagen_seed)
 print("Data Load")
 train_input_list = []
 train_target_list = []
@@ -105,7 +105,7 @@ train_init_list = []
 cv_init_list = []
 test_init_list = []
 for i in range(len(SoW)):
-   [train_input,train_target, cv_input, cv_target, test_input, test_target,train_init, cv_init, test_init] =  torch.load(DatafolderName + dataFileName[i], map_location=device)   
+   [train_input,train_target, cv_input, cv_target, test_input, test_target,train_init, cv_init, test_init] =  LoadData(args, DatafolderName + dataFileName[i], device)   
    
    train_input_list.append((train_input, SoW[i]))
    train_target_list.append((train_target, SoW[i]))
@@ -1,8 +1,10 @@
 """# **Class: KalmanNet as main network**"""
 
+import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 class KalmanNetNN(torch.nn.Module):
 
@@ -24,6 +26,9 @@ class KalmanNetNN(torch.nn.Module):
         self.use_context_mod = args.use_context_mod
 
         self.knet_trainable = args.knet_trainable
+        self.compile_KNet = args.compile_KNet
+        self.autocast_bf16 = getattr(args, 'autocast_bf16', False) # missing in the args of older checkpoints
+        self._compiled_step = None
         if self.knet_trainable:
             print("KNet is trainable")
         else:
@@ -123,6 +128,14 @@ class KalmanNetNN(torch.nn.Module):
                         d_hidden_Q * 4 * (d_hidden_Q +1) + d_hidden_Sigma * 4 * (d_hidden_Sigma +1) + d_hidden_S * 4 * (d_hidden_S +1)
         self.n_params_KNet = n_params_fc + n_params_lstm
         
+        # Initial hidden state buffers per (batch_size, m, n), see hidden_arena
+        self._arena = {}
+
+        # Per-layer views of the generated weights, see bind_weights
+        self._bound_weights = None
+        self._bound_source = None
+        self._bound_version = None
+
         self._weights = None
         # Define KNet layers
         if args.knet_trainable == True:
@@ -234,6 +247,10 @@ class KalmanNetNN(torch.nn.Module):
         self.m1x_prior_previous = self.m1x_posterior
         self.y_previous = self.h(self.m1x_posterior)
 
+        if self.knet_trainable:
+            # the fused LSTM matrices are copies of the parameters, rebuild them for every sequence
+            self._bound_weights = self._weight_dict()
+
     ######################
     ### Compute Priors ###
     ######################
@@ -247,19 +264,25 @@ class KalmanNetNN(torch.nn.Module):
     ##############################
     ### Kalman Gain Estimation ###
     ##############################
-    def step_KGain_est(self, y):
+    def KGain_features(self, y, y_previous, m1y, m1x_posterior, m1x_posterior_previous, m1x_prior_previous):
         # both in size [batch_size, n]
-        obs_diff = torch.squeeze(y,2) - torch.squeeze(self.y_previous,2) 
-        obs_innov_diff = torch.squeeze(y,2) - torch.squeeze(self.m1y,2)
+        obs_diff = torch.squeeze(y,2) - torch.squeeze(y_previous,2) 
+        obs_innov_diff = torch.squeeze(y,2) - torch.squeeze(m1y,2)
         # both in size [batch_size, m]
-        fw_evol_diff = torch.squeeze(self.m1x_posterior,2) - torch.squeeze(self.m1x_posterior_previous,2)
-        fw_update_diff = torch.squeeze(self.m1x_posterior,2) - torch.squeeze(self.m1x_prior_previous,2)
+        fw_evol_diff = torch.squeeze(m1x_posterior,2) - torch.squeeze(m1x_posterior_previous,2)
+        fw_update_diff = torch.squeeze(m1x_posterior,2) - torch.squeeze(m1x_prior_previous,2)
 
         obs_diff = F.normalize(obs_diff, p=2, dim=1, eps=1e-12, out=None)
         obs_innov_diff = F.normalize(obs_innov_diff, p=2, dim=1, eps=1e-12, out=None)
         fw_evol_diff = F.normalize(fw_evol_diff, p=2, dim=1, eps=1e-12, out=None)
         fw_update_diff = F.normalize(fw_update_diff, p=2, dim=1, eps=1e-12, out=None)
 
+        return obs_diff, obs_innov_diff, fw_evol_diff, fw_update_diff
+
+    def step_KGain_est(self, y):
+        obs_diff, obs_innov_diff, fw_evol_diff, fw_update_diff = self.KGain_features(y, self.y_previous, self.m1y, \
+            self.m1x_posterior, self.m1x_posterior_previous, self.m1x_prior_previous)
+
         # Kalman Gain Network Step
         KG = self.KGain_step(obs_diff, obs_innov_diff, fw_evol_diff, fw_update_diff)
 
@@ -299,15 +322,42 @@ class KalmanNetNN(torch.nn.Module):
     ########################
     def KGain_step(self, obs_diff, obs_innov_diff, fw_evol_diff, fw_update_diff):
 
-        def expand_dim(x):
-            expanded = torch.empty(self.seq_len_input, self.batch_size, x.shape[-1]).to(self.device)
-            expanded[0, :, :] = x
-            return expanded
+        # add the sequence dimension [1, batch_size, *]
+        obs_diff = torch.unsqueeze(obs_diff, 0)
+        obs_innov_diff = torch.unsqueeze(obs_innov_diff, 0)
+        fw_evol_diff = torch.unsqueeze(fw_evol_diff, 0)
+        fw_update_diff = torch.unsqueeze(fw_update_diff, 0)
+
+        if self._bound_weights is not None:
+            w = self._bound_weights
+        else:
+            w = self._weight_dict()
+        hidden = (self.out_Q, self.h_Q, self.out_Sigma, self.h_Sigma, self.out_S, self.h_S)
+        KG, hidden = self.KGain_net(obs_diff, obs_innov_diff, fw_evol_diff, fw_update_diff, hidden, w)
+        self.out_Q, self.h_Q, self.out_Sigma, self.h_Sigma, self.out_S, self.h_S = hidden
+
+        return KG
+
+    def KGain_net(self, obs_diff, obs_innov_diff, fw_evol_diff, fw_update_diff, hidden, w):
+        """
+        Stateless forward flow of the Kalman Gain network.
 
-        obs_diff = expand_dim(obs_diff)
-        obs_innov_diff = expand_dim(obs_innov_diff)
-        fw_evol_diff = expand_dim(fw_evol_diff)
-        fw_update_diff = expand_dim(fw_update_diff)
+        input obs_diff, obs_innov_diff (torch.tensor): [1, batch_size, n]
+        input fw_evol_diff, fw_update_diff (torch.tensor): [1, batch_size, m]
+        input hidden (tuple): (out_Q, h_Q, out_Sigma, h_Sigma, out_S, h_S)
+        input w (dict): KNet weights, keyed as in fc_shape and lstm_shape
+        output: KG [1, batch_size, n*m] and the updated hidden tuple
+        """
+        if not self.autocast_bf16:
+            return self._KGain_net(obs_diff, obs_innov_diff, fw_evol_diff, fw_update_diff, hidden, w)
+        # the layers with the generated weights in bfloat16, the features in and the gain and
+        # hidden states out in float32, so the Kalman state update stays in float32
+        with torch.autocast(obs_diff.device.type, dtype=torch.bfloat16):
+            KG, hidden = self._KGain_net(obs_diff, obs_innov_diff, fw_evol_diff, fw_update_diff, hidden, w)
+        return KG.float(), tuple(h.float() for h in hidden)
+
+    def _KGain_net(self, obs_diff, obs_innov_diff, fw_evol_diff, fw_update_diff, hidden, w):
+        out_Q, h_Q, out_Sigma, h_Sigma, out_S, h_S = hidden
         
         ####################
         ### Forward Flow ###
@@ -315,66 +365,74 @@ class KalmanNetNN(torch.nn.Module):
         
         # FC 5
         in_FC5 = fw_evol_diff
-        out_FC5 = self.activation_func(F.linear(in_FC5, self.fc5_w, bias=self.fc5_b))
+        out_FC5 = self.activation_func(self._linear(in_FC5, w['fc5_w'], w['fc5_b']))
 
         # Q-lstm
         in_Q = out_FC5
-        self.out_Q, self.h_Q = self.lstm_rnn_step(in_Q, (self.out_Q, self.h_Q), 
-           [self.lstm_q_w_ih,
-            self.lstm_q_b_ih,
-            self.lstm_q_w_hh,
-            self.lstm_q_b_hh])
+        out_Q, h_Q = self.lstm_fused_step(in_Q, (out_Q, h_Q), w['lstm_q_w'], w['lstm_q_b'])
 
         # FC 6
         in_FC6 = fw_update_diff
-        out_FC6 = self.activation_func(F.linear(in_FC6, self.fc6_w, bias=self.fc6_b))
+        out_FC6 = self.activation_func(self._linear(in_FC6, w['fc6_w'], w['fc6_b']))
 
         # Sigma_lstm
-        in_Sigma = torch.cat((self.out_Q, out_FC6), 2)
-        self.out_Sigma, self.h_Sigma = self.lstm_rnn_step(in_Sigma, (self.out_Sigma, self.h_Sigma), 
-           [self.lstm_sigma_w_ih,
-            self.lstm_sigma_b_ih,
-            self.lstm_sigma_w_hh,
-            self.lstm_sigma_b_hh])
+        in_Sigma = torch.cat((out_Q, out_FC6), 2)
+        out_Sigma, h_Sigma = self.lstm_fused_step(in_Sigma, (out_Sigma, h_Sigma), w['lstm_sigma_w'], w['lstm_sigma_b'])
 
         # FC 1
-        in_FC1 = self.out_Sigma
-        out_FC1 = self.activation_func(F.linear(in_FC1, self.fc1_w, bias=self.fc1_b))
+        in_FC1 = out_Sigma
+        out_FC1 = self.activation_func(self._linear(in_FC1, w['fc1_w'], w['fc1_b']))
 
         # FC 7
         in_FC7 = torch.cat((obs_diff, obs_innov_diff), 2)
-        out_FC7 = self.activation_func(F.linear(in_FC7, self.fc7_w, bias=self.fc7_b))
+        out_FC7 = self.activation_func(self._linear(in_FC7, w['fc7_w'], w['fc7_b']))
 
 
         # S-lstm
         in_S = torch.cat((out_FC1, out_FC7), 2)
-        self.out_S, self.h_S = self.lstm_rnn_step(in_S, (self.out_S, self.h_S), 
-           [self.lstm_s_w_ih,
-            self.lstm_s_b_ih,
-            self.lstm_s_w_hh,
-            self.lstm_s_b_hh])
+        out_S, h_S = self.lstm_fused_step(in_S, (out_S, h_S), w['lstm_s_w'], w['lstm_s_b'])
 
         # FC 2
-        in_FC2 = torch.cat((self.out_Sigma, self.out_S), 2)
-        out_FC2 = self.activation_func(F.linear(in_FC2, self.fc2_w1, bias=self.fc2_b1))
-        out_FC2 = F.linear(out_FC2, self.fc2_w2, bias=self.fc2_b2)
+        in_FC2 = torch.cat((out_Sigma, out_S), 2)
+        out_FC2 = self.activation_func(self._linear(in_FC2, w['fc2_w1'], w['fc2_b1']))
+        out_FC2 = self._linear(out_FC2, w['fc2_w2'], w['fc2_b2'])
 
         #####################
         ### Backward Flow ###
         #####################
 
         # FC 3
-        in_FC3 = torch.cat((self.out_S, out_FC2), 2)
-        out_FC3 = self.activation_func(F.linear(in_FC3, self.fc3_w, bias=self.fc3_b))
+        in_FC3 = torch.cat((out_S, out_FC2), 2)
+        out_FC3 = self.activation_func(self._linear(in_FC3, w['fc3_w'], w['fc3_b']))
 
         # FC 4
-        in_FC4 = torch.cat((self.out_Sigma, out_FC3), 2)
-        out_FC4 = self.activation_func(F.linear(in_FC4, self.fc4_w, bias=self.fc4_b))
+        in_FC4 = torch.cat((out_Sigma, out_FC3), 2)
+        out_FC4 = self.activation_func(self._linear(in_FC4, w['fc4_w'], w['fc4_b']))
 
         # updating hidden state of the Sigma-lstm
-        self.h_Sigma = out_FC4
+        h_Sigma = out_FC4
+
+        return out_FC2, (out_Q, h_Q, out_Sigma, h_Sigma, out_S, h_S)
+
+    def _linear(self, x, weight, bias):
+        # shared weights [d_out, d_in], or one weight set per group of samples [num_groups, d_out, d_in]
+        if weight.dim() == 2:
+            return F.linear(x, weight, bias=bias)
+        out = torch.baddbmm(bias.unsqueeze(1), x.reshape(weight.shape[0], -1, x.shape[-1]), weight.transpose(1, 2))
+        return out.reshape(x.shape[:-1] + (-1,))
+
+    def _weight_dict(self):
+        # Current KNet weights (trainable or split from the hypernetwork output) by name
+        w = {name: getattr(self, name) for name in list(self.fc_shape) + list(self.lstm_shape)}
+        return self._fuse_lstm(w)
+
+    def _fuse_lstm(self, w):
+        # Stack [W_ih | W_hh] pre-transposed and pre-sum the biases for lstm_fused_step
+        for lstm in ('lstm_q', 'lstm_sigma', 'lstm_s'):
+            w[lstm + '_w'] = torch.cat((w[lstm + '_w_ih'], w[lstm + '_w_hh']), -1).transpose(-2, -1)
+            w[lstm + '_b'] = w[lstm + '_b_ih'] + w[lstm + '_b_hh']
+        return w
 
-        return out_FC2
     ###############
     ### Forward ###
     ###############
@@ -382,21 +440,262 @@ class KalmanNetNN(torch.nn.Module):
         y = y.to(self.device)
         if weights is not None: 
             assert(self.knet_trainable == False) # if weights are provided, the KNet should not be trainable
-            weights = weights.to(self.device)
-            self.split_weights(weights)
+            self.bind_weights(weights)
         return self.KNet_step(y)
 
+    ###########################
+    ### Whole-sequence Mode ###
+    ###########################
+    def init_state(self, M1_0):
+        """
+        input M1_0 (torch.tensor): 1st moment of x at time 0 [batch_size, m, 1]
+        output: recursion state tuple (m1x_posterior, m1x_posterior_previous, m1x_prior_previous, 
+            y_previous, out_Q, h_Q, out_Sigma, h_Sigma, out_S, h_S) for KNet_step_stateless
+        """
+        m1x_posterior = M1_0.to(self.device)
+        hidden = self.hidden_arena(m1x_posterior.shape[0])
+        return (m1x_posterior, m1x_posterior, m1x_posterior, self.h(m1x_posterior)) + hidden
+
+    def KNet_step_stateless(self, state, y, w):
+        """
+        KNet_step without side effects: the recursion state is passed in and returned.
+
+        input state (tuple): see init_state
+        input y (torch.tensor): observation at time t [batch_size, n, 1]
+        input w (dict): KNet weights, keyed as in fc_shape and lstm_shape
+        output: the updated state tuple, state[0] is the posterior [batch_size, m, 1]
+        """
+        m1x_posterior, m1x_posterior_previous, m1x_prior_previous, y_previous = state[:4]
+
+        # Compute Priors
+        m1x_prior = self.f(m1x_posterior)
+        m1y = self.h(m1x_prior)
+
+        # Compute Kalman Gain
+        features = self.KGain_features(y, y_previous, m1y, m1x_posterior, m1x_posterior_previous, m1x_prior_previous)
+        features = [torch.unsqueeze(feature, 0) for feature in features]
+        KG, hidden = self.KGain_net(*features, state[4:], w)
+        KGain = torch.reshape(KG, (y.shape[0], self.m, self.n))
+
+        # Innovation
+        dy = y - m1y # [batch_size, n, 1]
+
+        # Compute the 1-st posterior moment
+        INOV = torch.bmm(KGain, dy)
+
+        return (m1x_prior + INOV, m1x_posterior, m1x_prior, y) + hidden
+
+    def filter_sequence(self, y, M1_0, weights=None, lengths=None, checkpoint_every=0):
+        """
+        Run the KalmanNet recursion over all T time steps in one call.
+        The recursion state lives in local variables, so the attributes used
+        by the step-by-step API (forward, InitSequence, init_hidden) are untouched.
+
+        input y (torch.tensor): observations [batch_size, n, T]
+        input M1_0 (torch.tensor): 1st moment of x at time 0 [batch_size, m, 1]
+        input weights (torch.tensor): generated KNet weights [total number of weights],
+            or [num_groups, total number of weights], see bind_weights
+        input lengths (torch.tensor): valid length of each sequence [batch_size], None if all have length T.
+            Sequences are dropped from the recursion once they end, and their outputs beyond their
+            length are zero. With weight groups, a group keeps running until its longest sequence
+            has ended, see _filter_early_exit.
+        input checkpoint_every (int): if > 0 and gradients are enabled, activation checkpointing:
+            only the recursion state at every checkpoint_every-th step is kept for the backward pass,
+            the steps in between are recomputed. About sqrt(T) keeps the activation memory
+            O(sqrt(T)) for one extra forward pass.
+        output (torch.tensor): 1st posterior moments [batch_size, m, T]
+        """
+        y = y.to(self.device)
+        w = self.bind(weights)
+        step = self.step_fn()
+
+        state = self.init_state(M1_0)
+        if lengths is not None:
+            return self._filter_early_exit(step, state, y, w, lengths, checkpoint_every)
+        return self._recursion(step, state, y, w, checkpoint_every)[0]
+
+    def filter_window(self, state, y, weights=None):
+        """
+        Continue the recursion from state over the time steps of y, e.g. one window of truncated BPTT.
+
+        input state (tuple): see init_state
+        input y (torch.tensor): observations of the window [batch_size, n, T_window]
+        input weights (torch.tensor): see filter_sequence
+        output: 1st posterior moments [batch_size, m, T_window], and the state after the window
+        """
+        y = y.to(self.device)
+        return self._recursion(self.step_fn(), state, y, self.bind(weights))
+
+    def detach_state(self, state):
+        # cut the autograd graph between windows, the values are kept
+        return tuple(s.detach() for s in state)
+
+    def bind(self, weights):
+        """
+        The KNet weights of a sequence in the form taken by the steps (see step_fn), e.g. to run
+        the recursion step by step (mnets/session.py, mnets/server.py) with the same weights as filter_sequence.
+
+        input weights (torch.tensor): generated KNet weights [total number of weights],
+            or [num_groups, total number of weights], see bind_weights. None for the trainable KNet weights
+        output (dict): KNet weights, keyed as in fc_shape and lstm_shape
+        """
+        if weights is not None: 
+            assert(self.knet_trainable == False) # if weights are provided, the KNet should not be trainable
+            w = self.bind_weights(weights)
+        else:
+            w = self._weight_dict()
+        if self.autocast_bf16:
+            # cast once per sequence, autocast would cast them again at every step
+            w = {name: weight.to(torch.bfloat16) for name, weight in w.items()}
+        return w
+
+    def step_fn(self):
+        """
+        output (function): KNet_step_stateless(state, y, w), compiled with torch.compile if compile_KNet.
+            state from init_state, y [batch_size, n, 1] and w from bind
+        """
+        # f and h are arbitrary python callables, so the step is compiled with 
+        # torch.compile (when enabled) rather than scripted with TorchScript
+        if not self.compile_KNet:
+            return self.KNet_step_stateless
+        if self._compiled_step is None:
+            self._compiled_step = torch.compile(self.KNet_step_stateless)
+        return self._compiled_step
+
+    def select_state(self, state, index):
+        """
+        input state (tuple): see init_state
+        input index (slice, or torch.tensor of indices): sequences of the batch to keep
+        output: the recursion state of these sequences
+        """
+        # the posterior, prior and observation are [batch_size, *, 1], the hidden states [1, batch_size, *]
+        return tuple(s[index] for s in state[:4]) + tuple(s[:, index] for s in state[4:])
+
+    def _recursion(self, step, state, y, w, checkpoint_every=0):
+        # the steps over y [batch_size, n, T'], returns the posteriors [batch_size, m, T'] and the last state
+        if checkpoint_every > 0 and torch.is_grad_enabled():
+            x_out = []
+            names = list(w)
+            for t in range(0, y.shape[2], checkpoint_every):
+                # the segment keeps only its inputs (state, y and weights) for backward. The weights are
+                # explicit inputs so that the reentrant checkpoint (no per-op hooks) propagates their gradient
+                out = checkpoint(self._segment, step, names, y[:, :, t:t+checkpoint_every], len(state), *state, \
+                    *w.values(), use_reentrant=True, preserve_rng_state=False)
+                x_out.append(out[0])
+                state = out[1:]
+            return torch.cat(x_out, dim=2), state
+        x_out = []
+        for t in range(0, y.shape[2]):
+            state = step(state, y[:, :, t:t+1], w)
+            x_out.append(state[0])
+        return torch.cat(x_out, dim=2), state
+
+    def _segment(self, step, names, y, n_state, *tensors):
+        w = dict(zip(names, tensors[n_state:]))
+        x_out, state = self._recursion(step, tensors[:n_state], y, w)
+        return (x_out,) + state
+
+    def _filter_early_exit(self, step, state, y, w, lengths, checkpoint_every=0):
+        batch_size, T = y.shape[0], y.shape[2]
+        lengths = lengths.to(self.device).clamp(1, T)
+        n_groups = w['fc1_w'].shape[0] if w['fc1_w'].dim() == 3 else 1
+        # The sequences are sorted longest first within blocks, so the running sequences are always
+        # the leading rows of every block. Groups sharing a weight set (1 < n_groups < batch_size)
+        # are the blocks, they stay contiguous and of equal size, and a block keeps as many rows
+        # as the block with the most running sequences. Otherwise the whole batch is one block.
+        blocks = n_groups if 1 < n_groups < batch_size else 1
+        size = batch_size // blocks
+        lengths_block, order = torch.sort(lengths.view(blocks, size), dim=1, descending=True)
+        order = (order + size * torch.arange(blocks, device=self.device).unsqueeze(1)).flatten()
+        y = y[order]
+        state = self.select_state(state, order)
+        if n_groups == batch_size: # one weight set per sequence
+            w = {name: weight[order] for name, weight in w.items()}
+        # number of running rows per block at each time step
+        active = (lengths_block.unsqueeze(0) > torch.arange(T, device=self.device).view(T, 1, 1)).sum(2).amax(1)
+        active = active[active > 0].tolist()
+        # shrink once at least 1/8 of the rows have stopped, each shrink copies the state;
+        # the rows that run past their length are masked below
+        rows, n = [], size
+        for n_t in active:
+            if (n - n_t) * 8 >= n:
+                n = n_t
+            rows.append(n)
+
+        # runs of time steps with the same number of rows
+        y = y.view(blocks, size, self.n, T)
+        x_out, t, n = [], 0, size
+        while t < len(rows):
+            n_t, t_end = rows[t], t
+            while t_end < len(rows) and rows[t_end] == n_t:
+                t_end += 1
+            if n_t < n:
+                if blocks == 1:
+                    index = slice(0, n_t)
+                else:
+                    index = (n * torch.arange(blocks, device=self.device).unsqueeze(1) + torch.arange(n_t, device=self.device)).flatten()
+                state = self.select_state(state, index)
+                if n_groups == batch_size:
+                    w = {name: weight[:n_t] for name, weight in w.items()}
+                n = n_t
+            x_chunk, state = self._recursion(step, state, y[:, :n, :, t:t_end].reshape(blocks * n, self.n, t_end - t), w, checkpoint_every)
+            # zeros for the rows that have stopped
+            x_out.append(F.pad(x_chunk.view(blocks, n, self.m, t_end - t), (0, 0, 0, 0, 0, size - n)))
+            t = t_end
+        # and beyond the longest sequence
+        x_out = F.pad(torch.cat(x_out, dim=3), (0, T - t)).reshape(batch_size, self.m, T)
+        x_out = x_out[torch.argsort(order)]
+        # zeros beyond the length of each sequence, rows of a block may run past it
+        return x_out.masked_fill((torch.arange(T, device=self.device) >= lengths.unsqueeze(1)).unsqueeze(1), 0)
+
+    def __getstate__(self):
+        state = super().__getstate__().copy()
+        state['_compiled_step'] = None # compiled functions cannot be pickled
+        state['_arena'] = {}
+        state['_bound_weights'] = None # views of the (possibly non-leaf) hypernetwork output
+        state['_bound_source'] = None
+        state['_bound_version'] = None
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        # models saved before the whole-sequence mode existed
+        self.__dict__.setdefault('compile_KNet', False)
+        self.__dict__.setdefault('autocast_bf16', False)
+        self.__dict__.setdefault('_compiled_step', None)
+        self.__dict__.setdefault('_arena', {})
+        self.__dict__.setdefault('_bound_weights', None)
+        self.__dict__.setdefault('_bound_source', None)
+        self.__dict__.setdefault('_bound_version', None)
+
     #########################
     ### Init Hidden State ###
     #########################
     def init_hidden(self):
-        self.out_Q = self.prior_Q.flatten().reshape(1,1, -1).repeat(self.seq_len_input,self.batch_size, 1)
-        self.out_Sigma = self.prior_Sigma.flatten().reshape(1,1, -1).repeat(self.seq_len_input,self.batch_size, 1)
-        self.out_S = self.prior_S.flatten().reshape(1,1, -1).repeat(self.seq_len_input,self.batch_size, 1)
+        self.out_Q, self.h_Q, self.out_Sigma, self.h_Sigma, self.out_S, self.h_S = self.hidden_arena(self.batch_size)
 
-        self.h_S = torch.zeros(self.seq_len_input,self.batch_size,self.n ** 2).to(self.device) # batch size expansion   
-        self.h_Sigma = torch.zeros(self.seq_len_input,self.batch_size,self.m ** 2).to(self.device) # batch size expansion
-        self.h_Q = torch.zeros(self.seq_len_input,self.batch_size,self.m ** 2).to(self.device) # batch size expansion
+    def hidden_arena(self, batch_size):
+        """
+        Initial hidden states (out_Q, h_Q, out_Sigma, h_Sigma, out_S, h_S), each [1, batch_size, d_hidden].
+        The buffers are allocated once per (batch_size, m, n) shape and reused by every 
+        sequence of that shape. The recursion never writes into them, so they are filled 
+        once here and stay valid as saved tensors of earlier autograd graphs.
+        """
+        key = (batch_size, self.m, self.n)
+        if key in self._arena:
+            # least recently used first: move the hit to the end
+            self._arena[key] = self._arena.pop(key)
+        else:
+            if len(self._arena) >= 8: # only a few shapes are live at a time (train, cv, test)
+                self._arena.pop(next(iter(self._arena)))
+            buffers = ()
+            for prior in (self.prior_Q, self.prior_Sigma, self.prior_S):
+                out = torch.empty(self.seq_len_input, batch_size, prior.numel(), device=self.device)
+                out.copy_(prior.flatten().expand_as(out))
+                hidden = torch.empty_like(out).zero_()
+                buffers = buffers + (out, hidden)
+            self._arena[key] = buffers
+        return self._arena[key]
 
     #####################
     ### Split weights ###
@@ -405,45 +704,33 @@ class KalmanNetNN(torch.nn.Module):
         """
         input: weights torch.tensor [total number of weights]
         """
-        weight_index = 0
-        # split weights and biases for FC 1 - 7
-        def split_and_reshape_fc(weights, weight_index, shape_w, shape_b):
-            length_w = shape_w[0] * shape_w[1]
-            length_b = shape_b[0]
-            fc_w = weights[weight_index:weight_index+length_w].reshape(shape_w[0], shape_w[1])
-            weight_index = weight_index + length_w
-            fc_b = weights[weight_index:weight_index+length_b].reshape(shape_b[0])
-            weight_index = weight_index + length_b
-            return fc_w, fc_b, weight_index
-        
-        self.fc1_w, self.fc1_b, weight_index = split_and_reshape_fc(weights, weight_index, self.fc_shape['fc1_w'], self.fc_shape['fc1_b'])
-        self.fc2_w1, self.fc2_b1, weight_index = split_and_reshape_fc(weights, weight_index, self.fc_shape['fc2_w1'], self.fc_shape['fc2_b1'])
-        self.fc2_w2, self.fc2_b2, weight_index = split_and_reshape_fc(weights, weight_index, self.fc_shape['fc2_w2'], self.fc_shape['fc2_b2'])
-        self.fc3_w, self.fc3_b, weight_index = split_and_reshape_fc(weights, weight_index, self.fc_shape['fc3_w'], self.fc_shape['fc3_b'])
-        self.fc4_w, self.fc4_b, weight_index = split_and_reshape_fc(weights, weight_index, self.fc_shape['fc4_w'], self.fc_shape['fc4_b'])
-        self.fc5_w, self.fc5_b, weight_index = split_and_reshape_fc(weights, weight_index, self.fc_shape['fc5_w'], self.fc_shape['fc5_b'])
-        self.fc6_w, self.fc6_b, weight_index = split_and_reshape_fc(weights, weight_index, self.fc_shape['fc6_w'], self.fc_shape['fc6_b'])
-        self.fc7_w, self.fc7_b, weight_index = split_and_reshape_fc(weights, weight_index, self.fc_shape['fc7_w'], self.fc_shape['fc7_b'])
-
-        # split weights and biases for lstm Q, Sigma, S
-        def split_and_reshape_lstm(weights, weight_index, shape_w_ih, shape_b_ih, shape_w_hh, shape_b_hh):
-            length_w_ih = shape_w_ih[0] * shape_w_ih[1]
-            length_b_ih = shape_b_ih[0]
-            length_w_hh = shape_w_hh[0] * shape_w_hh[1]
-            length_b_hh = shape_b_hh[0]
-            lstm_w_ih = weights[weight_index:weight_index+length_w_ih].reshape(shape_w_ih[0], shape_w_ih[1])
-            weight_index = weight_index + length_w_ih
-            lstm_b_ih = weights[weight_index:weight_index+length_b_ih].reshape(shape_b_ih[0])
-            weight_index = weight_index + length_b_ih
-            lstm_w_hh = weights[weight_index:weight_index+length_w_hh].reshape(shape_w_hh[0], shape_w_hh[1])
-            weight_index = weight_index + length_w_hh
-            lstm_b_hh = weights[weight_index:weight_index+length_b_hh].reshape(shape_b_hh[0])
-            weight_index = weight_index + length_b_hh
-            return lstm_w_ih, lstm_b_ih, lstm_w_hh, lstm_b_hh, weight_index
-        
-        self.lstm_q_w_ih, self.lstm_q_b_ih, self.lstm_q_w_hh, self.lstm_q_b_hh, weight_index = split_and_reshape_lstm(weights, weight_index, self.lstm_shape['lstm_q_w_ih'], self.lstm_shape['lstm_q_b_ih'], self.lstm_shape['lstm_q_w_hh'], self.lstm_shape['lstm_q_b_hh'])
-        self.lstm_sigma_w_ih, self.lstm_sigma_b_ih, self.lstm_sigma_w_hh, self.lstm_sigma_b_hh, weight_index = split_and_reshape_lstm(weights, weight_index, self.lstm_shape['lstm_sigma_w_ih'], self.lstm_shape['lstm_sigma_b_ih'], self.lstm_shape['lstm_sigma_w_hh'], self.lstm_shape['lstm_sigma_b_hh'])
-        self.lstm_s_w_ih, self.lstm_s_b_ih, self.lstm_s_w_hh, self.lstm_s_b_hh, weight_index = split_and_reshape_lstm(weights, weight_index, self.lstm_shape['lstm_s_w_ih'], self.lstm_shape['lstm_s_b_ih'], self.lstm_shape['lstm_s_w_hh'], self.lstm_shape['lstm_s_b_hh'])
+        w = self.bind_weights(weights)
+        for name in list(self.fc_shape) + list(self.lstm_shape):
+            setattr(self, name, w[name])
+
+    def bind_weights(self, weights):
+        """
+        Split the generated weights into per-layer views once per sequence.
+        The hypernetwork output is constant over a sequence, so passing the 
+        same tensor again returns the cached views without re-slicing.
+
+        input weights (torch.tensor): [total number of weights], or [num_groups, total number of weights]
+            for one weight set per group of samples. The batch is then split into num_groups
+            contiguous groups of equal size, e.g. one group of sequences per SoW.
+        output (dict): KNet weights, keyed as in fc_shape and lstm_shape
+        """
+        if weights is self._bound_source and weights._version == self._bound_version:
+            return self._bound_weights
+
+        shapes = list(self.fc_shape.items()) + list(self.lstm_shape.items())
+        lengths = [math.prod(shape) for _, shape in shapes]
+        assert weights.shape[-1] == sum(lengths) == self.n_params_KNet
+        chunks = torch.split(weights.to(self.device), lengths, dim=-1)
+        group_shape = list(weights.shape[:-1])
+        self._bound_weights = self._fuse_lstm({name: chunk.reshape(group_shape + shape) for (name, shape), chunk in zip(shapes, chunks)})
+        self._bound_source = weights
+        self._bound_version = weights._version
+        return self._bound_weights
 
     ########################
     ### LSTM computation ###
@@ -497,4 +784,47 @@ class KalmanNetNN(torch.nn.Module):
         y_t = o_t * torch.tanh(c_t)
         
         return y_t, c_t
-    
\ No newline at end of file
+    
+
+    def lstm_fused_step(self, x_t, h_t, weight, bias):
+        """
+        Same computation as lstm_rnn_step, with a single matmul for all four gates.
+
+        Args:
+            x_t: Tensor of size ``[1, batch_size, n_inputs]`` with inputs.
+            h_t (tuple): (y_t, c_t) Tuple of length 2, containing two tensors of size
+                ``[1, batch_size, n_hidden]`` with previous output y and c.
+            weight: ``[W_ih | W_hh]`` transposed, of size ``[n_inputs + n_hidden, 4 * n_hidden]``,
+                or ``[num_groups, n_inputs + n_hidden, 4 * n_hidden]`` for grouped weights.
+            bias: ``bias_ih + bias_hh`` of size ``[4 * n_hidden]`` or ``[num_groups, 4 * n_hidden]``.
+
+        Returns:
+            - **y_t** (torch.Tensor): The tensor ``y_t`` of size
+              ``[1, batch_size, n_hidden]`` with the output state.
+            - **c_t** (torch.Tensor): The tensor ``c_t`` of size
+              ``[1, batch_size, n_hidden]`` with the new cell state.
+        """
+        y_t, c_t = h_t
+
+        # Compute total pre-activation input.
+        xy_t = torch.cat((x_t, y_t), 2)
+        if weight.dim() == 2:
+            gates = torch.addmm(bias, xy_t.view(-1, xy_t.shape[2]), weight)
+        else:
+            gates = torch.baddbmm(bias.unsqueeze(1), xy_t.view(weight.shape[0], -1, xy_t.shape[2]), weight)
+        gates = gates.view(xy_t.shape[0], xy_t.shape[1], -1)
+        i_t, f_t, g_t, o_t = gates.chunk(4, 2)
+
+        # Compute activation.
+        i_t = torch.sigmoid(i_t) # input
+        f_t = torch.sigmoid(f_t) # forget
+        g_t = torch.tanh(g_t)
+        o_t = torch.sigmoid(o_t) # output
+
+        # Compute c states.
+        c_t = f_t * c_t + i_t * g_t
+
+        # Compute h states.
+        y_t = o_t * torch.tanh(c_t)
+        
+        return y_t, c_t
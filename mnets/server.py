@@ -0,0 +1,204 @@
+"""# **Class: Track Server**
+Local micro-batching inference service for (Hyper-)KalmanNet. Independent tracks send one
+observation at a time with `await server.step(track_id, y_t)`; the requests that arrive within
+one tick are coalesced into a single batched KalmanNet step per SoW, so the HyperNetwork output
+is generated once per SoW and shared by all its tracks. Tracks can be opened at any time, they
+do not have to start at t=0 together.
+
+Usage:
+    server = TrackServer(mnet, hnet=hnet, max_batch=256, max_wait_us=500)
+    async with server:
+        server.open_track('a', M1_0, SoW)
+        x_t = await server.step('a', y_t)
+"""
+
+import asyncio
+import torch
+
+class TrackServer:
+
+    def __init__(self, mnet, weights=None, hnet=None, max_batch=256, max_wait_us=500):
+        """
+        input mnet (KalmanNetNN): the KalmanNet, built with NNBuild
+        input weights (torch.tensor): KNet weights [total number of weights] of tracks opened without SoW,
+            None to use the trainable KNet weights
+        input hnet (HyperNetwork): generates the KNet weights of the tracks opened with a SoW
+        input max_batch (int): a tick is flushed once it holds max_batch requests
+        input max_wait_us (float): or once max_wait_us microseconds have passed since its first request
+        """
+        self.mnet = mnet
+        self.hnet = hnet
+        self.default_weights = weights
+        self.max_batch = max_batch
+        self.max_wait = max_wait_us * 1e-6
+        self.step_fn = mnet.step_fn()
+        self.weights = {} # SoW key -> bound KNet weights, while the SoW has open tracks
+        self.n_tracks = {} # SoW key -> number of open tracks
+        self.tracks = {} # track_id -> (SoW key, recursion state of a batch of one)
+        self.queue = None
+        self.worker = None
+
+    ##############
+    ### Tracks ###
+    ##############
+    def open_track(self, track_id, M1_0, SoW=None):
+        """
+        input track_id (hashable): name of the track, an open track of that name is replaced
+        input M1_0 (torch.tensor): 1st moment of x at time 0 [m, 1] or [m]
+        input SoW (torch.tensor): [hnet_input_size], None for the default weights
+        """
+        state = self.mnet.init_state(M1_0.reshape(1, self.mnet.m, 1))
+        key = self.get_weights(SoW)
+        self.n_tracks[key] += 1 # before closing the replaced track, which may have the same SoW
+        self.close_track(track_id)
+        self.tracks[track_id] = (key, state)
+
+    def close_track(self, track_id):
+        entry = self.tracks.pop(track_id, None)
+        if entry is not None:
+            # the weights of a SoW are dropped with its last track
+            key = entry[0]
+            self.n_tracks[key] -= 1
+            if self.n_tracks[key] == 0:
+                del self.n_tracks[key], self.weights[key]
+
+    def get_weights(self, SoW):
+        # bind the KNet weights of a SoW once, shared by all its tracks
+        key = None if SoW is None else tuple(SoW.flatten().tolist())
+        if key not in self.weights:
+            if key is not None and self.hnet is None:
+                raise ValueError('tracks with a SoW need a server with an hnet')
+            with torch.no_grad():
+                if key is not None:
+                    # stateless generation, the hidden state of the shared hnet is not touched
+                    self.weights[key] = self.mnet.bind(self.hnet.generate(SoW.to(self.hnet.device)))
+                else:
+                    self.weights[key] = self.mnet.bind(self.default_weights)
+            self.n_tracks[key] = 0
+        return key
+
+    ###############
+    ### Serving ###
+    ###############
+    async def step(self, track_id, y_t):
+        """
+        input track_id (hashable): an open track
+        input y_t (torch.tensor): observation [n, 1] or [n], ValueError if it has not n elements
+        output (torch.tensor): 1st posterior moment of the track [m, 1]
+        """
+        if self.queue is None:
+            raise RuntimeError('the server is not running')
+        if track_id not in self.tracks:
+            raise KeyError(f'track {track_id!r} is not open')
+        # checked here, a bad observation in a tick would fail the batched step of all its requests
+        y_t = torch.as_tensor(y_t)
+        if y_t.numel() != self.mnet.n:
+            raise ValueError(f'y_t of shape {tuple(y_t.shape)} is not an observation of size n={self.mnet.n}')
+        y_t = y_t.to(self.mnet.device, self.mnet.prior_Q.dtype).reshape(self.mnet.n, 1)
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((track_id, y_t, future))
+        return await future
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self.worker = asyncio.create_task(self.run())
+
+    async def stop(self):
+        self.worker.cancel()
+        try:
+            await self.worker
+        except asyncio.CancelledError:
+            pass
+        # the requests that were never collected into a tick
+        queue, self.queue = self.queue, None
+        while not queue.empty():
+            queue.get_nowait()[2].cancel()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        pending = [] # requests deferred to the next tick
+        tick = []
+        try:
+            while True:
+                if not pending:
+                    pending.append(await self.queue.get())
+                # collect the tick: until max_batch requests or max_wait after the first one
+                deadline = loop.time() + self.max_wait
+                while len(pending) < self.max_batch:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        pending.append(await asyncio.wait_for(self.queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+                # at most one step per track in a tick, later requests of a track wait for the next one;
+                # requests of tracks closed meanwhile fail on their own
+                requests, tick, pending, seen = pending, [], [], set()
+                for request in requests:
+                    track_id, _, future = request
+                    if track_id not in self.tracks:
+                        if not future.done():
+                            future.set_exception(KeyError(f'track {track_id!r} is not open'))
+                    elif track_id in seen:
+                        pending.append(request)
+                    else:
+                        seen.add(track_id)
+                        tick.append(request)
+                if not tick:
+                    continue
+                # the worker thread only sees this snapshot, the tracks and weights are read
+                # and written on the event loop thread
+                entries = [self.tracks[track_id] for track_id, _, _ in tick]
+                jobs = [(self.weights[key], state, y_t) for (_, y_t, _), (key, state) in zip(tick, entries)]
+                try:
+                    results = await asyncio.to_thread(self.process, jobs)
+                except Exception as e:
+                    for _, _, future in tick:
+                        if not future.done():
+                            future.set_exception(e)
+                    tick = []
+                    continue
+                for (track_id, _, future), entry, (x, state) in zip(tick, entries, results):
+                    # not if the track was closed or reopened during the step
+                    if self.tracks.get(track_id) is entry:
+                        self.tracks[track_id] = (entry[0], state)
+                    if not future.done():
+                        future.set_result(x)
+                tick = []
+        finally:
+            for _, _, future in pending + tick:
+                future.cancel()
+
+    def process(self, jobs):
+        """
+        one batched KalmanNet step per weight set for the requests of a tick, without side effects
+
+        input jobs (list): (bound KNet weights, recursion state of the track, y_t) of each request
+        output (list): 1st posterior moment [m, 1] and new recursion state of each request
+        """
+        groups = {}
+        for i, (w, _, _) in enumerate(jobs):
+            groups.setdefault(id(w), []).append(i)
+
+        results = [None] * len(jobs)
+        with torch.no_grad():
+            for index in groups.values():
+                w = jobs[index[0]][0]
+                state = self.cat_states([jobs[i][1] for i in index])
+                y = torch.stack([jobs[i][2] for i in index]) # checked and moved to the device in step
+                state = self.step_fn(state, y, w)
+                for j, i in enumerate(index):
+                    results[i] = (state[0][j], self.mnet.select_state(state, slice(j, j+1)))
+        return results
+
+    def cat_states(self, states):
+        # the posterior, prior and observation are [batch_size, *, 1], the hidden states [1, batch_size, *]
+        return tuple(torch.cat([s[k] for s in states], dim=0 if k < 4 else 1) for k in range(len(states[0])))
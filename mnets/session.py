@@ -0,0 +1,86 @@
+"""# **Class: Filter Session**
+Online filtering with KalmanNet: observations are processed as they arrive instead of as
+[batch_size, n, T] tensors. Each session owns its recursion state and its generated KNet
+weights, so any number of sessions (e.g. groups of independent tracks) can share one
+KalmanNetNN and HyperNetwork.
+"""
+
+import torch
+
+class FilterSession:
+
+    def __init__(self, mnet, M1_0, weights=None, hnet=None, SoW=None, grad=False):
+        """
+        input mnet (KalmanNetNN): the KalmanNet, built with NNBuild
+        input M1_0 (torch.tensor): 1st moment of x at time 0 of each track [batch_size, m, 1]
+        input weights (torch.tensor): generated KNet weights [total number of weights], or
+            [num_groups, total number of weights], see KalmanNetNN.bind_weights
+        input hnet (HyperNetwork): generates the weights from SoW if weights is None
+        input SoW (torch.tensor): [hnet_input_size], or [num_groups, hnet_input_size]
+        input grad (bool): if False, the steps run without building the autograd graph
+        """
+        self.mnet = mnet
+        self.grad = grad
+        with torch.set_grad_enabled(grad):
+            if weights is None and hnet is not None:
+                # stateless generation, the hidden state of the shared hnet is not touched
+                weights = hnet.generate(SoW.to(hnet.device))
+            # bound as in filter_sequence, including the bfloat16 cast of autocast_bf16
+            self.w = mnet.bind(weights)
+        self.step_fn = mnet.step_fn()
+        self.reset(M1_0)
+
+    def reset(self, M1_0):
+        """
+        restart the recursion of all tracks, keeping the weights
+
+        input M1_0 (torch.tensor): [batch_size, m, 1]
+        """
+        self.state = self.mnet.init_state(M1_0)
+        self.t = 0
+
+    @property
+    def m1x_posterior(self):
+        # current 1st posterior moment [batch_size, m, 1]
+        return self.state[0]
+
+    def step(self, y_t):
+        """
+        input y_t (torch.tensor): observation of each track [batch_size, n] or [batch_size, n, 1]
+        output (torch.tensor): 1st posterior moment [batch_size, m, 1]
+        """
+        y_t = y_t.to(self.mnet.device).reshape(-1, self.mnet.n, 1)
+        with torch.set_grad_enabled(self.grad):
+            self.state = self.step_fn(self.state, y_t, self.w)
+        self.t += 1
+        return self.state[0]
+
+    def step_many(self, y_chunk):
+        """
+        input y_chunk (torch.tensor): next observations of each track [batch_size, n, T_chunk]
+        output (torch.tensor): 1st posterior moments [batch_size, m, T_chunk]
+        """
+        y_chunk = y_chunk.to(self.mnet.device)
+        x_out = []
+        with torch.set_grad_enabled(self.grad):
+            for t in range(0, y_chunk.shape[2]):
+                self.state = self.step_fn(self.state, y_chunk[:, :, t:t+1], self.w)
+                x_out.append(self.state[0])
+        self.t += y_chunk.shape[2]
+        return torch.cat(x_out, dim=2)
+
+    def snapshot(self):
+        """
+        the steps never write into the state tensors, so a snapshot only keeps references
+
+        output (dict): recursion state and time step, see restore
+        """
+        return {'state': self.state, 't': self.t}
+
+    def restore(self, snapshot):
+        """
+        input snapshot (dict): from snapshot, possibly of another session with the same
+            KalmanNet dimensions and number of tracks
+        """
+        self.state = snapshot['state']
+        self.t = snapshot['t']
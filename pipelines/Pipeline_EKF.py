@@ -5,9 +5,10 @@ which is used to train and test KalmanNet.
 
 import torch
 import torch.nn as nn
-import random
 import time
 from Plot import Plot_KF
+from pipelines.utils import masked_mse, seq_lengths, truncated_bptt
+from pipelines.prefetch import TrainingBatches, BatchPrefetcher
 
 
 class Pipeline_EKF:
@@ -62,6 +63,7 @@ class Pipeline_EKF:
         self.MSE_train_linear_epoch = torch.zeros([self.N_steps])
         self.MSE_train_dB_epoch = torch.zeros([self.N_steps])
         
+        mask = None
         if MaskOnState:
             mask = torch.tensor([True,False,False])
             if SysModel.m == 2: 
@@ -73,6 +75,9 @@ class Pipeline_EKF:
 
         self.MSE_cv_dB_opt = 1000
         self.MSE_cv_idx_opt = 0
+        batches = BatchPrefetcher(TrainingBatches(self.N_B, [(train_input, train_target, train_init if randomInit else None, \
+            train_lengthMask if self.args.randomLength else None)], bucket_pool=self.args.bucket_pool), \
+            self.device, depth=self.args.prefetch_batches)
 
         for ti in range(0, self.N_steps):
 
@@ -83,114 +88,64 @@ class Pipeline_EKF:
             # Training Mode
             self.model.train()
             self.model.batch_size = self.N_B
-            # Init Hidden State
-            self.model.init_hidden()
-
-            # Init Training Batch tensors
-            y_training_batch = torch.zeros([self.N_B, SysModel.n, SysModel.T]).to(self.device)
-            train_target_batch = torch.zeros([self.N_B, SysModel.m, SysModel.T]).to(self.device)
-            x_out_training_batch = torch.zeros([self.N_B, SysModel.m, SysModel.T]).to(self.device)
-            if self.args.randomLength:
-                MSE_train_linear_LOSS = torch.zeros([self.N_B])
-                MSE_cv_linear_LOSS = torch.zeros([self.N_CV])
 
             # Randomly select N_B training sequences
-            assert self.N_B <= self.N_E # N_B must be smaller than N_E
-            n_e = random.sample(range(self.N_E), k=self.N_B)
-            ii = 0
-            for index in n_e:
-                if self.args.randomLength:
-                    y_training_batch[ii,:,train_lengthMask[index,:]] = train_input[index,:,train_lengthMask[index,:]]
-                    train_target_batch[ii,:,train_lengthMask[index,:]] = train_target[index,:,train_lengthMask[index,:]]
-                else:
-                    y_training_batch[ii,:,:] = train_input[index]
-                    train_target_batch[ii,:,:] = train_target[index]
-                ii += 1
+            y_training_batch, train_target_batch, train_init_batch, train_lengthMask_batch = next(batches)[0]
             
             # Init Sequence
-            if(randomInit):
-                train_init_batch = torch.empty([self.N_B, SysModel.m,1]).to(self.device)
-                ii = 0
-                for index in n_e:
-                    train_init_batch[ii,:,0] = torch.squeeze(train_init[index])
-                    ii += 1
-                self.model.InitSequence(train_init_batch, SysModel.T)
-            else:
-                self.model.InitSequence(\
-                SysModel.m1x_0.reshape(1,SysModel.m,1).repeat(self.N_B,1,1), SysModel.T)
+            if not randomInit:
+                train_init_batch = SysModel.m1x_0.reshape(1,SysModel.m,1).repeat(self.N_B,1,1)
             
-            # Forward Computation
-            for t in range(0, SysModel.T):
-                x_out_training_batch[:, :, t] = torch.squeeze(self.model(torch.unsqueeze(y_training_batch[:, :, t],2)))
+            if self.args.tbptt_window > 0:
+                # truncated BPTT, one optimizer step per window
+                assert not self.args.CompositionLoss, 'truncated BPTT trains on the state MSE only'
+                MSE_trainbatch_linear_LOSS = truncated_bptt(self.model, self.optimizer, self.args.tbptt_window, \
+                    [(lambda: None, y_training_batch, train_init_batch, train_target_batch, train_lengthMask_batch)], mask)
+                self.MSE_train_linear_epoch[ti] = MSE_trainbatch_linear_LOSS.item()
+                self.MSE_train_dB_epoch[ti] = 10 * torch.log10(self.MSE_train_linear_epoch[ti])
+            else:
+                # Forward Computation
+                x_out_training_batch = self.model.filter_sequence(y_training_batch, train_init_batch, lengths=seq_lengths(train_lengthMask_batch), \
+                    checkpoint_every=self.args.checkpoint_every)
             
-            # Compute Training Loss
-            MSE_trainbatch_linear_LOSS = 0
-            if (self.args.CompositionLoss):
-                y_hat = torch.zeros([self.N_B, SysModel.n, SysModel.T])
-                for t in range(SysModel.T):
-                    y_hat[:,:,t] = torch.squeeze(SysModel.h(torch.unsqueeze(x_out_training_batch[:,:,t])))
-
-                if(MaskOnState):### FIXME: composition loss, y_hat may have different mask with x
-                    if self.args.randomLength:
-                        jj = 0
-                        for index in n_e:# mask out the padded part when computing loss
-                            MSE_train_linear_LOSS[jj] = self.alpha * self.loss_fn(x_out_training_batch[jj,mask,train_lengthMask[index]], train_target_batch[jj,mask,train_lengthMask[index]])+(1-self.alpha)*self.loss_fn(y_hat[jj,mask,train_lengthMask[index]], y_training_batch[jj,mask,train_lengthMask[index]])
-                            jj += 1
-                        MSE_trainbatch_linear_LOSS = torch.mean(MSE_train_linear_LOSS)
-                    else:                     
-                        MSE_trainbatch_linear_LOSS = self.alpha * self.loss_fn(x_out_training_batch[:,mask,:], train_target_batch[:,mask,:])+(1-self.alpha)*self.loss_fn(y_hat[:,mask,:], y_training_batch[:,mask,:])
-                else:# no mask on state
-                    if self.args.randomLength:
-                        jj = 0
-                        for index in n_e:# mask out the padded part when computing loss
-                            MSE_train_linear_LOSS[jj] = self.alpha * self.loss_fn(x_out_training_batch[jj,:,train_lengthMask[index]], train_target_batch[jj,:,train_lengthMask[index]])+(1-self.alpha)*self.loss_fn(y_hat[jj,:,train_lengthMask[index]], y_training_batch[jj,:,train_lengthMask[index]])
-                            jj += 1
-                        MSE_trainbatch_linear_LOSS = torch.mean(MSE_train_linear_LOSS)
-                    else:                
-                        MSE_trainbatch_linear_LOSS = self.alpha * self.loss_fn(x_out_training_batch, train_target_batch)+(1-self.alpha)*self.loss_fn(y_hat, y_training_batch)
+                # Compute Training Loss
+                MSE_trainbatch_linear_LOSS = 0
+                if (self.args.CompositionLoss):
+                    y_hat = torch.zeros([self.N_B, SysModel.n, SysModel.T])
+                    for t in range(SysModel.T):
+                        y_hat[:,:,t] = torch.squeeze(SysModel.h(torch.unsqueeze(x_out_training_batch[:,:,t])))
+
+                    ### FIXME: composition loss, y_hat may have different mask with x
+                    # mask out the padded part when computing loss
+                    MSE_trainbatch_linear_LOSS = (self.alpha * masked_mse(x_out_training_batch, train_target_batch, train_lengthMask_batch, mask) \
+                        + (1-self.alpha) * masked_mse(y_hat, y_training_batch, train_lengthMask_batch, mask)).mean()
             
-            else:# no composition loss
-                if(MaskOnState):
-                    if self.args.randomLength:
-                        jj = 0
-                        for index in n_e:# mask out the padded part when computing loss
-                            MSE_train_linear_LOSS[jj] = self.loss_fn(x_out_training_batch[jj,mask,train_lengthMask[index]], train_target_batch[jj,mask,train_lengthMask[index]])
-                            jj += 1
-                        MSE_trainbatch_linear_LOSS = torch.mean(MSE_train_linear_LOSS)
-                    else:
-                        MSE_trainbatch_linear_LOSS = self.loss_fn(x_out_training_batch[:,mask,:], train_target_batch[:,mask,:])
-                else: # no mask on state
-                    if self.args.randomLength:
-                        jj = 0
-                        for index in n_e:# mask out the padded part when computing loss
-                            MSE_train_linear_LOSS[jj] = self.loss_fn(x_out_training_batch[jj,:,train_lengthMask[index]], train_target_batch[jj,:,train_lengthMask[index]])
-                            jj += 1
-                        MSE_trainbatch_linear_LOSS = torch.mean(MSE_train_linear_LOSS)
-                    else: 
-                        MSE_trainbatch_linear_LOSS = self.loss_fn(x_out_training_batch, train_target_batch)
-
-            # dB Loss
-            self.MSE_train_linear_epoch[ti] = MSE_trainbatch_linear_LOSS.item()
-            self.MSE_train_dB_epoch[ti] = 10 * torch.log10(self.MSE_train_linear_epoch[ti])
-
-            ##################
-            ### Optimizing ###
-            ##################
-
-            # Before the backward pass, use the optimizer object to zero all of the
-            # gradients for the variables it will update (which are the learnable
-            # weights of the model). This is because by default, gradients are
-            # accumulated in buffers( i.e, not overwritten) whenever .backward()
-            # is called. Checkout docs of torch.autograd.backward for more details.
-
-            # Backward pass: compute gradient of the loss with respect to model
-            # parameters
-            MSE_trainbatch_linear_LOSS.backward(retain_graph=True)
-
-            # Calling the step function on an Optimizer makes an update to its
-            # parameters
-            self.optimizer.step()
-            # self.scheduler.step(self.MSE_cv_dB_epoch[ti])
+                else:# no composition loss
+                    # mask out the padded part when computing loss
+                    MSE_trainbatch_linear_LOSS = masked_mse(x_out_training_batch, train_target_batch, train_lengthMask_batch, mask).mean()
+
+                # dB Loss
+                self.MSE_train_linear_epoch[ti] = MSE_trainbatch_linear_LOSS.item()
+                self.MSE_train_dB_epoch[ti] = 10 * torch.log10(self.MSE_train_linear_epoch[ti])
+
+                ##################
+                ### Optimizing ###
+                ##################
+
+                # Before the backward pass, use the optimizer object to zero all of the
+                # gradients for the variables it will update (which are the learnable
+                # weights of the model). This is because by default, gradients are
+                # accumulated in buffers( i.e, not overwritten) whenever .backward()
+                # is called. Checkout docs of torch.autograd.backward for more details.
+
+                # Backward pass: compute gradient of the loss with respect to model
+                # parameters; the graph is not used again, so it is freed
+                MSE_trainbatch_linear_LOSS.backward()
+
+                # Calling the step function on an Optimizer makes an update to its
+                # parameters
+                self.optimizer.step()
+                # self.scheduler.step(self.MSE_cv_dB_epoch[ti])
 
             #################################
             ### Validation Sequence Batch ###
@@ -199,44 +154,22 @@ class Pipeline_EKF:
             # Cross Validation Mode
             self.model.eval()
             self.model.batch_size = self.N_CV
-            # Init Hidden State
-            self.model.init_hidden()
             with torch.no_grad():
 
                 SysModel.T_test = cv_input.size()[-1] # T_test is the maximum length of the CV sequences
-
-                x_out_cv_batch = torch.empty([self.N_CV, SysModel.m, SysModel.T_test]).to(self.device)
                 
                 # Init Sequence
-                if(randomInit):
-                    if(cv_init==None):
-                        self.model.InitSequence(\
-                        SysModel.m1x_0.reshape(1,SysModel.m,1).repeat(self.N_CV,1,1), SysModel.T_test)
-                    else:
-                        self.model.InitSequence(cv_init, SysModel.T_test)                       
+                if(randomInit and cv_init is not None):
+                    cv_init_batch = cv_init
                 else:
-                    self.model.InitSequence(\
-                        SysModel.m1x_0.reshape(1,SysModel.m,1).repeat(self.N_CV,1,1), SysModel.T_test)
+                    cv_init_batch = SysModel.m1x_0.reshape(1,SysModel.m,1).repeat(self.N_CV,1,1)
 
-                for t in range(0, SysModel.T_test):
-                    x_out_cv_batch[:, :, t] = torch.squeeze(self.model(torch.unsqueeze(cv_input[:, :, t],2)))
+                x_out_cv_batch = self.model.filter_sequence(cv_input, cv_init_batch, \
+                    lengths=seq_lengths(cv_lengthMask) if self.args.randomLength else None)
                 
                 # Compute CV Loss
-                MSE_cvbatch_linear_LOSS = 0
-                if(MaskOnState):
-                    if self.args.randomLength:
-                        for index in range(self.N_CV):
-                            MSE_cv_linear_LOSS[index] = self.loss_fn(x_out_cv_batch[index,mask,cv_lengthMask[index]], cv_target[index,mask,cv_lengthMask[index]])
-                        MSE_cvbatch_linear_LOSS = torch.mean(MSE_cv_linear_LOSS)
-                    else:          
-                        MSE_cvbatch_linear_LOSS = self.loss_fn(x_out_cv_batch[:,mask,:], cv_target[:,mask,:])
-                else:
-                    if self.args.randomLength:
-                        for index in range(self.N_CV):
-                            MSE_cv_linear_LOSS[index] = self.loss_fn(x_out_cv_batch[index,:,cv_lengthMask[index]], cv_target[index,:,cv_lengthMask[index]])
-                        MSE_cvbatch_linear_LOSS = torch.mean(MSE_cv_linear_LOSS)
-                    else:
-                        MSE_cvbatch_linear_LOSS = self.loss_fn(x_out_cv_batch, cv_target)
+                MSE_cvbatch_linear_LOSS = masked_mse(x_out_cv_batch, cv_target, \
+                    cv_lengthMask if self.args.randomLength else None, mask).mean()
 
                 # dB Loss
                 self.MSE_cv_linear_epoch[ti] = MSE_cvbatch_linear_LOSS.item()
@@ -261,6 +194,7 @@ class Pipeline_EKF:
 
             print("Optimal idx:", self.MSE_cv_idx_opt, "Optimal :", self.MSE_cv_dB_opt, "[dB]")
 
+        batches.close()
         return [self.MSE_cv_linear_epoch, self.MSE_cv_dB_epoch, self.MSE_train_linear_epoch, self.MSE_train_dB_epoch]
 
     def NNTest(self, SysModel, test_input, test_target, path_results, MaskOnState=False,\
@@ -277,49 +211,33 @@ class Pipeline_EKF:
 
         self.N_T = test_input.shape[0]
         SysModel.T_test = test_input.size()[-1]
-        self.MSE_test_linear_arr = torch.zeros([self.N_T])
-        x_out_test = torch.zeros([self.N_T, SysModel.m,SysModel.T_test]).to(self.device)
-
+        mask = None
         if MaskOnState:
             mask = torch.tensor([True,False,False])
             if SysModel.m == 2: 
                 mask = torch.tensor([True,False])
 
-        # MSE LOSS Function
-        loss_fn = nn.MSELoss(reduction='mean')
-
         # Test mode
         self.model.eval()
         self.model.batch_size = self.N_T
-        # Init Hidden State
-        self.model.init_hidden()
-        torch.no_grad()
 
         start = time.time()
 
         if (randomInit):
-            self.model.InitSequence(test_init, SysModel.T_test)               
+            test_init_batch = test_init
         else:
-            self.model.InitSequence(SysModel.m1x_0.reshape(1,SysModel.m,1).repeat(self.N_T,1,1), SysModel.T_test)         
+            test_init_batch = SysModel.m1x_0.reshape(1,SysModel.m,1).repeat(self.N_T,1,1)
         
-        for t in range(0, SysModel.T_test):
-            x_out_test[:,:, t] = torch.squeeze(self.model(torch.unsqueeze(test_input[:,:, t],2)))
+        with torch.no_grad():
+            x_out_test = self.model.filter_sequence(test_input, test_init_batch, \
+                lengths=seq_lengths(test_lengthMask) if self.args.randomLength else None)
         
         end = time.time()
         t = end - start
 
-        # MSE loss
-        for j in range(self.N_T):# cannot use batch due to different length and std computation  
-            if(MaskOnState):
-                if self.args.randomLength:
-                    self.MSE_test_linear_arr[j] = loss_fn(x_out_test[j,mask,test_lengthMask[j]], test_target[j,mask,test_lengthMask[j]]).item()
-                else:
-                    self.MSE_test_linear_arr[j] = loss_fn(x_out_test[j,mask,:], test_target[j,mask,:]).item()
-            else:
-                if self.args.randomLength:
-                    self.MSE_test_linear_arr[j] = loss_fn(x_out_test[j,:,test_lengthMask[j]], test_target[j,:,test_lengthMask[j]]).item()
-                else:
-                    self.MSE_test_linear_arr[j] = loss_fn(x_out_test[j,:,:], test_target[j,:,:]).item()
+        # MSE loss of each sequence
+        self.MSE_test_linear_arr = masked_mse(x_out_test, test_target, \
+            test_lengthMask if self.args.randomLength else None, mask).cpu()
         
         # Average
         self.MSE_test_linear_avg = torch.mean(self.MSE_test_linear_arr)
@@ -9,11 +9,15 @@ functions:
 * NNTest_alldatasets: test the hyper-KalmanNet model on multiple datasets
 """
 
+import os
 import torch
 import torch.nn as nn
-import random
 import time
 import math
+from pipelines.utils import masked_mse, seq_lengths, truncated_bptt
+from pipelines.prefetch import TrainingBatches, BatchPrefetcher
+from hnets.hnet import WeightCache
+from pipelines.checkpoint import CheckpointWriter, load_checkpoint_into, checkpoint_state, write_checkpoint
 
 class Pipeline_hknet:
 
@@ -23,10 +27,85 @@ class Pipeline_hknet:
         self.folderName = folderName + '/'
         self.modelName = modelName
         self.modelFileName = self.folderName + "model_" + self.modelName + ".pt"
-        self.PipelineName = self.folderName + "pipeline_" + self.modelName + ".pt"  
+        self.PipelineName = self.folderName + "pipeline_" + self.modelName + ".ckpt"  
 
     def save(self):
-        torch.save(self, self.PipelineName)
+        """
+        the models as a checkpoint (see pipelines.checkpoint), with the training and test results
+        as tensors under 'results'. Pickling the pipeline would also pickle the system model 
+        behind mnet.f and mnet.h, with its datasets.
+        """
+        state = checkpoint_state(self.hnet, self.mnet, getattr(self, 'args', None))
+        state['results'] = {name: torch.as_tensor(value).detach().cpu() for name, value in vars(self).items() \
+            if name.startswith('MSE_') or name == 'test_std_dB'}
+        write_checkpoint(state, self.PipelineName)
+
+    def shared_dynamics(self, sys_models):
+        # True if all system models share f and h, so their datasets can be filtered in one batch
+        ref = sys_models[0]
+        for sys_model in sys_models[1:]:
+            if hasattr(ref, 'F'): # linear models: f and h are built from F and H
+                if not (torch.equal(sys_model.F, ref.F) and torch.equal(sys_model.H, ref.H)):
+                    return False
+            elif sys_model.f is not ref.f or sys_model.h is not ref.h:
+                return False
+        return True
+
+    def filter_alldatasets(self, SoW_range, sys_model, input_tuple, init, lengthMask=None):
+        """
+        filter the datasets of all SoWs in SoW_range in one recursion, 
+        with one generated weight set per SoW
+
+        input SoW_range (list): indices of the datasets, all of the same size and with shared dynamics
+        input lengthMask (list): length mask [size of dataset i, T] of each dataset i, None for full-length sequences
+        output (torch.tensor): 1st posterior moments [total size of all datasets, m, T], 
+            datasets concatenated in the order of SoW_range
+        """
+        self.mnet.UpdateSystemDynamics(sys_model[SoW_range[0]])
+        self.mnet.batch_size = sum(input_tuple[i][0].shape[0] for i in SoW_range)
+        weights = self.hnet_weights(torch.stack([input_tuple[i][1] for i in SoW_range]))
+        lengths = None
+        if lengthMask is not None:
+            lengths = torch.cat([seq_lengths(lengthMask[i]) for i in SoW_range])
+        return self.mnet.filter_sequence(torch.cat([input_tuple[i][0] for i in SoW_range]), \
+            torch.cat([init[i] for i in SoW_range]), weights=weights, lengths=lengths)
+
+    def hnet_weights(self, SoW):
+        """
+        KNet weights generated for SoW [hnet_input_size] or [num_SoW, hnet_input_size],
+        from the weight cache in eval mode
+        """
+        if self.hnet.training or getattr(self, 'weight_cache', None) is None:
+            self.hnet.init_hidden()
+            return self.hnet(SoW)
+        self.weight_cache.hnet = self.hnet # the model may have been reloaded, the cache then sees new parameters
+        return self.weight_cache(SoW)
+
+    def tbptt_prepare(self, SoW, sys_model=None):
+        # prepare callable of a run of truncated_bptt: set the dynamics of sys_model and generate the weights of SoW
+        def prepare():
+            if sys_model is not None:
+                self.mnet.UpdateSystemDynamics(sys_model)
+            self.hnet.init_hidden()
+            return self.hnet(SoW)
+        return prepare
+
+    def load_best_model(self, path_results, load_model_path=None):
+        """
+        input load_model_path (str or list): checkpoint file (see pipelines.checkpoint), or
+            [hnet file, mnet file] of pickled models; the best checkpoint in path_results if None
+        """
+        if getattr(self, 'checkpoint_writer', None) is not None:
+            self.checkpoint_writer.wait() # the best model may still be being written
+        if load_model_path is None:
+            load_model_path = path_results + 'hknet_best-model.ckpt'
+            if not os.path.exists(load_model_path): # results of earlier versions
+                load_model_path = [path_results + 'hnet_best-model.pt', path_results + 'mnet_best-model.pt']
+        if isinstance(load_model_path, str):
+            load_checkpoint_into(load_model_path, self.hnet, self.mnet)
+        else:
+            self.hnet = torch.load(load_model_path[0], map_location=self.device, weights_only=False)
+            self.mnet = torch.load(load_model_path[1], map_location=self.device, weights_only=False)
 
     def print_grad(self, grad):
         print('Gradient:', grad)
@@ -46,6 +125,11 @@ class Pipeline_hknet:
         self.learningRate = args.lr # Learning Rate
         self.weightDecay = args.wd # L2 Weight Regularization - Weight Decay
         self.alpha = args.alpha # Composition loss factor
+        self.checkpoint_writer = CheckpointWriter() # saves the best model without stalling training
+        if args.hnet_cache_MB > 0:
+            self.weight_cache = WeightCache(self.hnet, max_bytes=int(args.hnet_cache_MB * 2**20))
+        else:
+            self.weight_cache = None
         # MSE LOSS Function
         self.loss_fn = nn.MSELoss(reduction='mean')
 
@@ -77,6 +161,24 @@ class Pipeline_hknet:
         sysmdl_m = train_target_tuple[0][0].shape[1] # state x dimension
         sysmdl_n = train_input_tuple[0][0].shape[1] # input y dimension
         sysmdl_T = train_input_tuple[0][0].shape[2] # sequence length 
+        # SoW: make sure SoWs are consistent
+        for i in SoW_train_range:
+            assert torch.allclose(cv_input_tuple[i][1], cv_target_tuple[i][1]) 
+            assert torch.allclose(train_input_tuple[i][1], train_target_tuple[i][1]) 
+        # mask on state
+        mask = None
+        if MaskOnState:
+            mask = torch.tensor([True,False,False])
+            if sysmdl_m == 2: 
+                mask = torch.tensor([True,False])
+        # train and validate all datasets in one recursion if they share the dynamics,
+        # otherwise filter them one by one and optimize the summed loss
+        train_batched = self.shared_dynamics([sys_model[i] for i in SoW_train_range])
+        cv_batched = train_batched and len(set(cv_input_tuple[i][0].shape[0] for i in SoW_train_range)) == 1
+        # training batches of all datasets, prepared ahead if args.prefetch_batches > 0
+        batches = BatchPrefetcher(TrainingBatches(self.N_B, [(train_input_tuple[i][0], train_target_tuple[i][0], train_init[i], \
+            train_lengthMask[i] if self.args.randomLength else None) for i in SoW_train_range], bucket_pool=self.args.bucket_pool), \
+            self.device, depth=self.args.prefetch_batches)
         
         for ti in range(0, self.N_steps):
             # each turn, go through all datasets
@@ -86,103 +188,75 @@ class Pipeline_hknet:
             # Training Mode
             self.hnet.train()
             self.mnet.train()
-            self.mnet.batch_size = self.N_B       
-            MSE_trainbatch_linear_LOSS_total = 0 # total train loss for all datasets
+            self.optimizer.zero_grad()
+            y_training_batch, train_target_batch, train_init_batch, train_lengthMask_batch = [], [], [], []
            
-            for i in SoW_train_range: # dataset i 
-                self.optimizer.zero_grad()  
-                 # Init Training Batch tensors
-                y_training_batch = torch.zeros([self.N_B, sysmdl_n, sysmdl_T]).to(self.device)
-                train_target_batch = torch.zeros([self.N_B, sysmdl_m, sysmdl_T]).to(self.device)
-                x_out_training_batch = torch.zeros([self.N_B, sysmdl_m, sysmdl_T]).to(self.device)
-                if self.args.randomLength:
-                    MSE_train_linear_LOSS = torch.zeros([self.N_B])
-                # Init Sequence
-                train_init_batch = torch.empty([self.N_B, sysmdl_m,1]).to(self.device)
-                # Init Hidden State
-                self.hnet.init_hidden()
-                self.mnet.init_hidden()  
-                # SoW: make sure SoWs are consistent
-                assert torch.allclose(cv_input_tuple[i][1], cv_target_tuple[i][1]) 
-                assert torch.allclose(train_input_tuple[i][1], train_target_tuple[i][1]) 
-                self.mnet.UpdateSystemDynamics(sys_model[i])
-                # req grad
-                train_input_tuple[i][1].requires_grad = True # SoW_train
-                train_input_tuple[i][0].requires_grad = True # input y
-                train_target_tuple[i][0].requires_grad = True # target x
-                train_init[i].requires_grad = True # init x0
-                # data size
-                self.N_E = len(train_input_tuple[i][0]) # Number of Training Sequences
-                # mask on state
-                if MaskOnState:
-                    mask = torch.tensor([True,False,False])
-                    if sysmdl_m == 2: 
-                        mask = torch.tensor([True,False])
-                # Randomly select N_B training sequences
-                assert self.N_B <= self.N_E # N_B must be smaller than N_E
-                n_e = random.sample(range(self.N_E), k=self.N_B)
-                dataset_index = 0
-                for index in n_e:
-                    # Training Batch
-                    if self.args.randomLength:
-                        y_training_batch[dataset_index,:,train_lengthMask[i][index,:]] = train_input_tuple[i][0][index,:,train_lengthMask[index,:]]
-                        train_target_batch[dataset_index,:,train_lengthMask[i][index,:]] = train_target_tuple[i][0][index,:,train_lengthMask[index,:]]
-                    else:
-                        y_training_batch[dataset_index,:,:] = train_input_tuple[i][0][index]
-                        train_target_batch[dataset_index,:,:] = train_target_tuple[i][0][index]                                 
-                    # Init Sequence
-                    train_init_batch[dataset_index,:,0] = torch.squeeze(train_init[i][index])                  
-                    dataset_index += 1
-                self.mnet.InitSequence(train_init_batch, sysmdl_T)
-                
+            for batch in next(batches): # N_B random training sequences of each dataset
+                y_training_batch.append(batch[0])
+                train_target_batch.append(batch[1])
+                train_init_batch.append(batch[2])
+                train_lengthMask_batch.append(batch[3])
+
+            if self.args.tbptt_window > 0:
+                # truncated BPTT, one optimizer step per window
+                if train_batched:
+                    self.mnet.UpdateSystemDynamics(sys_model[SoW_train_range[0]])
+                    self.mnet.batch_size = self.N_B * len(SoW_train_range)
+                    runs = [(self.tbptt_prepare(torch.stack([train_input_tuple[i][1] for i in SoW_train_range])), \
+                        torch.cat(y_training_batch), torch.cat(train_init_batch), torch.cat(train_target_batch), \
+                        torch.cat(train_lengthMask_batch) if self.args.randomLength else None)]
+                else:
+                    self.mnet.batch_size = self.N_B
+                    runs = [(self.tbptt_prepare(train_input_tuple[i][1], sys_model[i]), y_training_batch[k], train_init_batch[k], \
+                        train_target_batch[k], train_lengthMask_batch[k]) for k, i in enumerate(SoW_train_range)]
+                MSE_trainbatch_linear_LOSS_average = truncated_bptt(self.mnet, self.optimizer, self.args.tbptt_window, runs, mask)
+            else:
                 # Forward Computation
-                weights = self.hnet(train_input_tuple[i][1])
-                for t in range(0, sysmdl_T):
-                    x_out_training_batch[:, :, t] = torch.squeeze(self.mnet(torch.unsqueeze(y_training_batch[:, :, t],2), weights=weights))
+                self.hnet.init_hidden()
+                if train_batched:
+                    # one weight set per dataset, all datasets in one recursion
+                    self.mnet.UpdateSystemDynamics(sys_model[SoW_train_range[0]])
+                    self.mnet.batch_size = self.N_B * len(SoW_train_range)
+                    weights = self.hnet(torch.stack([train_input_tuple[i][1] for i in SoW_train_range]))
+                    lengths = torch.cat([seq_lengths(mask_k) for mask_k in train_lengthMask_batch]) if self.args.randomLength else None
+                    x_out_training_batch = self.mnet.filter_sequence(torch.cat(y_training_batch), torch.cat(train_init_batch), weights=weights, lengths=lengths, \
+                        checkpoint_every=self.args.checkpoint_every)
+                    x_out_training_batch = torch.split(x_out_training_batch, self.N_B)
+                else:
+                    x_out_training_batch = []
+                    self.mnet.batch_size = self.N_B
+                    for k, i in enumerate(SoW_train_range):
+                        self.hnet.init_hidden()
+                        self.mnet.UpdateSystemDynamics(sys_model[i])
+                        weights = self.hnet(train_input_tuple[i][1])
+                        x_out_training_batch.append(self.mnet.filter_sequence(y_training_batch[k], train_init_batch[k], weights=weights, \
+                            lengths=seq_lengths(train_lengthMask_batch[k]), checkpoint_every=self.args.checkpoint_every))
                 
                 ### weights.register_hook(self.print_grad)
 
                 # Compute Training Loss
-                MSE_trainbatch_linear_LOSS = 0 # loss for each dataset
-                if(MaskOnState):
-                    if self.args.randomLength:
-                        dataset_index = 0
-                        for index in n_e:# mask out the padded part when computing loss
-                            MSE_train_linear_LOSS[dataset_index] = self.loss_fn(x_out_training_batch[dataset_index,mask,train_lengthMask[i][index]], train_target_batch[dataset_index,mask,train_lengthMask[index]])
-                            dataset_index += 1
-                        MSE_trainbatch_linear_LOSS = torch.mean(MSE_train_linear_LOSS)
-                        MSE_trainbatch_linear_LOSS_total = MSE_trainbatch_linear_LOSS_total + MSE_trainbatch_linear_LOSS
-                    else:
-                        MSE_trainbatch_linear_LOSS = self.loss_fn(x_out_training_batch[:,mask,:], train_target_batch[:,mask,:])
-                        MSE_trainbatch_linear_LOSS_total = MSE_trainbatch_linear_LOSS_total + MSE_trainbatch_linear_LOSS
-                else: # no mask on state
-                    if self.args.randomLength:
-                        dataset_index = 0
-                        for index in n_e:# mask out the padded part when computing loss
-                            MSE_train_linear_LOSS[dataset_index] = self.loss_fn(x_out_training_batch[dataset_index,:,train_lengthMask[i][index]], train_target_batch[dataset_index,:,train_lengthMask[index]])
-                            dataset_index += 1
-                        MSE_trainbatch_linear_LOSS = torch.mean(MSE_train_linear_LOSS)
-                        MSE_trainbatch_linear_LOSS_total = MSE_trainbatch_linear_LOSS_total + MSE_trainbatch_linear_LOSS
-                    else: 
-                        MSE_trainbatch_linear_LOSS = self.loss_fn(x_out_training_batch, train_target_batch)
-                        MSE_trainbatch_linear_LOSS_total = MSE_trainbatch_linear_LOSS_total + MSE_trainbatch_linear_LOSS
+                MSE_trainbatch_linear_LOSS_total = 0 # total train loss for all datasets
+                for k, i in enumerate(SoW_train_range):
+                    # mask out the padded part when computing loss
+                    MSE_trainbatch_linear_LOSS = masked_mse(x_out_training_batch[k], train_target_batch[k], train_lengthMask_batch[k], mask).mean()
+                    MSE_trainbatch_linear_LOSS_total = MSE_trainbatch_linear_LOSS_total + MSE_trainbatch_linear_LOSS
                 
                 ##################
                 ### Optimizing ###
                 ##################
-                # FIXME: Can only optimize for each dataset one by one, since joint optimization cause in-place operation error
-                MSE_trainbatch_linear_LOSS.backward(retain_graph=True)
+                # one backward and one step on the loss averaged over all datasets
+                MSE_trainbatch_linear_LOSS_average = MSE_trainbatch_linear_LOSS_total / len(SoW_train_range)
+                MSE_trainbatch_linear_LOSS_average.backward()
                 self.optimizer.step()
 
             # averaged dB Loss
-            MSE_trainbatch_linear_LOSS_average = MSE_trainbatch_linear_LOSS_total / len(SoW_train_range)
             self.MSE_train_linear_epoch[ti] = MSE_trainbatch_linear_LOSS_average.item()
             self.MSE_train_dB_epoch[ti] = 10 * torch.log10(self.MSE_train_linear_epoch[ti])
 
             ##################
             ### Validation ###
             ##################
-            MSE_cvbatch_linear_LOSS = 0
+            MSE_cv_linear_LOSS = [] # loss for each dataset
             # Cross Validation Mode
             self.hnet.eval()
             self.mnet.eval()
@@ -190,49 +264,34 @@ class Pipeline_hknet:
             # data size
             self.N_CV = len(cv_input_tuple[i][0])
             sysmdl_T_test = cv_input_tuple[i][0].shape[2] 
-            if self.args.randomLength:
-                MSE_cv_linear_LOSS = torch.zeros([self.N_CV*len(SoW_train_range)])
             # Init Output
             x_out_cv_batch = torch.empty([self.N_CV*len(SoW_train_range), sysmdl_m, sysmdl_T_test]).to(self.device)                   
             # Update Batch Size for mnet
             self.mnet.batch_size = self.N_CV 
 
             with torch.no_grad():
-                for i in SoW_train_range: # dataset i 
-                    # Init Hidden State
-                    self.hnet.init_hidden()
-                    self.mnet.init_hidden()
-                    # Init Sequence                    
-                    self.mnet.InitSequence(cv_init[i], sysmdl_T_test)                       
-                    
-                    weights = self.hnet(cv_input_tuple[i][1])
-                    for t in range(0, sysmdl_T_test):
-                        x_out_cv_batch[self.N_CV*i:self.N_CV*(i+1), :, t] = torch.squeeze(self.mnet(torch.unsqueeze(cv_input_tuple[i][0][:, :, t],2), weights=weights))
+                if cv_batched:
+                    x_out_cv_batch = self.filter_alldatasets(SoW_train_range, sys_model, cv_input_tuple, cv_init, \
+                        cv_lengthMask if self.args.randomLength else None)
+                for k, i in enumerate(SoW_train_range): # dataset i 
+                    if not cv_batched:
+                        self.mnet.UpdateSystemDynamics(sys_model[i])
+                        weights = self.hnet_weights(cv_input_tuple[i][1])
+                        x_out_cv_batch[self.N_CV*k:self.N_CV*(k+1)] = self.mnet.filter_sequence(cv_input_tuple[i][0], cv_init[i], weights=weights, \
+                            lengths=seq_lengths(cv_lengthMask[i]) if self.args.randomLength else None)
                     
                     # Compute CV Loss
-                    MSE_cvbatch_linear_LOSS_i = MSE_cvbatch_linear_LOSS
-                    if(MaskOnState):
-                        if self.args.randomLength:
-                            for index in range(self.N_CV):
-                                MSE_cv_linear_LOSS[index+self.N_CV*i] = self.loss_fn(x_out_cv_batch[index+self.N_CV*i,mask,cv_lengthMask[i][index]], cv_target_tuple[i][0][index,mask,cv_lengthMask[index]])
-                            MSE_cvbatch_linear_LOSS = MSE_cvbatch_linear_LOSS + torch.mean(MSE_cv_linear_LOSS[self.N_CV*i:self.N_CV*(i+1)])
-                        else:          
-                            MSE_cvbatch_linear_LOSS = MSE_cvbatch_linear_LOSS + self.loss_fn(x_out_cv_batch[self.N_CV*i:self.N_CV*(i+1),mask,:], cv_target_tuple[i][0][:,mask,:])
-                    else:
-                        if self.args.randomLength:
-                            for index in range(self.N_CV):
-                                MSE_cv_linear_LOSS[index+self.N_CV*i] = self.loss_fn(x_out_cv_batch[index+self.N_CV*i,:,cv_lengthMask[i][index]], cv_target_tuple[i][0][index,:,cv_lengthMask[index]])
-                            MSE_cvbatch_linear_LOSS = MSE_cvbatch_linear_LOSS + torch.mean(MSE_cv_linear_LOSS[self.N_CV*i:self.N_CV*(i+1)])
-                        else:
-                            MSE_cvbatch_linear_LOSS = MSE_cvbatch_linear_LOSS + self.loss_fn(x_out_cv_batch[self.N_CV*i:self.N_CV*(i+1)], cv_target_tuple[i][0])
-                    
-                    # Print loss for each dataset
-                    MSE_cvbatch_linear_LOSS_i = MSE_cvbatch_linear_LOSS - MSE_cvbatch_linear_LOSS_i
-                    MSE_cvbatch_dB_LOSS_i = 10 * math.log10(MSE_cvbatch_linear_LOSS_i.item())
+                    MSE_cv_linear_LOSS.append(masked_mse(x_out_cv_batch[self.N_CV*k:self.N_CV*(k+1)], cv_target_tuple[i][0], \
+                        cv_lengthMask[i] if self.args.randomLength else None, mask).mean())
+                
+                # Print loss for each dataset
+                MSE_cv_linear_LOSS = torch.stack(MSE_cv_linear_LOSS).cpu()
+                for k, i in enumerate(SoW_train_range):
+                    MSE_cvbatch_dB_LOSS_i = 10 * math.log10(MSE_cv_linear_LOSS[k].item())
                     print(f"MSE Validation on dataset {i}:", MSE_cvbatch_dB_LOSS_i,"[dB]")
                 
                 # averaged dB Loss
-                MSE_cvbatch_linear_LOSS = MSE_cvbatch_linear_LOSS / len(SoW_train_range)
+                MSE_cvbatch_linear_LOSS = torch.mean(MSE_cv_linear_LOSS)
                 self.MSE_cv_linear_epoch[ti] = MSE_cvbatch_linear_LOSS.item()
                 self.MSE_cv_dB_epoch[ti] = 10 * torch.log10(self.MSE_cv_linear_epoch[ti])
                 # save model with best averaged loss on all datasets
@@ -240,8 +299,8 @@ class Pipeline_hknet:
                     self.MSE_cv_dB_opt = self.MSE_cv_dB_epoch[ti]
                     self.MSE_cv_idx_opt = ti
                     
-                    torch.save(self.hnet, path_results + 'hnet_best-model.pt')
-                    torch.save(self.mnet, path_results + 'mnet_best-model.pt')
+                    self.checkpoint_writer.save(path_results + 'hknet_best-model.ckpt', self.hnet, self.mnet, \
+                        self.args, SoW_train_range)
 
             ########################
             ### Training Summary ###
@@ -262,6 +321,8 @@ class Pipeline_hknet:
                     "train_loss": self.MSE_train_dB_epoch[ti],
                     "val_loss": self.MSE_cv_dB_epoch[ti]})
             ###
+        batches.close()
+        self.checkpoint_writer.wait()
         return [self.MSE_cv_linear_epoch, self.MSE_cv_dB_epoch, self.MSE_train_linear_epoch, self.MSE_train_dB_epoch]
 
     def NNTest_alldatasets(self, SoW_test_range, sys_model, test_input_tuple, test_target_tuple, path_results,test_init,\
@@ -269,12 +330,7 @@ class Pipeline_hknet:
         if self.args.wandb_switch: 
             import wandb
         # Load model
-        if load_model:
-            self.hnet = torch.load(load_model_path[0], map_location=self.device)
-            self.mnet = torch.load(load_model_path[1], map_location=self.device) 
-        else:
-            self.hnet = torch.load(path_results+'hnet_best-model.pt', map_location=self.device)
-            self.mnet = torch.load(path_results+'mnet_best-model.pt', map_location=self.device) 
+        self.load_best_model(path_results, load_model_path if load_model else None)
         
         # dataset size    
         for i in SoW_test_range[:-1]:# except the last one
@@ -289,59 +345,54 @@ class Pipeline_hknet:
         self.MSE_test_linear_arr = torch.zeros([total_size])
         x_out_test = torch.zeros([total_size, sysmdl_m,sysmdl_T_test]).to(self.device)
         current_idx = 0
+        # filter all datasets in one recursion if they share the dynamics and size
+        test_batched = self.shared_dynamics([sys_model[i] for i in SoW_test_range]) and \
+            len(set(test_input_tuple[i][0].shape[0] for i in SoW_test_range)) == 1
+        if test_batched:
+            self.hnet.eval()
+            self.mnet.eval()
+            start = time.time()
+            with torch.no_grad():
+                x_out_test = self.filter_alldatasets(SoW_test_range, sys_model, test_input_tuple, test_init, \
+                    test_lengthMask if self.args.randomLength else None)
+            t = time.time() - start
+            print("Inference Time (all datasets):", t)
 
         for i in SoW_test_range: # dataset i   
             # SoW
             assert torch.allclose(test_input_tuple[i][1], test_target_tuple[i][1]) 
             SoW_test = test_input_tuple[i][1]
-            self.mnet.UpdateSystemDynamics(sys_model[i])
             # load data
             test_input = test_input_tuple[i][0]
             test_target = test_target_tuple[i][0]
             # test data size
             self.N_T = test_input.shape[0]  
+            mask = None
             if MaskOnState:
                 mask = torch.tensor([True,False,False])
                 if sysmdl_m == 2: 
                     mask = torch.tensor([True,False])
 
-            # MSE LOSS Function
-            loss_fn = nn.MSELoss(reduction='mean')
-
-            # Test mode
-            self.hnet.eval()
-            self.mnet.eval()
-            self.mnet.batch_size = self.N_T
-            # Init Hidden State
-            self.hnet.init_hidden()
-            self.mnet.init_hidden()
+            if not test_batched:
+                # Test mode
+                self.hnet.eval()
+                self.mnet.eval()
+                self.mnet.UpdateSystemDynamics(sys_model[i])
+                self.mnet.batch_size = self.N_T
 
-            torch.no_grad()
+                start = time.time()
 
-            start = time.time()
+                with torch.no_grad():
+                    weights = self.hnet_weights(SoW_test)
+                    x_out_test[current_idx:current_idx+self.N_T] = self.mnet.filter_sequence(test_input, test_init[i], weights=weights, \
+                        lengths=seq_lengths(test_lengthMask[i]) if self.args.randomLength else None)
+                
+                end = time.time()
+                t = end - start
 
-            # Init Sequence
-            self.mnet.InitSequence(test_init[i], sysmdl_T_test)               
-            
-            weights = self.hnet(SoW_test)
-            for t in range(0, sysmdl_T_test):
-                x_out_test[current_idx:current_idx+self.N_T,:, t] = torch.squeeze(self.mnet(torch.unsqueeze(test_input[:,:, t],2), weights=weights))
-            
-            end = time.time()
-            t = end - start
-
-            # MSE loss
-            for j in range(self.N_T):# cannot use batch due to different length and std computation  
-                if(MaskOnState):
-                    if self.args.randomLength:
-                        self.MSE_test_linear_arr[current_idx+j] = loss_fn(x_out_test[current_idx+j,mask,test_lengthMask[j]], test_target[j,mask,test_lengthMask[j]]).item()
-                    else:
-                        self.MSE_test_linear_arr[current_idx+j] = loss_fn(x_out_test[current_idx+j,mask,:], test_target[j,mask,:]).item()
-                else:
-                    if self.args.randomLength:
-                        self.MSE_test_linear_arr[current_idx+j] = loss_fn(x_out_test[current_idx+j,:,test_lengthMask[j]], test_target[j,:,test_lengthMask[j]]).item()
-                    else:
-                        self.MSE_test_linear_arr[current_idx+j] = loss_fn(x_out_test[current_idx+j,:,:], test_target[j,:,:]).item()
+            # MSE loss of each sequence
+            self.MSE_test_linear_arr[current_idx:current_idx+self.N_T] = masked_mse(x_out_test[current_idx:current_idx+self.N_T], test_target, \
+                test_lengthMask[i] if self.args.randomLength else None, mask).cpu()
             
             # Average for dataset i
             MSE_test_linear_avg_dataset_i = torch.mean(self.MSE_test_linear_arr[current_idx:current_idx+self.N_T])
@@ -359,7 +410,8 @@ class Pipeline_hknet:
             str = self.modelName + "-"  + f"dataset {i}" + "-" + "STD Test:"
             print(str, test_std_dB_dataset_i, "[dB]")
             # Print Run Time
-            print("Inference Time:", t)
+            if not test_batched:
+                print("Inference Time:", t)
 
             ### Optinal: record loss on wandb
             if self.args.wandb_switch:
@@ -388,6 +440,43 @@ class Pipeline_hknet:
 
         return [self.MSE_test_linear_arr, self.MSE_test_linear_avg, self.MSE_test_dB_avg, x_out_test]
 
+    def autocast_guard(self, SoW_range, sys_model, input_tuple, target_tuple, init, lengthMask=None, MaskOnState=False):
+        """
+        accuracy guard of the bfloat16 mode (args.autocast_bf16): filter the datasets with and without
+        autocast and compare the MSE [dB] of each. If a deviation exceeds args.autocast_tol_dB,
+        autocast is switched off for the models.
+
+        input SoW_range (list): indices of the datasets, e.g. the test datasets
+        input lengthMask (list): length mask of each dataset, None for full-length sequences
+        output (tuple): MSE [dB] of each dataset in bfloat16 and in float32 [len(SoW_range)], 
+            and whether bfloat16 is kept
+        """
+        mask = None
+        if MaskOnState:
+            mask = torch.tensor([True,False,False])
+            if sys_model[SoW_range[0]].m == 2: 
+                mask = torch.tensor([True,False])
+        self.hnet.eval()
+        self.mnet.eval()
+        MSE_dB = {}
+        for bf16 in (True, False):
+            self.hnet.autocast_bf16 = self.mnet.autocast_bf16 = bf16
+            MSE_dB[bf16] = torch.empty(len(SoW_range))
+            with torch.no_grad():
+                for k, i in enumerate(SoW_range):
+                    x_out = self.filter_alldatasets([i], sys_model, input_tuple, init, lengthMask)
+                    MSE_linear = masked_mse(x_out, target_tuple[i][0], None if lengthMask is None else lengthMask[i], mask).mean()
+                    MSE_dB[bf16][k] = 10 * torch.log10(MSE_linear)
+        deviation = (MSE_dB[True] - MSE_dB[False]).abs().max().item()
+        keep = deviation <= self.args.autocast_tol_dB
+        self.hnet.autocast_bf16 = self.mnet.autocast_bf16 = keep
+        print("bfloat16 MSE:", MSE_dB[True], "[dB]", "float32 MSE:", MSE_dB[False], "[dB]")
+        if keep:
+            print("bfloat16 deviation", deviation, "[dB] within", self.args.autocast_tol_dB, "[dB], bfloat16 is kept")
+        else:
+            print("bfloat16 deviation", deviation, "[dB] exceeds", self.args.autocast_tol_dB, "[dB], switched back to float32")
+        return MSE_dB[True], MSE_dB[False], keep
+
     def NNTrain(self, sys_model, cv_input_tuple, cv_target_tuple, train_input_tuple, train_target_tuple, path_results, \
             cv_init, train_init, MaskOnState=False, train_lengthMask=None,cv_lengthMask=None):
             # SoW 
@@ -418,6 +507,7 @@ class Pipeline_hknet:
             self.MSE_train_linear_epoch = torch.zeros([self.N_steps])
             self.MSE_train_dB_epoch = torch.zeros([self.N_steps])
             
+            mask = None
             if MaskOnState:
                 mask = torch.tensor([True,False,False])
                 if sysmdl_m == 2: 
@@ -429,6 +519,9 @@ class Pipeline_hknet:
 
             self.MSE_cv_dB_opt = 1000
             self.MSE_cv_idx_opt = 0
+            batches = BatchPrefetcher(TrainingBatches(self.N_B, [(train_input, train_target, train_init, \
+                train_lengthMask if self.args.randomLength else None)], bucket_pool=self.args.bucket_pool), \
+                self.device, depth=self.args.prefetch_batches)
 
             for ti in range(0, self.N_steps):
 
@@ -442,85 +535,47 @@ class Pipeline_hknet:
                 self.mnet.batch_size = self.N_B
                 # Init Hidden State
                 self.hnet.init_hidden()
-                self.mnet.init_hidden()
-
-                # Init Training Batch tensors
-                y_training_batch = torch.zeros([self.N_B, sysmdl_n, sysmdl_T]).to(self.device)
-                train_target_batch = torch.zeros([self.N_B, sysmdl_m, sysmdl_T]).to(self.device)
-                x_out_training_batch = torch.zeros([self.N_B, sysmdl_m, sysmdl_T]).to(self.device)
-                if self.args.randomLength:
-                    MSE_train_linear_LOSS = torch.zeros([self.N_B])
-                    MSE_cv_linear_LOSS = torch.zeros([self.N_CV])
 
                 # Randomly select N_B training sequences
-                assert self.N_B <= self.N_E # N_B must be smaller than N_E
-                n_e = random.sample(range(self.N_E), k=self.N_B)
-                ii = 0
-                for index in n_e:
-                    if self.args.randomLength:
-                        y_training_batch[ii,:,train_lengthMask[index,:]] = train_input[index,:,train_lengthMask[index,:]]
-                        train_target_batch[ii,:,train_lengthMask[index,:]] = train_target[index,:,train_lengthMask[index,:]]
-                    else:
-                        y_training_batch[ii,:,:] = train_input[index]
-                        train_target_batch[ii,:,:] = train_target[index]
-                    ii += 1
-                
-                # Init Sequence
-                train_init_batch = torch.empty([self.N_B, sysmdl_m,1]).to(self.device)
-                ii = 0
-                for index in n_e:
-                    train_init_batch[ii,:,0] = torch.squeeze(train_init[index])
-                    ii += 1
-                self.mnet.InitSequence(train_init_batch, sysmdl_T)
-                
-                # Forward Computation
-                weights = self.hnet(SoW_train)
-                for t in range(0, sysmdl_T):
-                    x_out_training_batch[:, :, t] = torch.squeeze(self.mnet(torch.unsqueeze(y_training_batch[:, :, t],2), weights=weights))
-                
-                # Compute Training Loss
-                MSE_trainbatch_linear_LOSS = 0
-                if(MaskOnState):
-                    if self.args.randomLength:
-                        jj = 0
-                        for index in n_e:# mask out the padded part when computing loss
-                            MSE_train_linear_LOSS[jj] = self.loss_fn(x_out_training_batch[jj,mask,train_lengthMask[index]], train_target_batch[jj,mask,train_lengthMask[index]])
-                            jj += 1
-                        MSE_trainbatch_linear_LOSS = torch.mean(MSE_train_linear_LOSS)
-                    else:
-                        MSE_trainbatch_linear_LOSS = self.loss_fn(x_out_training_batch[:,mask,:], train_target_batch[:,mask,:])
-                else: # no mask on state
-                    if self.args.randomLength:
-                        jj = 0
-                        for index in n_e:# mask out the padded part when computing loss
-                            MSE_train_linear_LOSS[jj] = self.loss_fn(x_out_training_batch[jj,:,train_lengthMask[index]], train_target_batch[jj,:,train_lengthMask[index]])
-                            jj += 1
-                        MSE_trainbatch_linear_LOSS = torch.mean(MSE_train_linear_LOSS)
-                    else: 
-                        MSE_trainbatch_linear_LOSS = self.loss_fn(x_out_training_batch, train_target_batch)
-
-                # dB Loss
-                self.MSE_train_linear_epoch[ti] = MSE_trainbatch_linear_LOSS.item()
-                self.MSE_train_dB_epoch[ti] = 10 * torch.log10(self.MSE_train_linear_epoch[ti])
+                y_training_batch, train_target_batch, train_init_batch, train_lengthMask_batch = next(batches)[0]
+
+                if self.args.tbptt_window > 0:
+                    # truncated BPTT, one optimizer step per window
+                    MSE_trainbatch_linear_LOSS = truncated_bptt(self.mnet, self.optimizer, self.args.tbptt_window, \
+                        [(self.tbptt_prepare(SoW_train), y_training_batch, train_init_batch, train_target_batch, train_lengthMask_batch)], mask)
+                    self.MSE_train_linear_epoch[ti] = MSE_trainbatch_linear_LOSS.item()
+                    self.MSE_train_dB_epoch[ti] = 10 * torch.log10(self.MSE_train_linear_epoch[ti])
+                else:
+                    # Forward Computation
+                    weights = self.hnet(SoW_train)
+                    x_out_training_batch = self.mnet.filter_sequence(y_training_batch, train_init_batch, weights=weights, \
+                        lengths=seq_lengths(train_lengthMask_batch), checkpoint_every=self.args.checkpoint_every)
+                    
+                    # Compute Training Loss, mask out the padded part
+                    MSE_trainbatch_linear_LOSS = masked_mse(x_out_training_batch, train_target_batch, train_lengthMask_batch, mask).mean()
 
-                ##################
-                ### Optimizing ###
-                ##################
+                    # dB Loss
+                    self.MSE_train_linear_epoch[ti] = MSE_trainbatch_linear_LOSS.item()
+                    self.MSE_train_dB_epoch[ti] = 10 * torch.log10(self.MSE_train_linear_epoch[ti])
 
-                # Before the backward pass, use the optimizer object to zero all of the
-                # gradients for the variables it will update (which are the learnable
-                # weights of the model). This is because by default, gradients are
-                # accumulated in buffers( i.e, not overwritten) whenever .backward()
-                # is called. Checkout docs of torch.autograd.backward for more details.
+                    ##################
+                    ### Optimizing ###
+                    ##################
 
-                # Backward pass: compute gradient of the loss with respect to model
-                # parameters
-                MSE_trainbatch_linear_LOSS.backward(retain_graph=True)
+                    # Before the backward pass, use the optimizer object to zero all of the
+                    # gradients for the variables it will update (which are the learnable
+                    # weights of the model). This is because by default, gradients are
+                    # accumulated in buffers( i.e, not overwritten) whenever .backward()
+                    # is called. Checkout docs of torch.autograd.backward for more details.
 
-                # Calling the step function on an Optimizer makes an update to its
-                # parameters
-                self.optimizer.step()
-                # self.scheduler.step(self.MSE_cv_dB_epoch[ti])
+                    # Backward pass: compute gradient of the loss with respect to model
+                    # parameters; the graph is not used again, so it is freed
+                    MSE_trainbatch_linear_LOSS.backward()
+
+                    # Calling the step function on an Optimizer makes an update to its
+                    # parameters
+                    self.optimizer.step()
+                    # self.scheduler.step(self.MSE_cv_dB_epoch[ti])
 
                 #################################
                 ### Validation Sequence Batch ###
@@ -530,37 +585,15 @@ class Pipeline_hknet:
                 self.hnet.eval()
                 self.mnet.eval()
                 self.mnet.batch_size = self.N_CV
-                # Init Hidden State
-                self.hnet.init_hidden()
-                self.mnet.init_hidden()
 
                 with torch.no_grad():
-                    x_out_cv_batch = torch.empty([self.N_CV, sysmdl_m, sysmdl_T_test]).to(self.device)
-                    
-                    # Init Sequence                    
-                    self.mnet.InitSequence(cv_init, sysmdl_T_test)                       
-
-                    
-                    weights = self.hnet(SoW_cv)
-                    for t in range(0, sysmdl_T_test):
-                        x_out_cv_batch[:, :, t] = torch.squeeze(self.mnet(torch.unsqueeze(cv_input[:, :, t],2), weights=weights))
+                    weights = self.hnet_weights(SoW_cv)
+                    x_out_cv_batch = self.mnet.filter_sequence(cv_input, cv_init, weights=weights, \
+                        lengths=seq_lengths(cv_lengthMask) if self.args.randomLength else None)
                     
                     # Compute CV Loss
-                    MSE_cvbatch_linear_LOSS = 0
-                    if(MaskOnState):
-                        if self.args.randomLength:
-                            for index in range(self.N_CV):
-                                MSE_cv_linear_LOSS[index] = self.loss_fn(x_out_cv_batch[index,mask,cv_lengthMask[index]], cv_target[index,mask,cv_lengthMask[index]])
-                            MSE_cvbatch_linear_LOSS = torch.mean(MSE_cv_linear_LOSS)
-                        else:          
-                            MSE_cvbatch_linear_LOSS = self.loss_fn(x_out_cv_batch[:,mask,:], cv_target[:,mask,:])
-                    else:
-                        if self.args.randomLength:
-                            for index in range(self.N_CV):
-                                MSE_cv_linear_LOSS[index] = self.loss_fn(x_out_cv_batch[index,:,cv_lengthMask[index]], cv_target[index,:,cv_lengthMask[index]])
-                            MSE_cvbatch_linear_LOSS = torch.mean(MSE_cv_linear_LOSS)
-                        else:
-                            MSE_cvbatch_linear_LOSS = self.loss_fn(x_out_cv_batch, cv_target)
+                    MSE_cvbatch_linear_LOSS = masked_mse(x_out_cv_batch, cv_target, \
+                        cv_lengthMask if self.args.randomLength else None, mask).mean()
 
                     # dB Loss
                     self.MSE_cv_linear_epoch[ti] = MSE_cvbatch_linear_LOSS.item()
@@ -570,8 +603,7 @@ class Pipeline_hknet:
                         self.MSE_cv_dB_opt = self.MSE_cv_dB_epoch[ti]
                         self.MSE_cv_idx_opt = ti
                         
-                        torch.save(self.hnet, path_results + 'hnet_best-model.pt')
-                        torch.save(self.mnet, path_results + 'mnet_best-model.pt')
+                        self.checkpoint_writer.save(path_results + 'hknet_best-model.ckpt', self.hnet, self.mnet, self.args)
 
                 ########################
                 ### Training Summary ###
@@ -586,6 +618,8 @@ class Pipeline_hknet:
 
                 print("Optimal idx:", self.MSE_cv_idx_opt, "Optimal :", self.MSE_cv_dB_opt, "[dB]")
 
+            batches.close()
+            self.checkpoint_writer.wait()
             return [self.MSE_cv_linear_epoch, self.MSE_cv_dB_epoch, self.MSE_train_linear_epoch, self.MSE_train_dB_epoch]
 
     def NNTest(self, sys_model, test_input_tuple, test_target_tuple, path_results,test_init,\
@@ -593,12 +627,7 @@ class Pipeline_hknet:
         if self.args.wandb_switch: 
             import wandb
         # Load model
-        if load_model:
-            self.hnet = torch.load(load_model_path[0], map_location=self.device)
-            self.mnet = torch.load(load_model_path[1], map_location=self.device) 
-        else:
-            self.hnet = torch.load(path_results+'hnet_best-model.pt', map_location=self.device)
-            self.mnet = torch.load(path_results+'mnet_best-model.pt', map_location=self.device) 
+        self.load_best_model(path_results, load_model_path if load_model else None)
         
         # SoW
         assert torch.allclose(test_input_tuple[1], test_target_tuple[1]) 
@@ -612,51 +641,30 @@ class Pipeline_hknet:
         sysmdl_m = test_target.size()[1]
         sysmdl_T_test = test_target.size()[2]
 
-        self.MSE_test_linear_arr = torch.zeros([self.N_T])
-        x_out_test = torch.zeros([self.N_T, sysmdl_m,sysmdl_T_test]).to(self.device)
-
+        mask = None
         if MaskOnState:
             mask = torch.tensor([True,False,False])
             if sysmdl_m == 2: 
                 mask = torch.tensor([True,False])
 
-        # MSE LOSS Function
-        loss_fn = nn.MSELoss(reduction='mean')
-
         # Test mode
         self.hnet.eval()
         self.mnet.eval()
         self.mnet.batch_size = self.N_T
-        # Init Hidden State
-        self.hnet.init_hidden()
-        self.mnet.init_hidden()
-
-        torch.no_grad()
 
         start = time.time()
 
-        # Init Sequence
-        self.mnet.InitSequence(test_init, sysmdl_T_test)               
-        
-        weights = self.hnet(SoW_test)
-        for t in range(0, sysmdl_T_test):
-            x_out_test[:,:, t] = torch.squeeze(self.mnet(torch.unsqueeze(test_input[:,:, t],2), weights=weights))
+        with torch.no_grad():
+            weights = self.hnet_weights(SoW_test)
+            x_out_test = self.mnet.filter_sequence(test_input, test_init, weights=weights, \
+                lengths=seq_lengths(test_lengthMask) if self.args.randomLength else None)
         
         end = time.time()
         t = end - start
 
-        # MSE loss
-        for j in range(self.N_T):# cannot use batch due to different length and std computation  
-            if(MaskOnState):
-                if self.args.randomLength:
-                    self.MSE_test_linear_arr[j] = loss_fn(x_out_test[j,mask,test_lengthMask[j]], test_target[j,mask,test_lengthMask[j]]).item()
-                else:
-                    self.MSE_test_linear_arr[j] = loss_fn(x_out_test[j,mask,:], test_target[j,mask,:]).item()
-            else:
-                if self.args.randomLength:
-                    self.MSE_test_linear_arr[j] = loss_fn(x_out_test[j,:,test_lengthMask[j]], test_target[j,:,test_lengthMask[j]]).item()
-                else:
-                    self.MSE_test_linear_arr[j] = loss_fn(x_out_test[j,:,:], test_target[j,:,:]).item()
+        # MSE loss of each sequence
+        self.MSE_test_linear_arr = masked_mse(x_out_test, test_target, \
+            test_lengthMask if self.args.randomLength else None, mask).cpu()
         
         # Average
         self.MSE_test_linear_avg = torch.mean(self.MSE_test_linear_arr)
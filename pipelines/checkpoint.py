@@ -0,0 +1,139 @@
+"""
+The file contains the checkpoint format of Hyper-KalmanNet:
+the state_dicts of the hypernetwork and KalmanNet plus a JSON header with their shapes,
+fc_shape/lstm_shape of the KalmanNet, the args and the SoW range used for training.
+Only tensors, strings and dicts are stored, so a checkpoint loads with weights_only=True
+(no unpickling of modules or captured functions such as SysModel.f) and with mmap=True.
+
+functions:
+* save_checkpoint: write a checkpoint
+* read_checkpoint: read the header and state_dicts of a checkpoint
+* load_checkpoint_into: load a checkpoint into existing models
+* load_checkpoint: build the models from a checkpoint and a system model
+* CheckpointWriter: save checkpoints on a background thread
+"""
+
+import os
+import json
+import argparse
+import torch
+from concurrent.futures import ThreadPoolExecutor, wait
+
+FORMAT = 'hknet-checkpoint'
+VERSION = 1
+
+def checkpoint_state(hnet, mnet, args=None, SoW_range=None):
+    """
+    snapshot of the models as CPU tensors (copied, so training can go on) and the JSON header
+
+    output (dict): {'header': JSON string, 'hnet': state_dict, 'mnet': state_dict}
+    """
+    hnet_state = {k: v.detach().to('cpu', copy=True) for k, v in hnet.state_dict().items()}
+    mnet_state = {k: v.detach().to('cpu', copy=True) for k, v in mnet.state_dict().items()}
+    header = {
+        'format': FORMAT,
+        'version': VERSION,
+        'hnet': {
+            'output_size': hnet.fc2.out_features,
+            'hidden_size': hnet.hidden_size,
+            'shapes': {k: list(v.shape) for k, v in hnet_state.items()}},
+        'mnet': {
+            'm': mnet.m,
+            'n': mnet.n,
+            'n_params_KNet': mnet.n_params_KNet,
+            'knet_trainable': mnet.knet_trainable,
+            'fc_shape': mnet.fc_shape,
+            'lstm_shape': mnet.lstm_shape,
+            'shapes': {k: list(v.shape) for k, v in mnet_state.items()}},
+        'args': None if args is None else vars(args),
+        'SoW_range': None if SoW_range is None else list(SoW_range)}
+    return {'header': json.dumps(header, default=str), 'hnet': hnet_state, 'mnet': mnet_state}
+
+def write_checkpoint(state, path):
+    # write to a temporary file first, so a reader never sees a partial checkpoint
+    tmp_path = path + '.tmp'
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+
+def save_checkpoint(path, hnet, mnet, args=None, SoW_range=None):
+    """
+    input path (str): checkpoint file
+    input hnet (HyperNetwork), mnet (KalmanNetNN): models to save
+    input args (argparse.Namespace): settings stored in the header
+    input SoW_range (list): indices of the training datasets stored in the header
+    """
+    write_checkpoint(checkpoint_state(hnet, mnet, args, SoW_range), path)
+
+def read_checkpoint(path, mmap=True, map_location=None):
+    """
+    input mmap (bool): memory-map the tensors instead of reading the whole file
+    output (tuple): header (dict), hnet state_dict, mnet state_dict
+    """
+    state = torch.load(path, map_location=map_location, weights_only=True, mmap=mmap)
+    header = json.loads(state['header'])
+    assert header['format'] == FORMAT, 'not a Hyper-KalmanNet checkpoint'
+    return header, state['hnet'], state['mnet']
+
+def load_checkpoint_into(path, hnet, mnet, mmap=True):
+    """
+    load a checkpoint into models built with the same dimensions
+
+    output (dict): header of the checkpoint
+    """
+    header, hnet_state, mnet_state = read_checkpoint(path, mmap=mmap)
+    assert header['mnet']['fc_shape'] == mnet.fc_shape and header['mnet']['lstm_shape'] == mnet.lstm_shape, \
+        'checkpoint KalmanNet shapes do not match the model'
+    hnet.load_state_dict(hnet_state)
+    mnet.load_state_dict(mnet_state)
+    return header
+
+def load_checkpoint(path, SysModel, args=None, mmap=True):
+    """
+    build the models of a checkpoint, e.g. for a cold start of a deployment
+
+    input SysModel: system model providing f, h and the covariance priors, which are not stored
+    input args (argparse.Namespace): settings to build the models with, the ones of the checkpoint if None
+    output (tuple): hnet (HyperNetwork), mnet (KalmanNetNN), header (dict)
+    """
+    from hnets.hnet import HyperNetwork
+    from mnets.KNet_mnet import KalmanNetNN
+
+    header, hnet_state, mnet_state = read_checkpoint(path, mmap=mmap)
+    if args is None:
+        args = argparse.Namespace(**header['args'])
+    mnet = KalmanNetNN()
+    n_params = mnet.NNBuild(SysModel, args)
+    assert n_params == header['mnet']['n_params_KNet'], 'checkpoint KalmanNet size does not match the system model'
+    hnet = HyperNetwork(args, n_params)
+    hnet.load_state_dict(hnet_state)
+    mnet.load_state_dict(mnet_state)
+    return hnet, mnet, header
+
+class CheckpointWriter:
+    """
+    Saves checkpoints on a background thread. The models are copied to CPU when save is
+    called, only the file write runs in the background. Saves are written in call order.
+    """
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = []
+
+    def save(self, path, hnet, mnet, args=None, SoW_range=None):
+        state = checkpoint_state(hnet, mnet, args, SoW_range)
+        self.pending = [f for f in self.pending if not f.done() or f.exception() is not None]
+        self.pending.append(self.executor.submit(write_checkpoint, state, path))
+
+    def wait(self):
+        # block until all saves are written, and raise the error of a failed one (once)
+        pending, self.pending = self.pending, []
+        wait(pending)
+        for future in pending:
+            future.result()
+
+    def __getstate__(self):
+        # threads cannot be pickled, e.g. with a pipeline saved by earlier versions of Pipeline_hknet.save
+        self.wait()
+        return {}
+
+    def __setstate__(self, state):
+        self.__init__()
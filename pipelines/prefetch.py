@@ -0,0 +1,122 @@
+"""
+The file contains the background prefetching of training batches.
+
+* TrainingBatches: iterable dataset of training steps, each step is one sample_batch per dataset (SoW).
+    The sources can live on any device, or be memory-mapped (see simulations/datastore.py),
+    only the selected sequences are gathered.
+* BatchPrefetcher: assembles the next steps on a background thread and copies them to the device
+    (from pinned host memory, on a separate CUDA stream), overlapping with the current step.
+"""
+
+import threading
+import queue
+import torch
+from pipelines.utils import sample_batch
+
+class TrainingBatches(torch.utils.data.IterableDataset):
+
+    def __init__(self, N_B, sources, bucket_pool=0, generator=None):
+        """
+        input N_B (int): batch size of each dataset
+        input sources (list): (input, target, init, lengthMask) of each dataset, init and lengthMask may be None
+        input bucket_pool (int): see sample_batch
+        input generator (torch.Generator): random generator of the selection, the global one if None
+        """
+        super().__init__()
+        self.N_B = N_B
+        self.sources = sources
+        self.bucket_pool = bucket_pool
+        self.generator = generator
+
+    def __iter__(self):
+        # one list of (y, target, init, lengthMask) batches per training step, without end
+        while True:
+            yield [sample_batch(self.N_B, *source, bucket_pool=self.bucket_pool, generator=self.generator) \
+                for source in self.sources]
+
+class BatchPrefetcher:
+
+    def __init__(self, dataset, device, depth=2):
+        """
+        input dataset (TrainingBatches): training steps
+        input device (torch.device): device of the training
+        input depth (int): number of steps prepared ahead on the background thread,
+            0 to assemble every step synchronously in next()
+        """
+        self.device = device
+        self.depth = depth
+        self.cuda = device.type == 'cuda' and torch.cuda.is_available()
+        if depth > 0 and dataset.generator is None:
+            # the background thread must not draw from the global generator, which the
+            # training also uses; seed its own from it, so runs stay reproducible
+            dataset.generator = torch.Generator().manual_seed(int(torch.randint(2**62, (1,))))
+        self.iterator = iter(dataset)
+        self.thread = None
+        if depth > 0:
+            self.queue = queue.Queue(maxsize=depth)
+            self.stopped = threading.Event()
+            self.thread = threading.Thread(target=self.worker, daemon=True)
+            self.thread.start()
+
+    def to_device(self, batches):
+        # copy the batches to the device, through pinned memory for asynchronous host-to-device copies
+        staged = []
+        for batch in batches:
+            staged.append(tuple(None if x is None else \
+                (x.pin_memory() if self.cuda and x.device.type == 'cpu' else x).to(self.device, non_blocking=self.cuda) \
+                for x in batch))
+        return staged
+
+    def worker(self):
+        stream = torch.cuda.Stream(self.device) if self.cuda else None
+        try:
+            while not self.stopped.is_set():
+                batches = next(self.iterator)
+                event = None
+                if stream is not None:
+                    with torch.cuda.stream(stream):
+                        batches = self.to_device(batches)
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                else:
+                    batches = self.to_device(batches)
+                self.put((batches, event))
+        except Exception as e:
+            self.put((e, None)) # raised by next()
+
+    def put(self, item):
+        # wait for a free slot, but give up once closed
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        """
+        output (list): (y, target, init, lengthMask) batch of each dataset, on the device
+        """
+        if self.thread is None:
+            return self.to_device(next(self.iterator))
+        batches, event = self.queue.get()
+        if isinstance(batches, Exception):
+            raise batches
+        if event is not None:
+            # the copies ran on the prefetch stream
+            current = torch.cuda.current_stream(self.device)
+            current.wait_event(event)
+            for batch in batches:
+                for x in batch:
+                    if x is not None:
+                        x.record_stream(current)
+        return batches
+
+    def close(self):
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,133 @@
+"""
+The file contains utility functions for the training pipelines.
+"""
+
+import torch
+import torch.nn.functional as F
+
+def sample_batch(N_B, input, target, init=None, lengthMask=None, device=None, bucket_pool=0, generator=None):
+    """
+    randomly select N_B sequences (without replacement) and gather them in one go
+
+    input input (torch.tensor): [N_E, n, T]
+    input target (torch.tensor): [N_E, m, T]
+    input init (torch.tensor): [N_E, m, 1], None if no per-sequence init
+    input lengthMask (torch.tensor): [N_E, T] bool, None if all sequences have full length
+    input device (torch.device): device of the gathered batch, device of input if None
+    input bucket_pool (int): if > 0 and lengthMask is given, draw bucket_pool x N_B random sequences,
+        split them by length into buckets of N_B and return one bucket at random, so the
+        batch has sequences of similar length (each sequence is still equally likely)
+    input generator (torch.Generator): CPU random generator for the selection, the global one if None
+    output (tuple): y_batch [N_B, n, T], target_batch [N_B, m, T], init_batch [N_B, m, 1] or None,
+        lengthMask_batch [N_B, T] or None; time steps beyond the length of a sequence are zero
+    """
+    N_E = input.shape[0]
+    assert N_B <= N_E # N_B must be smaller than N_E
+    if lengthMask is not None and bucket_pool > 0:
+        n_buckets = min(bucket_pool, N_E // N_B)
+        pool = randperm(N_E, lengthMask.device, generator)[:n_buckets * N_B]
+        pool = pool[torch.argsort(lengthMask[pool].sum(dim=1))]
+        bucket = torch.randint(n_buckets, (1,), generator=generator).item()
+        index = pool[bucket * N_B:(bucket + 1) * N_B].to(input.device)
+    else:
+        index = randperm(N_E, input.device, generator)[:N_B]
+    y_batch = input.index_select(0, index)
+    target_batch = target.index_select(0, index.to(target.device))
+    init_batch = None
+    if init is not None:
+        init_batch = init.index_select(0, index.to(init.device)).reshape(N_B, -1, 1)
+    lengthMask_batch = None
+    if lengthMask is not None:
+        lengthMask_batch = lengthMask.index_select(0, index.to(lengthMask.device))
+        padding = ~lengthMask_batch.unsqueeze(1)
+        y_batch = y_batch.masked_fill(padding.to(y_batch.device), 0)
+        target_batch = target_batch.masked_fill(padding.to(target_batch.device), 0)
+
+    if device is not None:
+        y_batch, target_batch = y_batch.to(device), target_batch.to(device)
+        if init_batch is not None:
+            init_batch = init_batch.to(device)
+        if lengthMask_batch is not None:
+            lengthMask_batch = lengthMask_batch.to(device)
+    return y_batch, target_batch, init_batch, lengthMask_batch
+
+def randperm(N, device, generator=None):
+    # random permutation on device, drawn on CPU when a (CPU) generator is given
+    if generator is None:
+        return torch.randperm(N, device=device)
+    return torch.randperm(N, generator=generator).to(device)
+
+def masked_mse(x, target, lengthMask=None, stateMask=None, n_valid=None):
+    """
+    MSE of each sequence, restricted to the valid time steps and the selected states
+
+    input x (torch.tensor): estimate [B, m, T]
+    input target (torch.tensor): [B, m, T]
+    input lengthMask (torch.tensor): [B, T] bool, True for valid time steps, None if all are valid
+    input stateMask (torch.tensor): [m] bool, states included in the loss, None for all states
+    input n_valid (torch.tensor or int): number of valid time steps of each sequence [B] to average over,
+        the ones in lengthMask if None. For a time window of the sequences, their whole lengths
+        make the window losses sum up to the loss of the sequences.
+    output (torch.tensor): [B], the batch MSE is its mean
+    """
+    if stateMask is not None:
+        x, target = x[:, stateMask], target[:, stateMask]
+    se = (x - target) ** 2
+    if lengthMask is None and n_valid is None:
+        return se.mean(dim=(1, 2))
+    if lengthMask is not None:
+        lengthMask = lengthMask.to(se.device).unsqueeze(1)
+        se = se.masked_fill(~lengthMask, 0)
+        if n_valid is None:
+            n_valid = lengthMask.sum(dim=(1, 2))
+    return se.sum(dim=(1, 2)) / (n_valid * se.shape[1])
+
+def truncated_bptt(mnet, optimizer, window, runs, stateMask=None):
+    """
+    one training batch with truncated backpropagation through time: the recursion runs in windows
+    of window time steps with one optimizer step per window, and its state is detached between
+    windows, so the autograd graph (the memory) is bounded by the window instead of T
+
+    input mnet (KalmanNetNN): the KalmanNet
+    input optimizer (torch.optim.Optimizer): optimizer of the trained parameters
+    input window (int): number of time steps of a window
+    input runs (list): (prepare, y, init, target, lengthMask) of each recursion of the batch,
+        e.g. one per dataset. prepare() is called before each window of the run, sets its system
+        dynamics if needed and returns its KNet weights (generated again after every optimizer step),
+        or None for a trainable KNet. lengthMask is None for full-length sequences.
+    input stateMask (torch.tensor): [m] bool, states included in the loss, None for all states
+    output (torch.tensor): loss of the whole sequences (without graph), averaged over all sequences of all runs
+    """
+    # the data are constants of the optimization, the windows of a sequence must not share a graph through them
+    runs = [(prepare, y.detach(), init.detach(), target.detach(), lengthMask) for prepare, y, init, target, lengthMask in runs]
+    n_sequences = sum(y.shape[0] for _, y, _, _, _ in runs)
+    states = [mnet.init_state(init) for _, _, init, _, _ in runs]
+    x_out = [[] for _ in runs]
+    # windows up to the end of the longest sequence
+    T = max(y.shape[2] if lengthMask is None else int(seq_lengths(lengthMask).max()) for _, y, _, _, lengthMask in runs)
+    for t0 in range(0, T, window):
+        t1 = min(t0 + window, T)
+        optimizer.zero_grad()
+        loss = 0
+        for k, (prepare, y, init, target, lengthMask) in enumerate(runs):
+            x, state = mnet.filter_window(states[k], y[:, :, t0:t1], weights=prepare())
+            n_valid = y.shape[2] if lengthMask is None else seq_lengths(lengthMask).to(x.device)
+            loss = loss + masked_mse(x, target[:, :, t0:t1], None if lengthMask is None else lengthMask[:, t0:t1], \
+                stateMask, n_valid).sum()
+            states[k] = mnet.detach_state(state)
+            x_out[k].append(x.detach())
+        (loss / n_sequences).backward()
+        optimizer.step()
+
+    with torch.no_grad():
+        loss = 0
+        for k, (_, y, _, target, lengthMask) in enumerate(runs):
+            x = F.pad(torch.cat(x_out[k], dim=2), (0, y.shape[2] - T))
+            loss = loss + masked_mse(x, target, lengthMask, stateMask).sum()
+    return loss / n_sequences
+
+def seq_lengths(lengthMask):
+    # valid length of each sequence [B] from its length mask [B, T], None for full-length sequences
+    if lengthMask is None:
+        return None
+    return lengthMask.sum(dim=1)
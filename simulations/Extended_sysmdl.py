@@ -15,6 +15,7 @@
 
 import torch
 from torch.distributions.multivariate_normal import MultivariateNormal
+from simulations.utils import noise_factor, sample_noise
 
 class SystemModel:
 
@@ -147,25 +148,50 @@ class SystemModel:
             self.x_prev = xt
 
 
+    #############################
+    ### Generate Trajectories ###
+    #############################
+    def GenerateTrajectories(self, x0, T):
+        """
+        generate the state and observation trajectories of all sequences in one batched pass,
+        with all noise drawn up front
+
+        input x0 (torch.tensor): initial states [batch_size, m, 1]
+        input T (int): sequence length
+        output (tuple): states [batch_size, m, T], observations [batch_size, n, T]
+        """
+        size = x0.shape[0]
+        W = sample_noise(noise_factor(self.Q), size, T) # [batch_size, T, m]
+        V = sample_noise(noise_factor(self.R), size, T) # [batch_size, T, n]
+
+        # State evolution with the process noise
+        X = W if W is not None else torch.zeros(size, T, self.m)
+        xt = x0
+        for t in range(0, T):
+            xt = self.f(xt) + X[:, t].unsqueeze(2)
+            X[:, t] = xt.squeeze(2)
+
+        # Emission for all time steps at once
+        Y = self.h(X.reshape(size * T, self.m, 1)).reshape(size, T, self.n)
+        if V is not None:
+            Y = Y + V
+
+        self.x_prev = xt
+        return X.transpose(1, 2).contiguous(), Y.transpose(1, 2).contiguous()
+
     ######################
     ### Generate Batch ###
     ######################
     def GenerateBatch(self, args, size, T, randomInit=False):
         if(randomInit):
-            # Allocate Empty Array for Random Initial Conditions
-            self.m1x_0_rand = torch.zeros(size, self.m, 1)
             if args.distribution == 'uniform':
                 ### if Uniform Distribution for random init
-                for i in range(size):           
-                    initConditions = torch.rand_like(self.m1x_0) * args.variance
-                    self.m1x_0_rand[i,:,0:1] = initConditions.view(self.m,1)     
+                self.m1x_0_rand = torch.rand(size, self.m, 1) * args.variance
             
             elif args.distribution == 'normal':
                 ### if Normal Distribution for random init
-                for i in range(size):
-                    distrib = MultivariateNormal(loc=torch.squeeze(self.m1x_0), covariance_matrix=self.m2x_0)
-                    initConditions = distrib.rsample().view(self.m,1)
-                    self.m1x_0_rand[i,:,0:1] = initConditions
+                distrib = MultivariateNormal(loc=torch.squeeze(self.m1x_0), covariance_matrix=self.m2x_0)
+                self.m1x_0_rand = distrib.rsample((size,)).view(size, self.m, 1)
             else:
                 raise ValueError('args.distribution not supported!')
             
@@ -175,82 +201,15 @@ class SystemModel:
             self.Init_batched_sequence(initConditions, self.m2x_0)### for sequence generation
     
         if(args.randomLength):
-            # Allocate Array for Input and Target (use zero padding)
-            self.Input = torch.zeros(size, self.n, args.T_max)
-            self.Target = torch.zeros(size, self.m, args.T_max)
-            self.lengthMask = torch.zeros((size,args.T_max), dtype=torch.bool)# init with all false
             # Init Sequence Lengths
             T_tensor = torch.round((args.T_max-args.T_min)*torch.rand(size)).int()+args.T_min # Uniform distribution [100,1000]
-            for i in range(0, size):
-                # Generate Sequence
-                self.GenerateSequence(self.Q, self.R, T_tensor[i].item())
-                # Training sequence input
-                self.Input[i, :, 0:T_tensor[i].item()] = self.y             
-                # Training sequence output
-                self.Target[i, :, 0:T_tensor[i].item()] = self.x
-                # Mask for sequence length
-                self.lengthMask[i, 0:T_tensor[i].item()] = True
+            # Mask for sequence length
+            self.lengthMask = torch.arange(args.T_max) < T_tensor.unsqueeze(1)
+            # Generate all sequences up to T_max, then zero pad beyond their length
+            self.Target, self.Input = self.GenerateTrajectories(self.m1x_0_batch, args.T_max)
+            self.Target.masked_fill_(~self.lengthMask.unsqueeze(1), 0)
+            self.Input.masked_fill_(~self.lengthMask.unsqueeze(1), 0)
 
         else:
-            # Allocate Empty Array for Input
-            self.Input = torch.empty(size, self.n, T)
-            # Allocate Empty Array for Target
-            self.Target = torch.empty(size, self.m, T)
-
-            # Set x0 to be x previous
-            self.x_prev = self.m1x_0_batch
-            xt = self.x_prev
-
-            # Generate in a batched manner
-            for t in range(0, T):
-                ########################
-                #### State Evolution ###
-                ########################   
-                if torch.equal(self.Q,torch.zeros(self.m,self.m)):# No noise
-                    xt = self.f(self.x_prev)
-                elif self.m == 1: # 1 dim noise
-                    xt = self.f(self.x_prev)
-                    eq = torch.normal(mean=torch.zeros(size), std=self.Q).view(size,1,1)
-                    # Additive Process Noise
-                    xt = torch.add(xt,eq)
-                else:            
-                    xt = self.f(self.x_prev)
-                    mean = torch.zeros([size, self.m])              
-                    distrib = MultivariateNormal(loc=mean, covariance_matrix=self.Q)
-                    eq = distrib.rsample().view(size,self.m,1)
-                    # Additive Process Noise
-                    xt = torch.add(xt,eq)
-
-                ################
-                ### Emission ###
-                ################
-                # Observation Noise
-                if torch.equal(self.R,torch.zeros(self.n,self.n)):# No noise
-                    yt = self.h(xt)
-                elif self.n == 1: # 1 dim noise
-                    yt = self.h(xt)
-                    er = torch.normal(mean=torch.zeros(size), std=self.R).view(size,1,1)
-                    # Additive Observation Noise
-                    yt = torch.add(yt,er)
-                else:  
-                    yt =  self.h(xt)
-                    mean = torch.zeros([size,self.n])            
-                    distrib = MultivariateNormal(loc=mean, covariance_matrix=self.R)
-                    er = distrib.rsample().view(size,self.n,1)          
-                    # Additive Observation Noise
-                    yt = torch.add(yt,er)
-
-                ########################
-                ### Squeeze to Array ###
-                ########################
-
-                # Save Current State to Trajectory Array
-                self.Target[:, :, t] = torch.squeeze(xt,2)
-
-                # Save Current Observation to Trajectory Array
-                self.Input[:, :, t] = torch.squeeze(yt,2)
-
-                ################################
-                ### Save Current to Previous ###
-                ################################
-                self.x_prev = xt
+            self.Target, self.Input = self.GenerateTrajectories(self.m1x_0_batch, T)
+
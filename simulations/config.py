@@ -23,6 +23,10 @@ def general_settings():
                     help='if random sequence length, input max sequence length')
     parser.add_argument('--T_min', type=int, default=100, metavar='minimum-length',
                 help='if random sequence length, input min sequence length')
+    parser.add_argument('--bucket_pool', type=int, default=0, metavar='bucket-pool',
+                help='if random sequence length and > 0, draw each training batch of similar lengths among bucket_pool x n_batch random sequences')
+    parser.add_argument('--prefetch_batches', type=int, default=0, metavar='prefetch-batches',
+                help='if > 0, number of training batches prepared ahead on a background thread and copied to the device')
         # Random initial state
     parser.add_argument('--randomInit_train', type=bool, default=False, metavar='ri_train',
                         help='if True, random initial state for training set')
@@ -34,6 +38,13 @@ def general_settings():
                         help='input variance for the random initial state with uniform distribution')
     parser.add_argument('--distribution', type=str, default='normal', metavar='distribution',
                         help='input distribution for the random initial state (uniform/normal)')
+        # Data generation
+    parser.add_argument('--datagen_workers', type=int, default=1, metavar='datagen-workers',
+                        help='number of worker processes for generating the datasets of all SoWs')
+    parser.add_argument('--datagen_seed', type=int, default=None, metavar='datagen-seed',
+                        help='seed for the generated datasets, reproducible for any number of workers')
+    parser.add_argument('--data_format', type=str, default='pt', metavar='data-format',
+                        help='format of the saved datasets: pt (one torch.save list per SoW) or store (memory-mapped arrays, see simulations/datastore.py)')
 
 
     ### Training settings
@@ -41,6 +52,10 @@ def general_settings():
                         help='if True, use wandb')
     parser.add_argument('--use_cuda', type=bool, default=False, metavar='CUDA',
                         help='if True, use CUDA')
+    parser.add_argument('--autocast_bf16', type=bool, default=False, metavar='autocast-bf16',
+                        help='if True, run the HyperNetwork and the KNet gain network in bfloat16 (autocast), the Kalman state update and the loss stay in float32')
+    parser.add_argument('--autocast_tol_dB', type=float, default=0.1, metavar='autocast-tol-dB',
+                        help='accuracy guard of autocast_bf16: largest allowed deviation of the test MSE [dB] from float32')
     parser.add_argument('--n_steps', type=int, default=1000, metavar='N_steps',
                         help='number of training steps (default: 1000)')
     parser.add_argument('--n_batch', type=int, default=20, metavar='N_B',
@@ -53,6 +68,10 @@ def general_settings():
                         help='if True, use composition loss')
     parser.add_argument('--alpha', type=float, default=0.3, metavar='alpha',
                         help='input alpha [0,1] for the composition loss')
+    parser.add_argument('--tbptt_window', type=int, default=0, metavar='tbptt-window',
+                        help='if > 0, truncated BPTT: backpropagate through windows of tbptt_window time steps, with one optimizer step per window')
+    parser.add_argument('--checkpoint_every', type=int, default=0, metavar='checkpoint-every',
+                        help='if > 0, full BPTT with activation checkpointing: keep the KNet state every checkpoint_every time steps and recompute the rest in backward (about sqrt(T))')
 
     
     ### KalmanNet settings
@@ -64,12 +83,26 @@ def general_settings():
                         help='if True, add context modulation layer to KNet')
     parser.add_argument('--knet_trainable', type=bool, default=False, metavar='knet_trainable',
                         help='if True, KNet is trainable, if False, KNet weights are generated by HyperNetwork')
+    parser.add_argument('--compile_KNet', type=bool, default=False, metavar='compile_KNet',
+                        help='if True, compile the KNet step with torch.compile for whole-sequence filtering')
     
     ### HyperNetwork settings
     parser.add_argument('--hnet_input_size', type=int, default=4, metavar='hnet_input_size',
                         help='input dimension for HyperNetwork') # (F_t, H_t, Q_t, R_t)
     parser.add_argument('--hnet_hidden_size_scale', type=int, default=10, metavar='hnet_hidden_size_scale',
                         help='hidden dimension divider for HyperNetwork')
+    parser.add_argument('--hnet_cache_MB', type=float, default=64, metavar='hnet_cache_MB',
+                        help='size of the cache of generated KNet weights used in evaluation (0 to disable)')
+
+    ### Model-based filter settings
+    parser.add_argument('--filter_history_stride', type=int, default=0, metavar='filter_history_stride',
+                        help='if > 0, the KF and EKF record the covariances (and EKF gains) of every filter_history_stride-th step, if 0 only the posterior means')
+    parser.add_argument('--filter_history_dtype', type=str, default=None, metavar='filter_history_dtype',
+                        help='storage dtype of the recorded covariances and gains (e.g. float16), default dtype if None')
+    parser.add_argument('--KF_form', type=str, default='standard', metavar='KF_form',
+                        help='covariance update of the KF and EKF: standard, joseph (symmetric PSD correction) or sqrt (Cholesky factors, stable in float32)')
+    parser.add_argument('--KF_steady_tol', type=float, default=0, metavar='KF_steady_tol',
+                        help='if > 0, the KF stops the Riccati recursion once the gain changes by less than this, and keeps the steady-state gain')
 
     args = parser.parse_args()
     return args
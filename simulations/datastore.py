@@ -0,0 +1,84 @@
+"""
+The file contains the memory-mapped dataset store.
+
+A dataset (the train, cv and test splits of one SoW) is a directory:
+    <name>.data/
+        meta.json               format version, and dtype and shape of every array
+        train_input.bin         one flat contiguous array per split and field,
+        train_target.bin        in C order, raw bytes without header
+        ...
+meta.json is written last, so a directory without it is an incomplete write.
+The reader memory-maps the arrays (copy-on-write), so loading is instant and only the
+sequences that are actually used (e.g. the gathered training batches) are read from disk.
+"""
+
+import os
+import json
+import numpy as np
+import torch
+
+FORMAT = 'hknet-datastore'
+VERSION = 1
+SPLITS = ['train', 'cv', 'test']
+FIELDS = ['input', 'target', 'init', 'lengthMask']
+
+def store_path(fileName):
+    # directory of the store of the dataset file fileName (e.g. 'data/r2=1.0_q2=1.0.pt' -> 'data/r2=1.0_q2=1.0.data')
+    return os.path.splitext(fileName)[0] + '.data'
+
+def save_store(path, splits):
+    """
+    input path (str): store directory
+    input splits (dict): split name -> [input, target, init, lengthMask] as returned by GenerateSplit,
+        lengthMask may be None
+    """
+    os.makedirs(path, exist_ok=True)
+    meta_file = os.path.join(path, 'meta.json')
+    if os.path.exists(meta_file):
+        os.remove(meta_file)
+    arrays = {}
+    for split, tensors in splits.items():
+        for field, tensor in zip(FIELDS, tensors):
+            if tensor is None:
+                continue
+            name = split + '_' + field
+            array = tensor.detach().cpu().contiguous().numpy()
+            array.tofile(os.path.join(path, name + '.bin'))
+            arrays[name] = {'dtype': array.dtype.str, 'shape': list(array.shape)}
+    with open(meta_file, 'w') as f:
+        json.dump({'format': FORMAT, 'version': VERSION, 'arrays': arrays}, f, indent=1)
+
+def open_store(path):
+    """
+    input path (str): store directory
+    output (dict): array name (e.g. 'train_input') -> CPU tensor backed by the memory-mapped file
+    """
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    assert meta['format'] == FORMAT, 'not a dataset store'
+    assert meta['version'] <= VERSION, 'dataset store written by a newer version'
+    arrays = {}
+    for name, info in meta['arrays'].items():
+        shape = tuple(info['shape'])
+        if 0 in shape: # empty arrays cannot be memory-mapped
+            arrays[name] = torch.from_numpy(np.zeros(shape, dtype=np.dtype(info['dtype'])))
+            continue
+        # mode 'c': copy-on-write, the tensor is writable but the file is never modified
+        array = np.memmap(os.path.join(path, name + '.bin'), dtype=np.dtype(info['dtype']), mode='c', shape=shape)
+        arrays[name] = torch.from_numpy(array)
+    return arrays
+
+def load_store(path, randomLength=False):
+    """
+    output (list): the same list as torch.load of a file written by SaveData:
+        [train_input, train_target, cv_input, cv_target, test_input, test_target, train_init, cv_init, test_init]
+        followed by [train_lengthMask, cv_lengthMask, test_lengthMask] if randomLength
+    """
+    arrays = open_store(path)
+    data = []
+    for split in SPLITS:
+        data += [arrays[split + '_input'], arrays[split + '_target']]
+    data += [arrays.get(split + '_init') for split in SPLITS]
+    if randomLength:
+        data += [arrays[split + '_lengthMask'] for split in SPLITS]
+    return data
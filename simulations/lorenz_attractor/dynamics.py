@@ -0,0 +1,120 @@
+"""# **Class: Lorenz Attractor Dynamics**
+
+Discrete-time Lorenz transition x_{t+1} = F(x_t) x_t, where F is the order-J Taylor expansion
+F(x) = sum_{j=0}^{J} (A(x) dt)^j / j! of the continuous-time matrix A(x) = C + B(x),
+with B(x)[1,0] = -x_2 and B(x)[2,0] = x_1, optionally followed by a rotation.
+
+Constants are kept on the device of the input (one copy per device and dtype), and the
+series is evaluated with incremental powers, term_j = term_{j-1} (A dt) / j, so each step
+costs J products instead of the O(J^2) of recomputing every matrix power.
+"""
+
+import torch
+
+class LorenzDynamics:
+
+    def __init__(self, C, delta_t, order, rotation=None):
+        """
+        input C (torch.tensor): constant part of A [m, m]
+        input delta_t (float): discretization step
+        input order (int): Taylor expansion order J
+        input rotation (torch.tensor): rotation applied after the transition [m, m], None for no rotation
+        """
+        self.C = C
+        self.m = C.shape[0]
+        self.delta_t = delta_t
+        self.order = order
+        self.rotation = rotation
+        self.constants = {} # (device, dtype) -> (C*dt, rotation)
+
+    def get_constants(self, x):
+        key = (x.device, x.dtype)
+        if key not in self.constants:
+            C_dt = (self.C * self.delta_t).to(x.device, x.dtype)
+            rotation = None if self.rotation is None else self.rotation.to(x.device, x.dtype)
+            self.constants[key] = (C_dt, rotation)
+        return self.constants[key]
+
+    def A_dt(self, x):
+        """
+        input x (torch.tensor): [batch_size, m, 1]
+        output (torch.tensor): A(x) dt [batch_size, m, m]
+        """
+        C_dt, _ = self.get_constants(x)
+        A_dt = C_dt.repeat(x.shape[0], 1, 1)
+        A_dt[:,1,0] -= x[:,2,0] * self.delta_t
+        A_dt[:,2,0] += x[:,1,0] * self.delta_t
+        return A_dt
+
+    def transition(self, x):
+        """
+        input x (torch.tensor): [batch_size, m, 1]
+        output F (torch.tensor): transition matrix at x, including the rotation [batch_size, m, m]
+        """
+        A_dt = self.A_dt(x)
+        term = A_dt
+        F = torch.eye(self.m, dtype=x.dtype, device=x.device) + A_dt
+        for j in range(2, self.order+1):
+            term = torch.bmm(term, A_dt) / j
+            F = F + term
+        _, rotation = self.get_constants(x)
+        if rotation is not None:
+            F = torch.matmul(rotation, F)
+        return F
+
+    def __call__(self, x, jacobian=False):
+        """
+        input x (torch.tensor): [batch_size, m, 1]
+        input jacobian (bool): also return the transition matrix F(x)
+        output (torch.tensor): F(x) x [batch_size, m, 1], and F(x) [batch_size, m, m] if jacobian
+        """
+        if jacobian:
+            F = self.transition(x)
+            return torch.bmm(F, x), F
+        # Only F(x) x is needed: apply the series to the vector, term_j = (A dt) term_{j-1} / j
+        A_dt = self.A_dt(x)
+        term = x
+        x_next = x
+        for j in range(1, self.order+1):
+            term = torch.bmm(A_dt, term) / j
+            x_next = x_next + term
+        _, rotation = self.get_constants(x)
+        if rotation is not None:
+            x_next = torch.matmul(rotation, x_next)
+        return x_next
+
+    def step_jacobian(self, x):
+        """
+        F(x) x and its Jacobian with respect to x, in the same pass over the series.
+        With term_j = (A dt) term_{j-1} / j, the Jacobian of term_j is
+        ((A dt) d term_{j-1} + G_{j-1}) / j, where G_{j-1} holds the derivatives of A dt
+        (with respect to x_1 and x_2) applied to term_{j-1}.
+
+        input x (torch.tensor): [batch_size, m, 1]
+        output (tuple): F(x) x [batch_size, m, 1], Jacobian [batch_size, m, m]
+        """
+        A_dt = self.A_dt(x)
+        term = x
+        x_next = x
+        d_term = torch.eye(self.m, dtype=x.dtype, device=x.device).expand(x.shape[0], self.m, self.m)
+        Jac = d_term
+        for j in range(1, self.order+1):
+            G = torch.zeros_like(A_dt)
+            G[:,2,1] = term[:,0,0] * self.delta_t # d(A dt)/dx_1 = dt e_2 e_0^T
+            G[:,1,2] = -term[:,0,0] * self.delta_t # d(A dt)/dx_2 = -dt e_1 e_0^T
+            d_term = (torch.bmm(A_dt, d_term) + G) / j
+            term = torch.bmm(A_dt, term) / j
+            x_next = x_next + term
+            Jac = Jac + d_term
+        _, rotation = self.get_constants(x)
+        if rotation is not None:
+            x_next = torch.matmul(rotation, x_next)
+            Jac = torch.matmul(rotation, Jac)
+        return x_next, Jac
+
+    def jacobian(self, x):
+        """
+        input x (torch.tensor): [batch_size, m, 1]
+        output (torch.tensor): Jacobian of F(x) x [batch_size, m, m]
+        """
+        return self.step_jacobian(x)[1]
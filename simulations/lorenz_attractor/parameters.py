@@ -9,6 +9,7 @@ import torch
 import math
 torch.pi = torch.acos(torch.zeros(1)).item() * 2 # which is 3.1415927410125732
 from torch import autograd
+from simulations.lorenz_attractor.dynamics import LorenzDynamics
 
 #########################
 ### Design Parameters ###
@@ -58,80 +59,26 @@ C = torch.tensor([[-10, 10,    0],
 ######################################################
 ### State evolution function f for Lorenz Atractor ###
 ######################################################
+lorenz_gen = LorenzDynamics(C, delta_t_gen, J)
+lorenz = LorenzDynamics(C, delta_t, J)
+lorenz_inacc = LorenzDynamics(C, delta_t, J_mod)
+lorenz_rotate = LorenzDynamics(C, delta_t, J, rotation=RotMatrix)
+
 ### f_gen is for dataset generation
 def f_gen(x, jacobian=False):
-    BX = torch.zeros([x.shape[0],m,m]).float().to(x.device) #[batch_size, m, m]
-    BX[:,1,0] = torch.squeeze(-x[:,2,:]) 
-    BX[:,2,0] = torch.squeeze(x[:,1,:])
-    Const = C.to(x.device)
-    A = torch.add(BX, Const)  
-    # Taylor Expansion for F    
-    F = torch.eye(m).to(x.device)
-    F = F.reshape((1, m, m)).repeat(x.shape[0], 1, 1) # [batch_size, m, m] identity matrix
-    for j in range(1,J+1):
-        F_add = (torch.matrix_power(A*delta_t_gen, j)/math.factorial(j))
-        F = torch.add(F, F_add)
-    if jacobian:
-        return torch.bmm(F, x), F
-    else:
-        return torch.bmm(F, x)
+    return lorenz_gen(x, jacobian)
 
 ### f will be fed to filters and KNet, note that the mismatch comes from delta_t
 def f(x, jacobian=False):
-    BX = torch.zeros([x.shape[0],m,m]).float().to(x.device) #[batch_size, m, m]
-    BX[:,1,0] = torch.squeeze(-x[:,2,:]) 
-    BX[:,2,0] = torch.squeeze(x[:,1,:]) 
-    Const = C.to(x.device)
-    A = torch.add(BX, Const) 
-    # Taylor Expansion for F    
-    F = torch.eye(m).to(x.device)
-    F = F.reshape((1, m, m)).repeat(x.shape[0], 1, 1) # [batch_size, m, m] identity matrix
-    for j in range(1,J+1):
-        F_add = (torch.matrix_power(A*delta_t, j)/math.factorial(j))
-        F = torch.add(F, F_add)
-    if jacobian:
-        return torch.bmm(F, x), F
-    else:
-        return torch.bmm(F, x)
+    return lorenz(x, jacobian)
 
 ### fInacc will be fed to filters and KNet, note that the mismatch comes from delta_t and J_mod
 def fInacc(x, jacobian=False):
-    BX = torch.zeros([x.shape[0],m,m]).float().to(x.device) #[batch_size, m, m]
-    BX[:,1,0] = torch.squeeze(-x[:,2,:]) 
-    BX[:,2,0] = torch.squeeze(x[:,1,:]) 
-    Const = C.to(x.device)
-    A = torch.add(BX, Const)     
-    # Taylor Expansion for F    
-    F = torch.eye(m).to(x.device)
-    F = F.reshape((1, m, m))
-    F = F.repeat(x.shape[0], 1, 1) # [batch_size, m, m] identity matrix
-    for j in range(1,J_mod+1):
-        F_add = (torch.matrix_power(A*delta_t, j)/math.factorial(j))
-        F = torch.add(F, F_add)
-    if jacobian:
-        return torch.bmm(F, x), F
-    else:
-        return torch.bmm(F, x)
+    return lorenz_inacc(x, jacobian)
 
-### fInacc will be fed to filters and KNet, note that the mismatch comes from delta_t and rotation
+### fRotate will be fed to filters and KNet, note that the mismatch comes from delta_t and rotation
 def fRotate(x, jacobian=False):
-    BX = torch.zeros([x.shape[0],m,m]).float().to(x.device) #[batch_size, m, m]
-    BX[:,1,0] = torch.squeeze(-x[:,2,:]) 
-    BX[:,2,0] = torch.squeeze(x[:,1,:])
-    Const = C.to(x.device)
-    A = torch.add(BX, Const)   
-    # Taylor Expansion for F    
-    F = torch.eye(m).to(x.device)
-    F = F.reshape((1, m, m))
-    F = F.repeat(x.shape[0], 1, 1) # [batch_size, m, m] identity matrix
-    for j in range(1,J+1):
-        F_add = (torch.matrix_power(A*delta_t, j)/math.factorial(j))
-        F = torch.add(F, F_add)
-    F_rotated = torch.bmm(RotMatrix.reshape(1,m,m).repeat(x.shape[0],1,1),F)
-    if jacobian:
-        return torch.bmm(F_rotated, x), F_rotated
-    else:
-        return torch.bmm(F_rotated, x)
+    return lorenz_rotate(x, jacobian)
 
 ##################################################
 ### Observation function h for Lorenz Atractor ###
@@ -189,24 +136,86 @@ if(R_non_diag):
 ##################################
 def getJacobian(x, g):
     """
-    Currently, pytorch does not have a built-in function to compute Jacobian matrix
-    in a batched manner, so we have to iterate over the batch dimension.
+    Batched Jacobian of g at x, using the fastest available method:
+    1. the closed-form Jacobian if g is one of the Lorenz functions of this file (closed_form_jacobians)
+    2. torch.func: vmap of jacrev over the batch dimension
+    3. autograd.functional.jacobian for each batch element, for functions torch.func cannot trace
+       (e.g. in-place writes into a non-batched buffer, .item(), data-dependent control flow)
+    The method chosen for a function is remembered, so the fallback is only probed once.
+    Any error of the first vmap attempt selects the fallback; a genuine error of g is
+    raised again by the fallback.
     
     input x (torch.tensor): [batch_size, m/n, 1]
     input g (function): function to be differentiated
     output Jac (torch.tensor): [batch_size, m, m] for f, [batch_size, n, m] for h
     """
+    if g in closed_form_jacobians:
+        return closed_form_jacobians[g](x)
+    if jacobian_method.get(g) != 'autograd':
+        try:
+            Jac = vmap_jacobian(x, g)
+            jacobian_method[g] = 'vmap'
+            return Jac
+        except Exception:
+            # vmap raises RuntimeError for most untraceable functions, but also
+            # ValueError, TypeError or NotImplementedError depending on the operator
+            if jacobian_method.get(g) == 'vmap':
+                raise
+            jacobian_method[g] = 'autograd'
     # Method 1: using autograd.functional.jacobian
     batch_size = x.shape[0]
     Jac_x0 = torch.squeeze(autograd.functional.jacobian(g, torch.unsqueeze(x[0,:,:],0)))
-    Jac = torch.zeros([batch_size, Jac_x0.shape[0], Jac_x0.shape[1]])
+    Jac = torch.zeros([batch_size, Jac_x0.shape[0], Jac_x0.shape[1]]).to(x.device)
     Jac[0,:,:] = Jac_x0
     for i in range(1,batch_size):
         Jac[i,:,:] = torch.squeeze(autograd.functional.jacobian(g, torch.unsqueeze(x[i,:,:],0)))
-    # Method 2: using F, H directly
-    # _,Jac = g(x, jacobian=True)
     return Jac
 
+def getValueAndJacobian(x, g):
+    """
+    g(x) and its batched Jacobian at x; for the Lorenz transitions of this file
+    both come from the same pass over the Taylor series (closed_form_steps)
+    """
+    if g in closed_form_steps:
+        return closed_form_steps[g](x)
+    return g(x), getJacobian(x, g)
+
+jacobian_method = {} # fallback method that works for each function g, 'vmap' or 'autograd'
+
+def vmap_jacobian(x, g):
+    # g works on batches, so each sample is passed as a batch of one
+    def g_single(x_i):
+        return g(x_i.unsqueeze(0)).squeeze(0)
+    Jac = torch.func.vmap(torch.func.jacrev(g_single))(x) # [batch_size, n, 1, m, 1]
+    return Jac.reshape(x.shape[0], -1, x.shape[1])
+
+#############################
+### Closed-form Jacobians ###
+#############################
+def h_jacobian(x):
+    return H_design.to(x.device, x.dtype).expand(x.shape[0], n, n)
+
+def hRotate_jacobian(x):
+    return H_Rotate.to(x.device, x.dtype).expand(x.shape[0], n, n)
+
+def toSpherical_jacobian(cart):
+    """
+    Jacobian of toSpherical: rows d rho, d theta, d phi with respect to (x, y, z)
+
+    input cart (torch.tensor): [batch_size, m, 1] or [batch_size, m]
+    output Jac (torch.tensor): [batch_size, n, m]
+    """
+    x, y, z = cart[:, 0, ...].reshape(-1), cart[:, 1, ...].reshape(-1), cart[:, 2, ...].reshape(-1)
+    rho2 = x**2 + y**2 + z**2
+    rho = torch.sqrt(rho2)
+    r_xy2 = x**2 + y**2
+    r_xy = torch.sqrt(r_xy2)
+    zeros = torch.zeros_like(x)
+    d_rho = torch.stack([x / rho, y / rho, z / rho], dim=1)
+    d_theta = torch.stack([x * z / (rho2 * r_xy), y * z / (rho2 * r_xy), -r_xy / rho2], dim=1)
+    d_phi = torch.stack([-y / r_xy2, x / r_xy2, zeros], dim=1)
+    return torch.stack([d_rho, d_theta, d_phi], dim=1)
+
 def toSpherical(cart):
     """
     input cart (torch.tensor): [batch_size, m, 1] or [batch_size, m]
@@ -238,4 +247,24 @@ def toCartesian(sphe):
 
     cart = torch.cat([x,y,z],dim=1).reshape(cart.shape[0],3,1) # [batch_size, n, 1]
 
-    return cart
\ No newline at end of file
+    return cart
+
+### closed-form Jacobians used by getJacobian
+closed_form_jacobians = {
+    f_gen: lorenz_gen.jacobian,
+    f: lorenz.jacobian,
+    fInacc: lorenz_inacc.jacobian,
+    fRotate: lorenz_rotate.jacobian,
+    h: h_jacobian,
+    hRotate: hRotate_jacobian,
+    h_nonlinear: toSpherical_jacobian,
+    toSpherical: toSpherical_jacobian,
+}
+
+### transitions that return their value and closed-form Jacobian together, used by getValueAndJacobian
+closed_form_steps = {
+    f_gen: lorenz_gen.step_jacobian,
+    f: lorenz.step_jacobian,
+    fInacc: lorenz_inacc.step_jacobian,
+    fRotate: lorenz_rotate.step_jacobian,
+}
@@ -2,52 +2,147 @@
 The file contains utility functions for the simulations.
 """
 
+import os
 import torch
+import numpy as np
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from simulations.datastore import save_store, load_store, store_path
 
 def DataGen(args, SysModel_data, fileName):
 
     ##################################
     ### Generate Training Sequence ###
     ##################################
-    SysModel_data.GenerateBatch(args, args.N_E, args.T, randomInit=args.randomInit_train)
-    train_input = SysModel_data.Input
-    train_target = SysModel_data.Target
-    ### init conditions ###
-    train_init = SysModel_data.m1x_0_batch #size: N_E x m x 1
-    ### length mask ###
-    if args.randomLength:
-        train_lengthMask = SysModel_data.lengthMask
+    train_input, train_target, train_init, train_lengthMask = GenerateSplit(args, SysModel_data, 'train')
 
     ####################################
     ### Generate Validation Sequence ###
     ####################################
-    SysModel_data.GenerateBatch(args, args.N_CV, args.T, randomInit=args.randomInit_cv)
-    cv_input = SysModel_data.Input
-    cv_target = SysModel_data.Target
-    cv_init = SysModel_data.m1x_0_batch #size: N_CV x m x 1
-    ### length mask ###
-    if args.randomLength:
-        cv_lengthMask = SysModel_data.lengthMask
+    cv_input, cv_target, cv_init, cv_lengthMask = GenerateSplit(args, SysModel_data, 'cv')
 
     ##############################
     ### Generate Test Sequence ###
     ##############################
-    SysModel_data.GenerateBatch(args, args.N_T, args.T_test, randomInit=args.randomInit_test)
-    test_input = SysModel_data.Input
-    test_target = SysModel_data.Target
-    test_init = SysModel_data.m1x_0_batch #size: N_T x m x 1
-    ### length mask ###
-    if args.randomLength:
-        test_lengthMask = SysModel_data.lengthMask
+    test_input, test_target, test_init, test_lengthMask = GenerateSplit(args, SysModel_data, 'test')
 
     #################
     ### Save Data ###
     #################
+    SaveData(args, fileName, [train_input, train_target, train_init, train_lengthMask], \
+        [cv_input, cv_target, cv_init, cv_lengthMask], [test_input, test_target, test_init, test_lengthMask])
+
+def GenerateSplit(args, SysModel_data, split, seed=None):
+    """
+    generate the train, cv or test set of one system model
+
+    input split (str): 'train', 'cv' or 'test'
+    input seed (int): seed of a private torch RNG for this split, None to use the global RNG
+    output (list): input [size, n, T], target [size, m, T], init [size, m, 1], 
+        lengthMask [size, T_max] (None if not args.randomLength)
+    """
+    size, T, randomInit = {
+        'train': (args.N_E, args.T, args.randomInit_train),
+        'cv': (args.N_CV, args.T, args.randomInit_cv),
+        'test': (args.N_T, args.T_test, args.randomInit_test)}[split]
+    with torch.random.fork_rng(devices=[], enabled=seed is not None):
+        if seed is not None:
+            torch.manual_seed(seed)
+        SysModel_data.GenerateBatch(args, size, T, randomInit=randomInit)
+    lengthMask = SysModel_data.lengthMask if args.randomLength else None
+    #size: size x m x 1 for init conditions
+    return [SysModel_data.Input, SysModel_data.Target, SysModel_data.m1x_0_batch, lengthMask]
+
+def SaveData(args, fileName, train, cv, test):
+    # train, cv, test: [input, target, init, lengthMask] as returned by GenerateSplit
+    if args.data_format == 'store':
+        save_store(store_path(fileName), {'train': train, 'cv': cv, 'test': test})
+        return
+    [train_input, train_target, train_init, train_lengthMask] = train
+    [cv_input, cv_target, cv_init, cv_lengthMask] = cv
+    [test_input, test_target, test_init, test_lengthMask] = test
     if(args.randomLength):
         torch.save([train_input, train_target, cv_input, cv_target, test_input, test_target,train_init, cv_init, test_init, train_lengthMask,cv_lengthMask,test_lengthMask], fileName)
     else:
         torch.save([train_input, train_target, cv_input, cv_target, test_input, test_target,train_init, cv_init, test_init], fileName)
+
+def LoadData(args, fileName, device=None):
+    """
+    load a dataset saved by SaveData, from its memory-mapped store if there is one
+
+    input device (torch.device): device of the loaded tensors; None keeps the tensors of a store
+        memory-mapped on CPU, the training batches are then gathered from disk by sample_batch
+    output (list): [train_input, train_target, cv_input, cv_target, test_input, test_target, train_init, cv_init, test_init],
+        followed by [train_lengthMask, cv_lengthMask, test_lengthMask] if args.randomLength
+    """
+    if os.path.exists(os.path.join(store_path(fileName), 'meta.json')):
+        data = load_store(store_path(fileName), args.randomLength)
+        if device is not None:
+            data = [None if x is None else x.to(device) for x in data]
+        return data
+    return torch.load(fileName, map_location=device)
+
+def _GenerateSplit_worker(args, SysModel_data, split, seed):
+    # one generation task per worker process, the process pool already runs one task per core
+    torch.set_num_threads(1)
+    return GenerateSplit(args, SysModel_data, split, seed)
+
+def DataGen_many(args, sys_models, fileNames, workers=1, seed=None):
+    """
+    generate and save the datasets of several system models (e.g. one per SoW), with the
+    train, cv and test sets of every model generated as separate tasks on a process pool
+
+    Every task gets its own seed, spawned from numpy.random.SeedSequence(seed) by 
+    (model index, split), so the generated data only depends on seed and not on the
+    number of workers. seed=None draws fresh entropy.
+
+    input sys_models (list): system models, one dataset each
+    input fileNames (list): output file of each dataset
+    input workers (int): number of worker processes, 1 to generate in this process
+    """
+    assert len(sys_models) == len(fileNames)
+    splits = ['train', 'cv', 'test']
+    seeds = [[int(child.generate_state(1, dtype=np.uint64)[0]) for child in model_seq.spawn(len(splits))] \
+        for model_seq in np.random.SeedSequence(seed).spawn(len(sys_models))]
+    tasks = [(i, split, seeds[i][j]) for i in range(len(sys_models)) for j, split in enumerate(splits)]
+
+    if workers == 1:
+        results = [GenerateSplit(args, sys_models[i], split, task_seed) for i, split, task_seed in tasks]
+    else:
+        # fork where available: the main scripts are not import-safe for spawn
+        mp_context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+        with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context) as executor:
+            futures = [executor.submit(_GenerateSplit_worker, args, sys_models[i], split, task_seed) for i, split, task_seed in tasks]
+            results = [future.result() for future in futures]
+
+    for i, fileName in enumerate(fileNames):
+        SaveData(args, fileName, *results[len(splits)*i:len(splits)*(i+1)])
     
+def noise_factor(cov):
+    """
+    factor L of a noise covariance, so that randn @ L^T is zero-mean Gaussian noise with covariance cov
+
+    input cov (torch.tensor): [d, d]
+    output (torch.tensor): [d, d], None if cov is zero (no noise).
+        For 1 dim noise cov is used as the std, as in GenerateSequence.
+    """
+    if not torch.any(cov):
+        return None
+    if cov.shape[0] == 1:
+        return cov.reshape(1, 1)
+    return torch.linalg.cholesky(cov)
+
+def sample_noise(L, size, T):
+    """
+    draw the noise of all sequences and time steps at once
+
+    input L (torch.tensor): noise factor [d, d] from noise_factor, None for no noise
+    output (torch.tensor): [size, T, d], None for no noise
+    """
+    if L is None:
+        return None
+    return torch.randn(size, T, L.shape[0]) @ L.T
+
 def DecimateData(all_tensors, t_gen,t_mod, offset=0):
     
     # ratio: defines the relation between the sampling time of the true process and of the model (has to be an integer)
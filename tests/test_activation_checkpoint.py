@@ -0,0 +1,34 @@
+"""
+Activation checkpointing of the whole-sequence KalmanNet recursion (filter_sequence with checkpoint_every).
+"""
+
+import pytest
+import torch
+
+T = 17
+SoW = torch.tensor([[0, 0, 1, 1.], [0, 0, 1, 4.]])
+
+def loss_and_grad(mnet, hnet, y, M1_0, lengths, checkpoint_every):
+    hnet.zero_grad()
+    x = mnet.filter_sequence(y, M1_0, weights=hnet.generate(SoW), lengths=lengths, checkpoint_every=checkpoint_every)
+    loss = x.square().mean()
+    loss.backward()
+    return x.detach(), [p.grad.clone() for p in hnet.parameters()]
+
+@pytest.mark.parametrize('random_lengths', [False, True])
+@pytest.mark.parametrize('checkpoint_every', [1, 5, T])
+def test_same_gradients(mnet, hnet, random_lengths, checkpoint_every):
+    y, M1_0 = torch.randn(6, mnet.n, T), torch.randn(6, mnet.m, 1)
+    lengths = torch.tensor([T, 4, 11, 9, 16, 2]) if random_lengths else None
+    x_ref, grad_ref = loss_and_grad(mnet, hnet, y, M1_0, lengths, 0)
+    x, grad = loss_and_grad(mnet, hnet, y, M1_0, lengths, checkpoint_every)
+    assert torch.allclose(x, x_ref, rtol=1e-5, atol=1e-7)
+    for g, g_ref in zip(grad, grad_ref):
+        assert (g - g_ref).norm() <= 1e-5 * g_ref.norm()
+
+def test_no_checkpoints_without_grad(mnet, hnet):
+    y, M1_0 = torch.randn(6, mnet.n, T), torch.randn(6, mnet.m, 1)
+    with torch.no_grad():
+        weights = hnet.generate(SoW)
+        assert torch.equal(mnet.filter_sequence(y, M1_0, weights=weights, checkpoint_every=5), \
+            mnet.filter_sequence(y, M1_0, weights=weights))
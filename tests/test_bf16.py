@@ -0,0 +1,44 @@
+"""
+bfloat16 autocast mode of the HyperNetwork and KalmanNet (args.autocast_bf16), and its accuracy guard.
+"""
+
+import pytest
+import torch
+from pipelines.Pipeline_hknet import Pipeline_hknet
+
+T = 20
+SoW = torch.tensor([[0, 0, 1, 1.], [0, 0, 1, 4.]])
+
+def relative_error(x, x_ref):
+    return ((x - x_ref).norm() / x_ref.norm()).item()
+
+def test_close_to_float32(args, sys_model, mnet, hnet):
+    # the recursion of an untrained KalmanNet drifts off, the bfloat16 rounding then grows with T
+    sys_model.GenerateBatch(args, 4, 10)
+    y, M1_0 = sys_model.Input, sys_model.m1x_0_batch
+    outputs = {}
+    for bf16 in (False, True):
+        hnet.autocast_bf16 = mnet.autocast_bf16 = bf16
+        with torch.no_grad():
+            weights = hnet.generate(SoW)
+            outputs[bf16] = weights, mnet.filter_sequence(y, M1_0, weights=weights)
+    for output_bf16, output in zip(outputs[True], outputs[False]):
+        assert output_bf16.dtype == torch.float32
+        assert relative_error(output_bf16, output) < 2e-2
+    # with gradients, generate runs the layers under autocast instead of on the bfloat16 copy of the parameters
+    assert relative_error(hnet.generate(SoW).detach(), outputs[False][0]) < 1e-2
+
+@pytest.mark.parametrize('tol_dB, keep', [(10., True), (0., False)])
+def test_autocast_guard(tmp_path, args, sys_model, mnet, hnet, tol_dB, keep):
+    sys_model.GenerateBatch(args, 8, T)
+    pipeline = Pipeline_hknet('time', str(tmp_path), 'hknet')
+    pipeline.setModel(hnet, mnet)
+    pipeline.args = args
+    args.autocast_tol_dB = tol_dB
+    input_tuple = [(sys_model.Input, SoW[0])]
+    target_tuple = [(sys_model.Target, SoW[0])]
+    MSE_dB_bf16, MSE_dB, kept = pipeline.autocast_guard([0], [sys_model], input_tuple, target_tuple, [sys_model.m1x_0_batch])
+    # bfloat16 rounding changes the MSE, by less than 10 dB
+    assert 0 < (MSE_dB_bf16 - MSE_dB).abs().max() < 10
+    assert kept == keep
+    assert hnet.autocast_bf16 == mnet.autocast_bf16 == keep
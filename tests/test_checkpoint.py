@@ -0,0 +1,77 @@
+"""
+Checkpoint format of pipelines/checkpoint.py, and Pipeline_hknet.save.
+"""
+
+import pytest
+import torch
+from simulations.Linear_sysmdl import SystemModel
+from mnets.KNet_mnet import KalmanNetNN
+from hnets.hnet import HyperNetwork
+from pipelines.checkpoint import save_checkpoint, read_checkpoint, load_checkpoint_into, load_checkpoint, CheckpointWriter
+from pipelines.Pipeline_hknet import Pipeline_hknet
+
+SoW = torch.tensor([0, 0, 1, 4.])
+
+def outputs(hnet, mnet):
+    torch.manual_seed(1)
+    y, M1_0 = torch.randn(3, mnet.n, 8), torch.randn(3, mnet.m, 1)
+    with torch.no_grad():
+        weights = hnet.generate(SoW)
+        return weights, mnet.filter_sequence(y, M1_0, weights=weights)
+
+def test_load_into_reproduces_outputs(tmp_path, args, sys_model, mnet, hnet):
+    path = str(tmp_path / 'hknet.ckpt')
+    save_checkpoint(path, hnet, mnet, args, SoW_range=[0, 1])
+    hnet_new = HyperNetwork(args, mnet.n_params_KNet)
+    mnet_new = KalmanNetNN()
+    mnet_new.NNBuild(sys_model, args)
+    header = load_checkpoint_into(path, hnet_new, mnet_new)
+    assert header['SoW_range'] == [0, 1]
+    for output, output_new in zip(outputs(hnet, mnet), outputs(hnet_new, mnet_new)):
+        assert torch.equal(output, output_new)
+
+def test_load_rebuilds_from_header(tmp_path, args, sys_model, mnet, hnet):
+    path = str(tmp_path / 'hknet.ckpt')
+    # the header holds JSON, other args come back as their str
+    args.device = torch.device('cpu')
+    save_checkpoint(path, hnet, mnet, args)
+    hnet_new, mnet_new, header = load_checkpoint(path, sys_model)
+    assert header['args']['device'] == 'cpu'
+    assert header['args']['n_batch'] == args.n_batch
+    assert header['args']['knet_trainable'] is args.knet_trainable
+    assert header['mnet']['fc_shape'] == mnet.fc_shape
+    for output, output_new in zip(outputs(hnet, mnet), outputs(hnet_new, mnet_new)):
+        assert torch.equal(output, output_new)
+
+def test_mismatched_model_rejected(tmp_path, args, mnet, hnet):
+    path = str(tmp_path / 'hknet.ckpt')
+    save_checkpoint(path, hnet, mnet, args)
+    # a KalmanNet of another state and observation dimension
+    eye = torch.eye(3)
+    sys_model = SystemModel(eye, eye, eye, eye, 8, 8, SoW)
+    mnet_other = KalmanNetNN()
+    hnet_other = HyperNetwork(args, mnet_other.NNBuild(sys_model, args))
+    with pytest.raises(AssertionError, match='shapes do not match'):
+        load_checkpoint_into(path, hnet_other, mnet_other)
+    with pytest.raises(AssertionError, match='size does not match'):
+        load_checkpoint(path, sys_model, args)
+
+def test_writer_raises_failed_write(tmp_path, args, mnet, hnet):
+    writer = CheckpointWriter()
+    writer.save(str(tmp_path / 'hknet.ckpt'), hnet, mnet, args)
+    writer.save(str(tmp_path / 'missing' / 'hknet.ckpt'), hnet, mnet, args)
+    with pytest.raises(RuntimeError):
+        writer.wait()
+    assert writer.pending == []
+    read_checkpoint(str(tmp_path / 'hknet.ckpt'))
+
+def test_pipeline_save(tmp_path, args, mnet, hnet):
+    pipeline = Pipeline_hknet('time', str(tmp_path), 'hknet')
+    pipeline.setModel(hnet, mnet)
+    pipeline.MSE_cv_dB_opt = 1000
+    pipeline.MSE_cv_dB_epoch = torch.zeros(3)
+    pipeline.save()
+    # without pickled objects
+    state = torch.load(pipeline.PipelineName, weights_only=True)
+    assert set(state['results']) == {'MSE_cv_dB_opt', 'MSE_cv_dB_epoch'}
+    read_checkpoint(pipeline.PipelineName)
@@ -0,0 +1,37 @@
+"""
+Memory-mapped dataset store of simulations/datastore.py, against the .pt dataset lists.
+"""
+
+import pytest
+import torch
+from simulations.utils import DataGen, LoadData
+from simulations.datastore import store_path
+
+@pytest.mark.parametrize('randomLength', [False, True])
+def test_store_matches_pt(tmp_path, args, sys_model, randomLength):
+    args.N_E, args.N_CV, args.N_T = 6, 4, 3
+    args.T, args.T_test, args.T_min, args.T_max = 10, 12, 5, 15
+    args.randomLength = randomLength
+    args.randomInit_train, args.distribution = True, 'uniform'
+    fileName = str(tmp_path / 'data.pt')
+
+    args.data_format = 'pt'
+    torch.manual_seed(0)
+    DataGen(args, sys_model, fileName)
+    data_pt = LoadData(args, fileName)
+    args.data_format = 'store'
+    torch.manual_seed(0)
+    DataGen(args, sys_model, fileName)
+    data_store = LoadData(args, fileName)
+
+    assert len(data_store) == len(data_pt) == (12 if randomLength else 9)
+    for x_store, x_pt in zip(data_store, data_pt):
+        assert x_store.dtype == x_pt.dtype
+        assert torch.equal(x_store, x_pt)
+    if randomLength:
+        # the length masks
+        assert all(x.dtype == torch.bool for x in data_store[9:])
+    # the store takes precedence over the .pt file, and can be loaded onto a device
+    assert store_path(fileName) == str(tmp_path / 'data.data')
+    for x_store, x_pt in zip(LoadData(args, fileName, device=torch.device('cpu')), data_pt):
+        assert torch.equal(x_store, x_pt)
@@ -0,0 +1,53 @@
+"""
+Whole-sequence KalmanNet recursion with random sequence lengths (KalmanNetNN.filter_sequence with lengths).
+"""
+
+import torch
+from simulations.Linear_sysmdl import SystemModel
+from simulations.linear_canonical.parameters import F, H, Q_structure, R_structure
+from mnets.KNet_mnet import KalmanNetNN
+
+T = 40
+N_GROUPS = 4
+GROUP_SIZE = 16
+
+def build(args):
+    sys_model = SystemModel(F, Q_structure, H, R_structure, T, T, torch.tensor([0, 0, 1, 1.]))
+    mnet = KalmanNetNN()
+    n_params = mnet.NNBuild(sys_model, args)
+    # small weights, so the recursion stays bounded
+    weights = 0.01 * torch.randn(N_GROUPS, n_params)
+    y = torch.randn(N_GROUPS * GROUP_SIZE, mnet.n, T)
+    M1_0 = torch.zeros(N_GROUPS * GROUP_SIZE, mnet.m, 1)
+    lengths = torch.randint(5, T + 1, (N_GROUPS * GROUP_SIZE,))
+    return mnet, weights, y, M1_0, lengths
+
+def record_batch_sizes(mnet):
+    # batch size of every step of the recursion
+    sizes = []
+    step = mnet.step_fn()
+    def recording_step(state, y, w):
+        sizes.append(y.shape[0])
+        return step(state, y, w)
+    mnet.step_fn = lambda: recording_step
+    return sizes
+
+def test_grouped_weights_shrink_batch(args):
+    mnet, weights, y, M1_0, lengths = build(args)
+    sizes = record_batch_sizes(mnet)
+    with torch.no_grad():
+        mnet.filter_sequence(y, M1_0, weights=weights, lengths=lengths)
+    assert len(sizes) == int(lengths.max())
+    assert sizes == sorted(sizes, reverse=True)
+    assert sizes[-1] < sizes[0] == N_GROUPS * GROUP_SIZE
+    # the groups stay whole and of equal size
+    assert all(size % N_GROUPS == 0 for size in sizes)
+
+def test_grouped_weights_match_full_recursion(args):
+    mnet, weights, y, M1_0, lengths = build(args)
+    with torch.no_grad():
+        x_full = mnet.filter_sequence(y, M1_0, weights=weights)
+        x = mnet.filter_sequence(y, M1_0, weights=weights, lengths=lengths)
+    valid = (torch.arange(T) < lengths.unsqueeze(1)).unsqueeze(1).expand_as(x)
+    assert torch.allclose(x[valid], x_full[valid], rtol=1e-4, atol=1e-5)
+    assert (x[~valid] == 0).all()
@@ -0,0 +1,59 @@
+"""
+Covariance and gain histories of the KF and EKF (filter_history_stride, filter_history_dtype, callback).
+"""
+
+import pytest
+import torch
+from filters.Linear_KF import KalmanFilter
+from filters.EKF import ExtendedKalmanFilter
+from filters.utils import allocate_history
+
+T = 10
+B = 3
+
+def run_filter(Filter, args, sys_model, y, m2x_0, stride, dtype=None, callback=None):
+    args.filter_history_stride, args.filter_history_dtype = stride, dtype
+    KF = Filter(sys_model, args)
+    KF.Init_batched_sequence(torch.zeros(B, sys_model.m, 1), m2x_0)
+    KF.GenerateBatch(y, callback)
+    return KF
+
+def initial_covariances(sys_model, shared):
+    # shared: the Riccati path of the KF, otherwise the per-sample recursion
+    m2x_0 = torch.eye(sys_model.m).repeat(B, 1, 1)
+    if not shared:
+        m2x_0[0] *= 2
+    return m2x_0
+
+def test_allocate_history():
+    assert allocate_history([B, 2, 2], T, 0) is None
+    history = allocate_history([B, 2, 2], T, 3, torch.float16)
+    assert history.shape == (B, 2, 2, 4) and history.dtype == torch.float16
+
+@pytest.mark.parametrize('Filter, shared', [(KalmanFilter, True), (KalmanFilter, False), (ExtendedKalmanFilter, False)])
+def test_strided_history_is_slice_of_full(args, sys_model, Filter, shared):
+    sys_model.GenerateBatch(args, B, T)
+    m2x_0 = initial_covariances(sys_model, shared)
+    full = run_filter(Filter, args, sys_model, sys_model.Input, m2x_0, 1)
+    strided = run_filter(Filter, args, sys_model, sys_model.Input, m2x_0, 3, 'float16')
+    assert torch.equal(strided.x, full.x)
+    assert strided.sigma.dtype == torch.float16
+    assert torch.equal(strided.sigma, full.sigma[..., ::3].half())
+    if Filter is ExtendedKalmanFilter:
+        assert torch.equal(strided.KG_array, full.KG_array[..., ::3].half())
+    # only the means
+    assert run_filter(Filter, args, sys_model, sys_model.Input, m2x_0, 0).sigma is None
+
+@pytest.mark.parametrize('Filter, shared', [(KalmanFilter, True), (KalmanFilter, False), (ExtendedKalmanFilter, False)])
+def test_callback_sees_every_step(args, sys_model, Filter, shared):
+    sys_model.GenerateBatch(args, B, T)
+    m2x_0 = initial_covariances(sys_model, shared)
+    full = run_filter(Filter, args, sys_model, sys_model.Input, m2x_0, 1)
+    steps = []
+    def callback(t, KF):
+        steps.append(t)
+        assert torch.equal(KF.m1x_posterior.squeeze(2), full.x[:, :, t])
+        assert torch.equal(KF.m2x_posterior, full.sigma[..., t])
+        assert KF.KG.shape == (B, sys_model.m, sys_model.n)
+    run_filter(Filter, args, sys_model, sys_model.Input, m2x_0, 0, callback=callback)
+    assert steps == list(range(T))
@@ -0,0 +1,50 @@
+"""
+Batched Jacobians of simulations/lorenz_attractor/parameters.py (getJacobian and its fallback to autograd).
+"""
+
+import pytest
+import torch
+from torch import autograd
+import simulations.lorenz_attractor.parameters as parameters
+
+def branching(x):
+    # data-dependent control flow
+    return x**2 if x.sum() > 0 else torch.sin(x)
+
+def scaled_by_item(x):
+    return x * x.abs().max().item()
+
+class Cube(torch.autograd.Function):
+    # without setup_context, so torch.func cannot transform it
+    @staticmethod
+    def forward(ctx, x):
+        ctx.save_for_backward(x)
+        return x**3
+
+    @staticmethod
+    def backward(ctx, grad):
+        x, = ctx.saved_tensors
+        return 3 * x**2 * grad
+
+def reference_jacobian(x, g):
+    return torch.stack([autograd.functional.jacobian(g, x[i:i+1]).reshape(x.shape[1], x.shape[1]) \
+        for i in range(x.shape[0])])
+
+@pytest.mark.parametrize('g', [branching, scaled_by_item, Cube.apply])
+def test_fallback_for_functions_vmap_cannot_trace(g, monkeypatch):
+    monkeypatch.setattr(parameters, 'jacobian_method', {})
+    x = torch.randn(5, 3, 1)
+    for _ in range(2):
+        Jac = parameters.getJacobian(x, g)
+        assert parameters.jacobian_method[g] == 'autograd'
+        assert torch.allclose(Jac, reference_jacobian(x, g))
+
+def test_fallback_for_any_vmap_error(monkeypatch):
+    def unsupported(x, g):
+        raise ValueError('vmap: unsupported')
+    monkeypatch.setattr(parameters, 'jacobian_method', {})
+    monkeypatch.setattr(parameters, 'vmap_jacobian', unsupported)
+    x = torch.randn(5, 3, 1)
+    Jac = parameters.getJacobian(x, torch.sin)
+    assert parameters.jacobian_method[torch.sin] == 'autograd'
+    assert torch.allclose(Jac, torch.diag_embed(torch.cos(x.squeeze(2))))
@@ -0,0 +1,85 @@
+"""
+Batched Kalman filters of filters/Linear_KF.py and filters/EKF.py: the shared-covariance Riccati path
+against the per-sample recursion, and the Joseph and square-root covariance updates against the standard one.
+"""
+
+import pytest
+import torch
+from filters.Linear_KF import KalmanFilter
+from filters.EKF import ExtendedKalmanFilter
+
+T = 20
+B = 4
+
+@pytest.fixture
+def y(args, sys_model):
+    sys_model.GenerateBatch(args, B, T)
+    return sys_model.Input
+
+def run_filter(args, sys_model, y, m2x_0, form='standard', steady_tol=0, callback=None):
+    args.KF_form, args.KF_steady_tol, args.filter_history_stride = form, steady_tol, 1
+    KF = KalmanFilter(sys_model, args)
+    KF.Init_batched_sequence(torch.zeros(y.shape[0], sys_model.m, 1), m2x_0)
+    KF.GenerateBatch(y, callback)
+    return KF
+
+def per_sample(args, sys_model, y, m2x_0, **kwargs):
+    # one more sequence with another initial covariance takes the per-sample path for all
+    y = torch.cat([y, y[:1]])
+    m2x_0 = torch.cat([m2x_0, 2 * m2x_0[:1]])
+    KF = run_filter(args, sys_model, y, m2x_0, **kwargs)
+    return KF.x[:B], KF.sigma[:B]
+
+def test_shared_path_matches_per_sample(args, sys_model, y):
+    m2x_0 = torch.eye(sys_model.m).expand(B, -1, -1)
+    KF = run_filter(args, sys_model, y, m2x_0)
+    assert hasattr(KF, 'KG_seq') # shared path
+    x, sigma = per_sample(args, sys_model, y, m2x_0)
+    assert torch.allclose(KF.x, x, rtol=1e-5, atol=1e-5)
+    assert torch.allclose(KF.sigma, sigma, rtol=1e-5, atol=1e-6)
+
+def test_steady_tol_zero_runs_every_step(args, sys_model, y, monkeypatch):
+    # one Cholesky factorization per step of the shared Riccati recursion
+    n_steps = []
+    cholesky = torch.linalg.cholesky
+    def counting_cholesky(A):
+        n_steps.append(1)
+        return cholesky(A)
+    monkeypatch.setattr(torch.linalg, 'cholesky', counting_cholesky)
+    m2x_0 = torch.eye(sys_model.m).expand(B, -1, -1)
+
+    KF = run_filter(args, sys_model, y, m2x_0, steady_tol=0)
+    assert len(n_steps) == T
+    assert not any(torch.equal(KF.KG_seq[t], KF.KG_seq[t - 1]) for t in range(1, T))
+    # frozen once the gain changes by less than the tolerance
+    n_steps.clear()
+    KF_steady = run_filter(args, sys_model, y, m2x_0, steady_tol=1e-3)
+    assert len(n_steps) < T
+    assert torch.equal(KF_steady.KG_seq[-1], KF_steady.KG_seq[len(n_steps) - 1])
+    assert torch.allclose(KF_steady.x, KF.x, rtol=1e-3, atol=1e-3)
+
+@pytest.mark.parametrize('form', ['joseph', 'sqrt'])
+def test_covariance_forms_match_standard(args, sys_model, y, form):
+    m2x_0 = torch.eye(sys_model.m).expand(B, -1, -1)
+    # shared path
+    KF_ref = run_filter(args, sys_model, y, m2x_0)
+    KF = run_filter(args, sys_model, y, m2x_0, form=form)
+    assert torch.allclose(KF.x, KF_ref.x, rtol=1e-4, atol=1e-5)
+    assert torch.allclose(KF.sigma, KF_ref.sigma, rtol=1e-4, atol=1e-5)
+    # per-sample path
+    x_ref, sigma_ref = per_sample(args, sys_model, y, m2x_0)
+    x, sigma = per_sample(args, sys_model, y, m2x_0, form=form)
+    assert torch.allclose(x, x_ref, rtol=1e-4, atol=1e-5)
+    assert torch.allclose(sigma, sigma_ref, rtol=1e-4, atol=1e-5)
+
+@pytest.mark.parametrize('form', ['standard', 'joseph', 'sqrt'])
+def test_ekf_forms_match_kf(args, sys_model, y, form):
+    # on a linear model the EKF is the KF
+    m2x_0 = torch.eye(sys_model.m).expand(B, -1, -1)
+    KF = run_filter(args, sys_model, y, m2x_0)
+    args.KF_form, args.filter_history_stride = form, 1
+    EKF = ExtendedKalmanFilter(sys_model, args)
+    EKF.Init_batched_sequence(torch.zeros(B, sys_model.m, 1), m2x_0)
+    EKF.GenerateBatch(y)
+    assert torch.allclose(EKF.x, KF.x, rtol=1e-4, atol=1e-5)
+    assert torch.allclose(EKF.sigma, KF.sigma, rtol=1e-4, atol=1e-5)
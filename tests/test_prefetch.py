@@ -0,0 +1,54 @@
+"""
+Background prefetching of training batches of pipelines/prefetch.py.
+"""
+
+import time
+import pytest
+import torch
+from pipelines.prefetch import TrainingBatches, BatchPrefetcher
+
+N_B = 4
+
+def sources(randomLength):
+    # two datasets of 10 sequences
+    torch.manual_seed(0)
+    sources = []
+    for _ in range(2):
+        lengthMask = torch.arange(8) < torch.randint(3, 9, (10, 1)) if randomLength else None
+        sources.append((torch.randn(10, 2, 8), torch.randn(10, 2, 8), torch.randn(10, 2, 1), lengthMask))
+    return sources
+
+def batch_sequence(depth, randomLength, steps=6):
+    dataset = TrainingBatches(N_B, sources(randomLength), bucket_pool=2, generator=torch.Generator().manual_seed(1))
+    batches = BatchPrefetcher(dataset, torch.device('cpu'), depth=depth)
+    sequence = [next(batches) for _ in range(steps)]
+    batches.close()
+    return sequence
+
+def test_same_batches_with_and_without_thread():
+    for randomLength in (False, True):
+        sequence = batch_sequence(0, randomLength)
+        for depth in (1, 3):
+            for step, step_ref in zip(batch_sequence(depth, randomLength), sequence):
+                for batch, batch_ref in zip(step, step_ref):
+                    for x, x_ref in zip(batch, batch_ref):
+                        assert (x is None and x_ref is None) or torch.equal(x, x_ref)
+
+def test_thread_stops_when_closed_early():
+    dataset = TrainingBatches(N_B, sources(False), generator=torch.Generator().manual_seed(1))
+    batches = BatchPrefetcher(dataset, torch.device('cpu'), depth=2)
+    thread = batches.thread
+    next(batches)
+    # the queue is full, the worker waits for a free slot
+    while not batches.queue.full():
+        time.sleep(0.001)
+    batches.close()
+    assert not thread.is_alive()
+    assert batches.thread is None
+
+def test_error_of_source_raised():
+    dataset = TrainingBatches(20, sources(False)) # more than the 10 sequences
+    batches = BatchPrefetcher(dataset, torch.device('cpu'), depth=2)
+    with pytest.raises(AssertionError):
+        next(batches)
+    batches.close()
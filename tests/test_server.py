@@ -0,0 +1,136 @@
+"""
+Micro-batching inference service of mnets/server.py (TrackServer).
+"""
+
+import asyncio
+import time
+import pytest
+import torch
+from mnets.server import TrackServer
+
+T = 10
+SoW_1 = torch.tensor([0, 0, 1, 1.])
+SoW_2 = torch.tensor([0, 0, 1, 4.])
+
+def serve(server, main):
+    # run main(server) on a running server
+    async def run():
+        async with server:
+            return await main(server)
+    return asyncio.run(asyncio.wait_for(run(), 10))
+
+def record_ticks(server):
+    # number of requests of every tick
+    ticks = []
+    process = server.process
+    def recording_process(jobs):
+        ticks.append(len(jobs))
+        return process(jobs)
+    server.process = recording_process
+    return ticks
+
+def test_tracks_match_filter_sequence(mnet, hnet):
+    # three tracks of two SoWs, the last one opened after 4 steps
+    y = torch.randn(3, mnet.n, T)
+    M1_0 = torch.randn(3, mnet.m, 1)
+    SoWs = [SoW_1, SoW_1, SoW_2]
+    start = [0, 0, 4]
+
+    async def main(server):
+        x = torch.zeros(3, mnet.m, T)
+        for t in range(T):
+            tracks = [i for i in range(3) if start[i] <= t]
+            for i in tracks:
+                if start[i] == t:
+                    server.open_track(i, M1_0[i], SoWs[i])
+            results = await asyncio.gather(*[server.step(i, y[i, :, t]) for i in tracks])
+            for i, x_t in zip(tracks, results):
+                x[i, :, t:t+1] = x_t
+        return x
+
+    x = serve(TrackServer(mnet, hnet=hnet, max_wait_us=10000), main)
+    with torch.no_grad():
+        for i in range(3):
+            x_ref = mnet.filter_sequence(y[i:i+1, :, start[i]:], M1_0[i:i+1], weights=hnet.generate(SoWs[i]))
+            assert torch.allclose(x[i:i+1, :, start[i]:], x_ref, rtol=1e-4, atol=1e-6)
+
+def test_tick_flushed_at_max_batch(mnet, hnet):
+    async def main(server):
+        for i in range(5):
+            server.open_track(i, torch.zeros(mnet.m), SoW_1)
+        await asyncio.gather(*[server.step(i, torch.randn(mnet.n)) for i in range(5)])
+
+    server = TrackServer(mnet, hnet=hnet, max_batch=2, max_wait_us=100000)
+    ticks = record_ticks(server)
+    serve(server, main)
+    assert ticks == [2, 2, 1]
+
+def test_tick_flushed_after_max_wait(mnet, hnet):
+    async def main(server):
+        server.open_track('a', torch.zeros(mnet.m), SoW_1)
+        server.open_track('b', torch.zeros(mnet.m), SoW_1)
+        start = time.perf_counter()
+        first = asyncio.ensure_future(server.step('a', torch.randn(mnet.n)))
+        await asyncio.sleep(0.02)
+        await asyncio.gather(first, server.step('b', torch.randn(mnet.n)))
+        return time.perf_counter() - start
+
+    # the second request arrives within max_wait of the first one
+    server = TrackServer(mnet, hnet=hnet, max_wait_us=200000)
+    ticks = record_ticks(server)
+    assert serve(server, main) >= 0.2
+    assert ticks == [2]
+    # but not within a wait of zero
+    server = TrackServer(mnet, hnet=hnet, max_wait_us=0)
+    ticks = record_ticks(server)
+    serve(server, main)
+    assert ticks == [1, 1]
+
+def test_bad_request_fails_alone(mnet, hnet):
+    async def main(server):
+        server.open_track('a', torch.zeros(mnet.m), SoW_1)
+        server.open_track('b', torch.zeros(mnet.m), SoW_1)
+        return await asyncio.gather(server.step('a', torch.randn(mnet.n)), server.step('b', torch.randn(mnet.n + 1)), \
+            server.step('c', torch.randn(mnet.n)), return_exceptions=True)
+
+    x_a, error_b, error_c = serve(TrackServer(mnet, hnet=hnet, max_wait_us=10000), main)
+    assert x_a.shape == (mnet.m, 1)
+    assert isinstance(error_b, ValueError)
+    assert isinstance(error_c, KeyError)
+
+def test_stop_cancels_pending_requests(mnet, hnet):
+    server = TrackServer(mnet, hnet=hnet, max_batch=1, max_wait_us=0)
+    process = server.process
+    def slow_process(jobs):
+        time.sleep(0.05)
+        return process(jobs)
+    server.process = slow_process
+
+    async def main():
+        await server.start()
+        server.open_track('a', torch.zeros(mnet.m), SoW_1)
+        futures = [asyncio.ensure_future(server.step('a', torch.randn(mnet.n))) for _ in range(4)]
+        await asyncio.sleep(0.01)
+        await server.stop()
+        return await asyncio.gather(*futures, return_exceptions=True)
+
+    results = asyncio.run(asyncio.wait_for(main(), 10))
+    assert all(isinstance(result, asyncio.CancelledError) for result in results)
+    assert server.queue is None
+
+def test_weights_of_sow(mnet, hnet):
+    server = TrackServer(mnet, hnet=hnet)
+    server.open_track('a', torch.zeros(mnet.m), SoW_1)
+    server.open_track('b', torch.zeros(mnet.m), SoW_1)
+    server.open_track('c', torch.zeros(mnet.m), SoW_2)
+    assert len(server.weights) == 2
+    # reopened with another SoW, the weights of SoW_2 go with its last track
+    server.open_track('c', torch.zeros(mnet.m), SoW_1)
+    assert len(server.weights) == 1
+    server.close_track('a')
+    server.close_track('c')
+    assert len(server.weights) == 1
+    server.close_track('b')
+    assert server.weights == {}
+    with pytest.raises(ValueError):
+        TrackServer(mnet, weights=hnet.generate(SoW_1)).open_track('a', torch.zeros(mnet.m), SoW_1)
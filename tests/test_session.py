@@ -0,0 +1,44 @@
+"""
+Streaming KalmanNet filtering of mnets/session.py (FilterSession).
+"""
+
+import torch
+from mnets.session import FilterSession
+
+T = 12
+SoW = torch.tensor([[0, 0, 1, 1.], [0, 0, 1, 4.]]) # one weight group per SoW
+
+def inputs(mnet):
+    return torch.randn(4, mnet.n, T), torch.randn(4, mnet.m, 1)
+
+def test_step_matches_filter_sequence(mnet, hnet):
+    y, M1_0 = inputs(mnet)
+    with torch.no_grad():
+        x_ref = mnet.filter_sequence(y, M1_0, weights=hnet.generate(SoW))
+    session = FilterSession(mnet, M1_0, hnet=hnet, SoW=SoW)
+    x = torch.cat([session.step(y[:, :, t]) for t in range(T)], dim=2)
+    assert torch.allclose(x, x_ref, rtol=1e-5, atol=1e-7)
+    assert session.t == T
+
+def test_step_many_matches_filter_sequence(mnet, hnet):
+    y, M1_0 = inputs(mnet)
+    with torch.no_grad():
+        x_ref = mnet.filter_sequence(y, M1_0, weights=hnet.generate(SoW))
+    session = FilterSession(mnet, M1_0, hnet=hnet, SoW=SoW)
+    x = torch.cat([session.step_many(y[:, :, :5]), session.step_many(y[:, :, 5:])], dim=2)
+    assert torch.allclose(x, x_ref, rtol=1e-5, atol=1e-7)
+    assert session.t == T
+
+def test_restore_resumes_from_snapshot(mnet, hnet):
+    y, M1_0 = inputs(mnet)
+    session = FilterSession(mnet, M1_0, hnet=hnet, SoW=SoW)
+    session.step_many(y[:, :, :5])
+    snapshot = session.snapshot()
+    x = session.step_many(y[:, :, 5:])
+    # resumed in the same session and in another one
+    session.restore(snapshot)
+    assert session.t == 5
+    assert torch.equal(session.step_many(y[:, :, 5:]), x)
+    other = FilterSession(mnet, torch.zeros_like(M1_0), hnet=hnet, SoW=SoW)
+    other.restore(snapshot)
+    assert torch.equal(other.step_many(y[:, :, 5:]), x)
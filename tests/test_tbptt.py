@@ -0,0 +1,52 @@
+"""
+Truncated backpropagation through time of pipelines/utils.py (truncated_bptt).
+"""
+
+import pytest
+import torch
+from pipelines.utils import truncated_bptt, masked_mse, seq_lengths
+
+T = 12
+SoW = torch.tensor([[0, 0, 1, 1.], [0, 0, 1, 4.]])
+
+def batch(mnet, randomLength):
+    torch.manual_seed(1)
+    y, target, init = torch.randn(4, mnet.n, T), torch.randn(4, mnet.m, T), torch.randn(4, mnet.m, 1)
+    lengthMask = None
+    if randomLength:
+        lengthMask = torch.arange(T) < torch.tensor([[T], [5], [9], [7]])
+        y, target = y.masked_fill(~lengthMask.unsqueeze(1), 0), target.masked_fill(~lengthMask.unsqueeze(1), 0)
+    return y, target, init, lengthMask
+
+def full_bptt(mnet, hnet, y, target, init, lengthMask):
+    # loss and gradient of one backward through all T steps, as in the training loop
+    hnet.zero_grad()
+    x = mnet.filter_sequence(y, init, weights=hnet.generate(SoW), lengths=seq_lengths(lengthMask))
+    loss = masked_mse(x, target, lengthMask).mean()
+    loss.backward()
+    return loss.detach(), [p.grad.clone() for p in hnet.parameters()]
+
+def tbptt(mnet, hnet, window, y, target, init, lengthMask):
+    # a learning rate of 0 keeps the parameters, and the gradient of the last window
+    optimizer = torch.optim.SGD(hnet.parameters(), lr=0)
+    loss = truncated_bptt(mnet, optimizer, window, [(lambda: hnet.generate(SoW), y, init, target, lengthMask)])
+    return loss, [p.grad.clone() for p in hnet.parameters()]
+
+@pytest.mark.parametrize('randomLength', [False, True])
+def test_window_of_whole_sequence_is_full_bptt(mnet, hnet, randomLength):
+    data = batch(mnet, randomLength)
+    loss_ref, grad_ref = full_bptt(mnet, hnet, *data)
+    for window in (T, 2 * T):
+        loss, grad = tbptt(mnet, hnet, window, *data)
+        assert torch.allclose(loss, loss_ref, rtol=1e-5)
+        for g, g_ref in zip(grad, grad_ref):
+            assert (g - g_ref).norm() <= 1e-5 * g_ref.norm()
+
+@pytest.mark.parametrize('randomLength', [False, True])
+def test_loss_of_windows_is_sequence_loss(mnet, hnet, randomLength):
+    # with unchanged parameters, detaching the state between windows does not change the outputs
+    data = batch(mnet, randomLength)
+    loss_ref, grad_ref = full_bptt(mnet, hnet, *data)
+    loss, grad = tbptt(mnet, hnet, 5, *data)
+    assert torch.allclose(loss, loss_ref, rtol=1e-5)
+    assert not all(torch.allclose(g, g_ref) for g, g_ref in zip(grad, grad_ref))
@@ -0,0 +1,81 @@
+"""
+Cache of generated KNet weights of hnets/hnet.py (WeightCache).
+"""
+
+import pytest
+import torch
+from hnets.hnet import HyperNetwork, WeightCache
+
+SoW_1 = torch.tensor([0, 0, 1, 1.])
+SoW_2 = torch.tensor([0, 0, 1, 4.])
+SoW_3 = torch.tensor([0, 0, 1, 7.])
+
+@pytest.fixture
+def cache(hnet):
+    hnet.eval()
+    return WeightCache(hnet)
+
+def n_bytes(weights):
+    return weights.numel() * weights.element_size()
+
+def test_hits_and_misses(cache):
+    weights = cache(SoW_1)
+    assert cache(SoW_1) is weights
+    # within the quantum of SoW_1
+    assert cache(SoW_1 + 1e-8) is weights
+    cache(SoW_2)
+    assert cache.stats() == {'hits': 2, 'misses': 2, 'entries': 2, 'bytes': 2 * n_bytes(weights)}
+
+def test_lru_eviction_by_bytes(cache):
+    cache.max_bytes = 2 * n_bytes(cache(SoW_1))
+    cache(SoW_2)
+    cache(SoW_1) # SoW_2 is now the least recently used
+    cache(SoW_3)
+    assert cache.stats()['entries'] == 2
+    assert cache.n_bytes == cache.max_bytes
+    misses = cache.misses
+    cache(SoW_1)
+    cache(SoW_3)
+    assert cache.misses == misses
+    cache(SoW_2)
+    assert cache.misses == misses + 1
+    # weights larger than the whole cache are not kept
+    cache.max_bytes = 1
+    cache.clear()
+    cache(SoW_1)
+    assert cache.stats()['entries'] == 0
+
+def test_invalidated_by_optimizer_step(cache, hnet):
+    weights = cache(SoW_1)
+    optimizer = torch.optim.SGD(hnet.parameters(), lr=0.1)
+    hnet.train()
+    hnet.generate(SoW_1).square().sum().backward()
+    optimizer.step()
+    hnet.eval()
+    new_weights = cache(SoW_1)
+    assert cache.misses == 2
+    assert not torch.equal(new_weights, weights)
+    assert torch.equal(new_weights, hnet.generate(SoW_1))
+
+def test_invalidated_by_load_state_dict(cache, hnet, args, mnet):
+    cache(SoW_1)
+    other = HyperNetwork(args, mnet.n_params_KNet)
+    hnet.load_state_dict(other.state_dict())
+    assert torch.equal(cache(SoW_1), other.generate(SoW_1))
+    assert cache.misses == 2
+
+def test_independent_of_hidden_state(cache, hnet):
+    # forward carries the GRU hidden state from call to call, generate and the cache do not
+    for SoW in (SoW_2, SoW_3, SoW_1):
+        hnet(SoW)
+    weights = cache(SoW_1)
+    assert torch.equal(weights, hnet.generate(SoW_1))
+    hnet.init_hidden()
+    assert torch.allclose(weights, hnet(SoW_1), atol=1e-6)
+    hnet(SoW_2)
+    assert cache(SoW_1) is weights
+
+def test_bypassed_in_training(cache, hnet):
+    hnet.train()
+    cache(SoW_1)
+    assert cache.stats() == {'hits': 0, 'misses': 0, 'entries': 0, 'bytes': 0}